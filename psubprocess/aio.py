@@ -0,0 +1,210 @@
+'''An asyncio interface for the parallel runs.
+
+The splitting, the launching of the subjobs and the joining are done by a
+prunner.Popen in the threads of an executor, so the event loop is never
+blocked by them. The subjobs are polled from a timer of the loop.
+
+The futures returned can be awaited with asyncio or yielded from the
+coroutines with trollius, the asyncio port for python 2:
+
+    popen = yield From(create_parallel(cmd, cmd_def=cmd_def))
+    retcode = yield From(popen.wait())
+
+Created on 17/10/2026
+
+@author: jose
+'''
+
+# Copyright 2009 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of psubprocess.
+# psubprocess is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# psubprocess is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with psubprocess. If not, see <http://www.gnu.org/licenses/>.
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+from psubprocess.prunner import Popen, POLL_INTERVAL
+
+def _get_loop(loop):
+    'It returns the given loop or the current one'
+    if asyncio is None:
+        raise RuntimeError('asyncio or trollius is required')
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    return loop
+
+def _create_future(loop):
+    'It creates a future attached to the loop'
+    if 'create_future' in dir(loop):
+        return loop.create_future()
+    return asyncio.Future(loop=loop)
+
+def _chain_future(source, destination, transform=None):
+    '''When the source future is done the destination gets its result,
+    transformed by the given function, or its exception'''
+    def copy_result(source):
+        'It sets the result of the destination future'
+        if destination.cancelled():
+            return
+        if source.cancelled():
+            destination.cancel()
+        elif source.exception() is not None:
+            destination.set_exception(source.exception())
+        elif transform is None:
+            destination.set_result(source.result())
+        else:
+            destination.set_result(transform(source.result()))
+    source.add_done_callback(copy_result)
+
+class AsyncStream(object):
+    '''A PIPE of a prunner.Popen used from an event loop.
+
+    The reads, the writes and the close are done in the executor and they
+    return futures.
+    '''
+    def __init__(self, fhand, run):
+        'It inits the stream with the PIPE and the function that runs it'
+        self._fhand = fhand
+        self._run = run
+
+    def _get_closed(self):
+        'It returns True if the PIPE is closed'
+        return self._fhand.closed
+    closed = property(_get_closed)
+
+    def read(self, size=-1):
+        'It returns a future with up to size bytes, all of them by default'
+        return self._run(self._fhand.read, size)
+
+    def readline(self):
+        'It returns a future with the next line'
+        return self._run(self._fhand.readline)
+
+    def write(self, data):
+        'It returns a future done when the data has been written'
+        return self._run(self._fhand.write, data)
+
+    def close(self):
+        'It returns a future done when the PIPE is closed'
+        return self._run(self._fhand.close)
+
+class AsyncPopen(object):
+    '''It runs a prunner.Popen from an event loop.
+
+    The methods that would block return futures. returncode is None until the
+    future returned by wait is done. The stdin, stdout and stderr PIPEs are
+    AsyncStreams.
+    '''
+    def __init__(self, popen, loop=None, executor=None,
+                 poll_interval=POLL_INTERVAL):
+        'It inits the object with a running prunner.Popen'
+        self.popen = popen
+        self._loop = _get_loop(loop)
+        self._executor = executor
+        self._poll_interval = poll_interval
+        self._wait_future = None
+        self.returncode = None
+        pipes = (popen.stdin, popen.stdout, popen.stderr)
+        self.stdin, self.stdout, self.stderr = [
+                    None if pipe is None else AsyncStream(pipe, self._run)
+                                                            for pipe in pipes]
+
+    def _run(self, func, *args):
+        'It runs the function in the executor and it returns its future'
+        return self._loop.run_in_executor(self._executor, func, *args)
+
+    def _check(self):
+        '''It checks if the subjobs have finished in the executor.
+
+        The finished outputs are joined and the pending subjobs launched.
+        '''
+        if self._wait_future.done():
+            return
+        def checked(future):
+            'It waits for the rest of the subjobs once one has failed'
+            if future.cancelled() or future.exception() is not None:
+                _chain_future(future, self._wait_future)
+            elif future.result() is None:
+                self._loop.call_later(self._poll_interval, self._check)
+            else:
+                _chain_future(self._run(self.popen.wait), self._wait_future)
+        self._run(self.popen.poll).add_done_callback(checked)
+
+    def wait(self):
+        '''It returns a future with the returncode of the run, done when all
+        the subjobs have finished and the outputs are joined'''
+        if self._wait_future is None:
+            self._wait_future = _create_future(self._loop)
+            def set_returncode(future):
+                'It keeps the returncode'
+                if not future.cancelled() and future.exception() is None:
+                    self.returncode = future.result()
+            self._wait_future.add_done_callback(set_returncode)
+            #closing the stdin PIPE waits for the chunks to be split
+            if self.popen.stdin is not None:
+                closed = self._run(self.popen.stdin.close)
+                def check(future):
+                    'It starts to poll once the stdin is closed'
+                    if future.cancelled() or future.exception() is not None:
+                        _chain_future(future, self._wait_future)
+                    else:
+                        self._check()
+                closed.add_done_callback(check)
+            else:
+                self._check()
+        return self._wait_future
+
+    def communicate(self, input=None):
+        '''It returns a future with the stdout and stderr of the run.
+
+        The input is written in the stdin PIPE and the PIPEs are read in the
+        executor.
+        '''
+        #same interface as subprocess.Popen
+        #pylint: disable-msg=W0622
+        future = self._run(self.popen.communicate, input)
+        def set_returncode(future):
+            'It keeps the returncode'
+            if not future.cancelled() and future.exception() is None:
+                self.returncode = self.popen.returncode
+        future.add_done_callback(set_returncode)
+        return future
+
+    def kill(self):
+        'It kills all the subjobs'
+        self.popen.kill()
+
+    def terminate(self):
+        'It terminates all the subjobs'
+        self.popen.terminate()
+
+def create_parallel(cmd, loop=None, executor=None, **kwargs):
+    '''It returns a future with an AsyncPopen for the given cmd.
+
+    The arguments are the ones of the prunner.Popen. The input files are
+    split and the subjobs launched in the executor, the default one of the
+    loop if not given.
+    '''
+    loop = _get_loop(loop)
+    future = _create_future(loop)
+    popen_future = loop.run_in_executor(executor,
+                                        lambda: Popen(cmd, **kwargs))
+    _chain_future(popen_future, future,
+                  lambda popen: AsyncPopen(popen, loop=loop,
+                                           executor=executor))
+    return future
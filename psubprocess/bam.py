@@ -5,87 +5,268 @@ Created on 06/09/2010
 
 @author: peio
 '''
-from psubprocess.utils import call, get_fhand
-from tempfile import NamedTemporaryFile
-
-
-def bam2sam(bam_fhand, sam_fhand, header=False):
-    '''It converts between bam and sam.'''
-    bam_fhand.seek(0)
-
-    cmd = ['samtools', 'view', bam_fhand.name, '-o', sam_fhand.name]
-    if header:
-        cmd.insert(2, '-h')
-    call(cmd, raise_on_error=True)
-    sam_fhand.flush()
-
-def sam2bam(sam_fhand, bam_fhand, header=None):
-    'It converts between bam and sam.'
-    sam_fhand.seek(0)
-    if header is not None:
-        pass
-    cmd = ['samtools', 'view', '-bSh', '-o', bam_fhand.name, sam_fhand.name]
-    call(cmd, raise_on_error=True)
-    bam_fhand.flush()
-
-def get_bam_header(bam_fhand, header_fhand):
-    'It gets the header of the bam'
-    cmd = ['samtools', 'view', '-H', bam_fhand.name, '-o', header_fhand.name]
-    call(cmd, raise_on_error=True)
-
-def bam_unigene_counter(fhand, expression=None):
-    'It count the unigene number of a bam'
-    unigenes = set()
-    for line in fhand:
-        unigene = line.split()[2]
-        unigenes.add(unigene)
-    return len(unigenes)
-
-def unigenes_in_bam(fhand, expression=None):
-    'It yields the bam mapping by joined by unigene'
-    unigene_prev   = None
-    unigene_lines = ''
-    for line in fhand:
-        unigene = line.split()[2]
-        if unigene_prev is not None and unigene_prev != unigene:
-            yield unigene_lines
-            unigene_lines = ''
-
-        unigene_lines += line
-        unigene_prev = unigene
-    else:
-        yield unigene_lines
+import struct, os
+from array import array
+from psubprocess.bgzf import (BgzfReader, BgzfWriter, get_bgzf_blocks,
+                              copy_bgzf_section, virtual_offset_to_position,
+                              BGZF_EOF)
 
-def bam_joiner(out_file, in_files):
-    'It joins bam files'
-    #are we working with fhands or fnames?
-    out_fhand = get_fhand(out_file, writable=True)
-    sam_fhand = NamedTemporaryFile(suffix='.sam')
+BAM_MAGIC = 'BAM\x01'
+BAI_MAGIC = 'BAI\x01'
+#the pseudo bin of the bai index with the reference span and read counts
+_BAI_PSEUDO_BIN = 37450
+
+
+def iter_bam_records(reader):
+    '''It yields the alignment records of a bam as binary strings.
+
+    The reader should be a BgzfReader placed at the first alignment. Every
+    record includes its block_size.
+    '''
+    while True:
+        block_size = reader.read(4)
+        if not block_size:
+            break
+        if len(block_size) < 4:
+            raise ValueError('Truncated bam record in ' + reader.name)
+        size = struct.unpack('<i', block_size)[0]
+        data = reader.read(size)
+        if len(data) < size:
+            raise ValueError('Truncated bam record in ' + reader.name)
+        yield block_size + data
+
+def bam_reference_offsets(fname, blocks=None):
+    '''It returns an array with the offsets in which every reference starts.
+
+    The alignments of every reference should be together in the bam, every
+    run of consecutive alignments with the same refID is an item. The offsets
+    are uncompressed positions, the end of the alignments is appended at the
+    end of the array. The block table of the bam can be given (see
+    get_bgzf_blocks).
+    '''
+    alignments_start = read_bam_header(fname, blocks=blocks)[2]
+    reader = BgzfReader(fname, blocks=blocks)
+    reader.seek(alignments_start)
+    offsets = array('L')
+    offset = alignments_start
+    previous_ref = None
+    for record in iter_bam_records(reader):
+        ref_id = record[4:8]
+        if ref_id != previous_ref:
+            offsets.append(offset)
+        previous_ref = ref_id
+        offset += len(record)
+    reader.close()
+    offsets.append(offset)
+    return offsets
+
+def read_bam_header(fname, blocks=None):
+    '''It returns the header of a bam file.
 
-    first = True
-    for file_ in in_files:
-        file_ = get_fhand(file_)
-        if first:
-            first = False
-            bam2sam(file_, sam_fhand, header=True)
+    It returns the header text, a list with the (name, length) of the
+    references and the uncompressed offset in which the alignments start.
+    The block table of the bam can be given (see get_bgzf_blocks).
+    '''
+    reader = BgzfReader(fname, blocks=blocks)
+    try:
+        read_int = lambda: struct.unpack('<i', reader.read(4))[0]
+        if reader.read(4) != BAM_MAGIC:
+            raise ValueError('Not a bam file: ' + fname)
+        text = reader.read(read_int())
+        references = []
+        for index in range(read_int()):
+            name = reader.read(read_int()).rstrip('\x00')
+            references.append((name, read_int()))
+        return text, references, reader.tell()
+    except struct.error:
+        raise ValueError('Truncated bam header: ' + fname)
+    finally:
+        reader.close()
 
-        else:
-            sam_fhand_temp = NamedTemporaryFile(suffix='.sam')
-            bam2sam(file_, sam_fhand_temp)
-            sam_fhand_temp.seek(0)
-            sam_fhand2 = open(sam_fhand.name, 'a')
-            sam_fhand2.write(open(sam_fhand_temp.name).read())
-            sam_fhand2.close()
+def _bam_headers_compatible(header1, header2):
+    '''The alignments of two bams can be joined if they have the same
+    references and the same header, the @PG lines apart'''
+    def header_lines(text):
+        'The header lines without the programs'
+        return [line for line in text.rstrip('\x00').splitlines()
+                                                if not line.startswith('@PG')]
+    return (header1[1] == header2[1] and
+            header_lines(header1[0]) == header_lines(header2[0]))
 
-    sam_fhand.flush()
-    sam2bam(sam_fhand, out_fhand)
-    out_fhand.flush()
+def pack_bam_header(text, references):
+    '''It returns the binary bam header for the given text and (name, length)
+    references'''
+    header = [BAM_MAGIC, struct.pack('<i', len(text)), text,
+              struct.pack('<i', len(references))]
+    for name, length in references:
+        header.append(struct.pack('<i', len(name) + 1) + name + '\x00')
+        header.append(struct.pack('<i', length))
+    return ''.join(header)
 
+def _merge_bam_headers(headers):
+    '''It returns the text and the references of a header with the references
+    and the header lines of all the given headers.
 
+    The first header is kept as it is, the references and the lines not found
+    in it are added at the end.
+    '''
+    text = headers[0][0].rstrip('\x00')
+    references = list(headers[0][1])
+    ref_names = set([name for name, length in references])
+    lines = set(text.splitlines())
+    for header in headers[1:]:
+        for name, length in header[1]:
+            if name not in ref_names:
+                ref_names.add(name)
+                references.append((name, length))
+                text += '@SQ\tSN:%s\tLN:%d\n' % (name, length)
+        for line in header[0].rstrip('\x00').splitlines():
+            if line and line not in lines and not line.startswith('@HD') and \
+               not line.startswith('@SQ'):
+                lines.add(line)
+                text += line + '\n'
+    return text, references
+
+def _remap_bam_record(record, ref_map):
+    'It changes the refID and the next_refID of the record using the ref_map'
+    ref_id, = struct.unpack('<i', record[4:8])
+    next_ref_id, = struct.unpack('<i', record[24:28])
+    if ref_id >= 0:
+        ref_id = ref_map[ref_id]
+    if next_ref_id >= 0:
+        next_ref_id = ref_map[next_ref_id]
+    return ''.join((record[:4], struct.pack('<i', ref_id), record[8:24],
+                    struct.pack('<i', next_ref_id), record[28:]))
+
+def _merging_bam_joiner(out_fname, in_fnames, headers):
+    '''It joins bams with different headers.
+
+    The output has all the references and header lines and the references of
+    the alignments are renumbered to match it.
+    '''
+    text, references = _merge_bam_headers(headers)
+    ref_indexes = dict([(name, index) for index, (name, length) in
+                                                        enumerate(references)])
+    writer = BgzfWriter(open(out_fname, 'wb'))
+    writer.write(pack_bam_header(text, references))
+    for fname, header in zip(in_fnames, headers):
+        ref_map = [ref_indexes[name] for name, length in header[1]]
+        reader = BgzfReader(fname)
+        reader.seek(header[2])
+        for record in iter_bam_records(reader):
+            if ref_map != range(len(ref_map)):
+                record = _remap_bam_record(record, ref_map)
+            writer.write(record)
+        reader.close()
+    writer.close()
+
+def bam_joiner(out_file, in_files):
+    '''It joins bam files.
+
+    If all the headers are compatible the compressed blocks of the alignments
+    are concatenated after the first header, otherwise the alignments are
+    read and written again with a header with the references of all bams.
+    '''
+    #are we working with fhands or fnames?
+    get_fname = lambda file_: (file_ if isinstance(file_, basestring) else
+                                                                    file_.name)
+    in_fnames = [get_fname(file_) for file_ in in_files]
+    headers = [read_bam_header(fname) for fname in in_fnames]
+    for header in headers[1:]:
+        if not _bam_headers_compatible(headers[0], header):
+            _merging_bam_joiner(get_fname(out_file), in_fnames, headers)
+            return
+    out_fhand = open(get_fname(out_file), 'wb')
+    for index, fname in enumerate(in_fnames):
+        #the first bam keeps its header
+        start = headers[index][2] if index else 0
+        fhand = open(fname, 'rb')
+        blocks = get_bgzf_blocks(fhand)
+        copy_bgzf_section(fhand, out_fhand, blocks, start, blocks[1][-1])
+        fhand.close()
+    out_fhand.write(BGZF_EOF)
+    out_fhand.close()
 
+def find_bam_index(fname):
+    '''It returns the bai index of the bam, if there is an up to date one.
 
+    The index can be named file.bam.bai or file.bai.
+    '''
+    for index_fname in (fname + '.bai', os.path.splitext(fname)[0] + '.bai'):
+        if (os.path.exists(index_fname) and
+            os.path.getmtime(index_fname) >= os.path.getmtime(fname)):
+            return index_fname
+    return None
 
+def read_bam_index(fname):
+    '''It reads the read counts and spans of the references from a bai index.
 
+    It returns a list with a (ref_begin, ref_end, n_mapped, n_unmapped) tuple
+    for every reference, with the virtual offsets of the first and after the
+    last read. The references without reads have None.
+    '''
+    fhand = open(fname, 'rb')
+    try:
+        read_int = lambda: struct.unpack('<i', fhand.read(4))[0]
+        if fhand.read(4) != BAI_MAGIC:
+            raise ValueError('Not a bai index: ' + fname)
+        references = []
+        for ref_index in range(read_int()):
+            reference = None
+            for bin_index in range(read_int()):
+                bin_, n_chunk = struct.unpack('<Ii', fhand.read(8))
+                if bin_ == _BAI_PSEUDO_BIN:
+                    #two pseudo chunks with the span and the counts
+                    reference = struct.unpack('<4Q', fhand.read(32))
+                else:
+                    fhand.seek(16 * n_chunk, 1)
+            #the linear index
+            fhand.seek(8 * read_int(), 1)
+            references.append(reference)
+        return references
+    except struct.error:
+        raise ValueError('Truncated bai index: ' + fname)
+    finally:
+        fhand.close()
 
+def get_bam_reference_spans(fname, index_fname, blocks=None):
+    '''It returns where the reads of every reference are in a sorted bam.
 
+    It returns the block offsets of the bam (see get_bgzf_blocks), the
+    uncompressed position in which the alignments start and a list with the
+    (start, end, number_of_reads) for every reference with reads. The bams not
+    sorted by coordinate raise a ValueError. The block offsets are read if
+    they are not given.
+    '''
+    if blocks is None:
+        fhand = open(fname, 'rb')
+        blocks = get_bgzf_blocks(fhand)
+        fhand.close()
+    alignments_start = read_bam_header(fname, blocks=blocks)[2]
+    spans = []
+    previous_end = alignments_start
+    for reference in read_bam_index(index_fname):
+        if reference is None:
+            continue
+        ref_begin, ref_end, n_mapped, n_unmapped = reference
+        start = virtual_offset_to_position(blocks, ref_begin)
+        end = virtual_offset_to_position(blocks, ref_end)
+        if start < previous_end:
+            raise ValueError('The bam is not sorted by coordinate: ' + fname)
+        previous_end = end
+        spans.append((start, end, n_mapped + n_unmapped))
+    return blocks, alignments_start, spans
 
+def write_bam_section(fname, out_fname, alignments_start, start, end,
+                      blocks=None):
+    '''It writes a bam with the header and the alignments from start to end of
+    the given bam'''
+    fhand = open(fname, 'rb')
+    if blocks is None:
+        blocks = get_bgzf_blocks(fhand)
+    out_fhand = open(out_fname, 'wb')
+    copy_bgzf_section(fhand, out_fhand, blocks, 0, alignments_start)
+    copy_bgzf_section(fhand, out_fhand, blocks, start, end)
+    out_fhand.write(BGZF_EOF)
+    out_fhand.close()
+    fhand.close()
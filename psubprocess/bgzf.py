@@ -0,0 +1,359 @@
+'''
+Utils to read gzip and BGZF compressed files.
+
+BGZF is the gzip variant used by the bam and tabix files. A BGZF file is a
+series of gzip members (blocks) with up to 64 KB of uncompressed data, every
+block has its compressed size in the BC extra subfield of its header. Every
+position in the uncompressed data can be reached by seeking to the beginning
+of its block, that is what a virtual offset is:
+compressed_block_offset << 16 | offset_inside_the_uncompressed_block
+
+Created on 17/10/2026
+
+@author: jose
+'''
+
+# Copyright 2009 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of psubprocess.
+# psubprocess is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# psubprocess is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with psubprocess. If not, see <http://www.gnu.org/licenses/>.
+
+import struct, zlib, gzip
+from array import array
+from bisect import bisect_right
+
+from psubprocess.utils import map_in_threads, copy_file_section
+
+GZIP_MAGIC = '\x1f\x8b'
+#ID1 ID2 CM FLG MTIME XFL OS XLEN
+_GZIP_HEADER = struct.Struct('<4BI2BH')
+_FEXTRA = 4
+#the header of a BGZF block, the only thing that changes is the block size
+_BGZF_HEADER = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+#an empty block marks the end of a BGZF file
+BGZF_EOF = _BGZF_HEADER + '\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+#the uncompressed data in every block, less than 64 KB to be sure that the
+#compressed block fits in 64 KB
+MAX_BLOCK_DATA = 65280
+
+def _read_block_header(fhand):
+    '''It reads a gzip member header and it returns the BGZF block size.
+
+    If the member is not a BGZF block it returns None, at the end of the file
+    it returns 0. The fhand is left after the header.
+    '''
+    header = fhand.read(_GZIP_HEADER.size)
+    if not header:
+        return 0
+    if len(header) < _GZIP_HEADER.size or header[:2] != GZIP_MAGIC:
+        return None
+    fields = _GZIP_HEADER.unpack(header)
+    flags, xlen = fields[3], fields[-1]
+    if not flags & _FEXTRA:
+        return None
+    extra = fhand.read(xlen)
+    #the extra field is a list of subfields: SI1 SI2 SLEN data
+    index = 0
+    while index + 4 <= len(extra):
+        subfield_id = extra[index:index + 2]
+        subfield_len = struct.unpack('<H', extra[index + 2:index + 4])[0]
+        if subfield_id == 'BC' and subfield_len == 2:
+            bsize = struct.unpack('<H', extra[index + 4:index + 6])[0]
+            return bsize + 1
+        index += 4 + subfield_len
+    return None
+
+def get_compression(fname):
+    'It returns None, gzip or bgzf for the given file'
+    fhand = open(fname, 'rb')
+    try:
+        if fhand.read(2) != GZIP_MAGIC:
+            return None
+        fhand.seek(0)
+        if _read_block_header(fhand):
+            return 'bgzf'
+        return 'gzip'
+    finally:
+        fhand.close()
+
+def get_bgzf_blocks(fhand):
+    '''It returns two arrays with the compressed and uncompressed offsets of the
+    blocks.
+
+    The blocks are not decompressed, only their headers and the uncompressed
+    sizes stored at their end are read. The total sizes are appended at the
+    end of both arrays.
+    '''
+    coffsets = array('L')
+    uoffsets = array('L')
+    coffset, uoffset = 0, 0
+    fhand.seek(0)
+    while True:
+        block_size = _read_block_header(fhand)
+        if not block_size:
+            if block_size is None:
+                raise ValueError('Not a BGZF block at byte %d' % coffset)
+            break
+        coffsets.append(coffset)
+        uoffsets.append(uoffset)
+        #ISIZE is the last field of the block
+        fhand.seek(coffset + block_size - 4)
+        uoffset += struct.unpack('<I', fhand.read(4))[0]
+        coffset += block_size
+        fhand.seek(coffset)
+    coffsets.append(coffset)
+    uoffsets.append(uoffset)
+    return coffsets, uoffsets
+
+def decompress_block(block):
+    'Given the bytes of a BGZF block it returns its uncompressed data'
+    xlen = struct.unpack('<H', block[10:12])[0]
+    return zlib.decompress(block[12 + xlen:-8], -15)
+
+def compress_block(data, level=6):
+    'It returns a BGZF block with the given data'
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    block_size = len(_BGZF_HEADER) + 2 + len(cdata) + 8
+    return ''.join((_BGZF_HEADER, struct.pack('<H', block_size - 1), cdata,
+                    struct.pack('<iI', zlib.crc32(data), len(data))))
+
+def virtual_offset_to_position(blocks, virtual_offset):
+    '''It returns the uncompressed position of a virtual offset.
+
+    blocks are the compressed and uncompressed block offsets returned by
+    get_bgzf_blocks.
+    '''
+    coffsets, uoffsets = blocks
+    coffset, uoffset = split_virtual_offset(virtual_offset)
+    block_index = bisect_right(coffsets, coffset) - 1
+    if block_index < 0 or coffsets[block_index] != coffset:
+        raise ValueError('No BGZF block at byte %d' % coffset)
+    return uoffsets[block_index] + uoffset
+
+def copy_bgzf_section(in_fhand, out_fhand, blocks, start, end, level=6):
+    '''It appends the uncompressed bytes from start to end as BGZF blocks.
+
+    blocks are the compressed and uncompressed block offsets of the in_fhand
+    returned by get_bgzf_blocks. The blocks included completely are copied as
+    they are, only the first and last blocks are compressed again if they are
+    partially included. The empty blocks, like the EOF, found at the end are
+    not copied.
+    '''
+    coffsets, uoffsets = blocks
+    nblocks = len(coffsets) - 1
+    index = max(0, bisect_right(uoffsets, start) - 1)
+    while index < nblocks and uoffsets[index] < end:
+        if uoffsets[index] >= start and uoffsets[index + 1] <= end:
+            #a run of whole blocks
+            first_block = index
+            while (index < nblocks and uoffsets[index] < end and
+                   uoffsets[index + 1] <= end):
+                index += 1
+            copy_file_section(in_fhand, out_fhand, coffsets[first_block],
+                              coffsets[index])
+            continue
+        in_fhand.seek(coffsets[index])
+        block = in_fhand.read(coffsets[index + 1] - coffsets[index])
+        data = decompress_block(block)
+        block_start = uoffsets[index]
+        data = data[max(start, block_start) - block_start:
+                    min(end, uoffsets[index + 1]) - block_start]
+        if data:
+            out_fhand.write(compress_block(data, level))
+        index += 1
+
+def make_virtual_offset(coffset, uoffset):
+    'It returns the virtual offset for a position inside a block'
+    return (coffset << 16) | uoffset
+
+def split_virtual_offset(virtual_offset):
+    'It returns the block offset and the offset inside the block'
+    return virtual_offset >> 16, virtual_offset & 0xFFFF
+
+class BgzfReader(object):
+    '''A read only file-like object with the uncompressed data of a BGZF file.
+
+    It can seek to any uncompressed position using the block table. The
+    blocks are decompressed in batches, by several threads if workers is
+    greater than one. The block table returned by get_bgzf_blocks can be
+    given to avoid reading it again.
+    '''
+    def __init__(self, fname, workers=1, blocks_per_batch=16, blocks=None):
+        'It inits the reader, it reads the block table if it is not given'
+        self.name = fname
+        self._fhand = open(fname, 'rb')
+        if blocks is None:
+            blocks = get_bgzf_blocks(self._fhand)
+        self._coffsets, self._uoffsets = blocks
+        self._workers = workers
+        self._blocks_per_batch = max(blocks_per_batch, workers)
+        self._buffer = ''
+        self._buffer_start = 0
+        self._next_block = 0
+        self._position = 0
+
+    def _get_size(self):
+        'It returns the uncompressed size'
+        return self._uoffsets[-1]
+    size = property(_get_size)
+
+    def get_virtual_offset(self, position):
+        'It returns the virtual offset for an uncompressed position'
+        block_index = bisect_right(self._uoffsets, position) - 1
+        block_index = min(block_index, len(self._coffsets) - 2)
+        return make_virtual_offset(self._coffsets[block_index],
+                                   position - self._uoffsets[block_index])
+
+    def seek(self, position):
+        'It goes to the given uncompressed position'
+        self._position = position
+        buffer_end = self._buffer_start + len(self._buffer)
+        if self._buffer_start <= position <= buffer_end:
+            return
+        block_index = bisect_right(self._uoffsets, position) - 1
+        block_index = max(0, min(block_index, len(self._coffsets) - 2))
+        self._buffer = ''
+        self._buffer_start = self._uoffsets[block_index]
+        self._next_block = block_index
+
+    def tell(self):
+        'It returns the uncompressed position'
+        return self._position
+
+    def _read_batch(self):
+        '''It adds the next blocks to the buffer.
+
+        It returns False if there are no more blocks.
+        '''
+        nblocks = len(self._coffsets) - 1
+        if self._next_block >= nblocks:
+            return False
+        last_block = min(self._next_block + self._blocks_per_batch, nblocks)
+        start = self._coffsets[self._next_block]
+        self._fhand.seek(start)
+        data = self._fhand.read(self._coffsets[last_block] - start)
+        blocks = []
+        for index in range(self._next_block, last_block):
+            block_start = self._coffsets[index] - start
+            block_end = self._coffsets[index + 1] - start
+            blocks.append(data[block_start:block_end])
+        blocks = map_in_threads(decompress_block, blocks, self._workers)
+        #we keep only what has not been read yet
+        consumed = min(self._position - self._buffer_start, len(self._buffer))
+        self._buffer = self._buffer[consumed:] + ''.join(blocks)
+        self._buffer_start += consumed
+        self._next_block = last_block
+        return True
+
+    def read(self, size=-1):
+        'It reads up to size uncompressed bytes'
+        if size < 0:
+            size = self.size - self._position
+        while self._buffer_start + len(self._buffer) < self._position + size:
+            if not self._read_batch():
+                break
+        start = self._position - self._buffer_start
+        data = self._buffer[start:start + size]
+        self._position += len(data)
+        return data
+
+    def readline(self):
+        'It reads the next line'
+        while True:
+            start = self._position - self._buffer_start
+            end = self._buffer.find('\n', start)
+            if end >= 0:
+                line = self._buffer[start:end + 1]
+                break
+            if not self._read_batch():
+                line = self._buffer[start:]
+                break
+        self._position += len(line)
+        return line
+
+    def __iter__(self):
+        'It yields the lines'
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+    def close(self):
+        'It closes the file'
+        self._fhand.close()
+
+class BgzfWriter(object):
+    '''A file-like object that writes BGZF compressed data.
+
+    The data is compressed in blocks, by several threads if workers is greater
+    than one. The EOF block is written when it is closed. A BGZF file is a
+    valid gzip file.
+    '''
+    def __init__(self, fhand, workers=1, level=6, blocks_per_batch=16):
+        'It inits the writer, the fhand should be open for writing'
+        self.name = fhand.name
+        self._fhand = fhand
+        self._workers = workers
+        self._level = level
+        self._batch_size = max(blocks_per_batch, workers) * MAX_BLOCK_DATA
+        self._buffer = []
+        self._buffer_size = 0
+
+    def _write_blocks(self, data):
+        'It compresses the data in blocks and it writes them'
+        datas = [data[start:start + MAX_BLOCK_DATA]
+                           for start in range(0, len(data), MAX_BLOCK_DATA)]
+        compress = lambda data: compress_block(data, self._level)
+        for block in map_in_threads(compress, datas, self._workers):
+            self._fhand.write(block)
+
+    def write(self, data):
+        'It writes the given data'
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= self._batch_size:
+            data = ''.join(self._buffer)
+            #the last incomplete block is kept for the next write
+            nfull = len(data) - len(data) % MAX_BLOCK_DATA
+            self._write_blocks(data[:nfull])
+            self._buffer = [data[nfull:]]
+            self._buffer_size = len(data) - nfull
+
+    def flush(self):
+        'It writes all the data, the last block might be a small one'
+        data = ''.join(self._buffer)
+        if data:
+            self._write_blocks(data)
+        self._buffer = []
+        self._buffer_size = 0
+        self._fhand.flush()
+
+    def close(self):
+        'It writes the pending data and the EOF block and it closes the file'
+        self.flush()
+        self._fhand.write(BGZF_EOF)
+        self._fhand.close()
+
+def open_compressed(fname, compression, workers=1, blocks=None):
+    '''It opens a compressed file and it returns a file-like object with the
+    uncompressed data.
+
+    The blocks of a BGZF file can be given (see BgzfReader).
+    '''
+    if compression == 'bgzf':
+        return BgzfReader(fname, workers=workers, blocks=blocks)
+    elif compression == 'gzip':
+        return gzip.GzipFile(fname, 'rb')
+    raise ValueError('Unknown compression: ' + str(compression))
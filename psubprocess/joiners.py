@@ -0,0 +1,439 @@
+'''
+Joiners that merge or reduce the output of the subjobs by a key instead of
+concatenating it.
+
+Created on 17/10/2026
+
+@author: jose
+'''
+
+# Copyright 2009 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of psubprocess.
+# psubprocess is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# psubprocess is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with psubprocess. If not, see <http://www.gnu.org/licenses/>.
+
+import heapq, os, itertools
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+#the bytes of lines sorted in memory at once by every sort
+SORT_BUFFER_SIZE = 64 * 1024 * 1024
+
+def _to_number(value):
+    'It converts a column to an int or to a float'
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+def _format_number(value):
+    'It writes a number, the floats with all their digits'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def _sort_value(value):
+    'The numeric columns are sorted as numbers'
+    try:
+        return _to_number(value)
+    except ValueError:
+        return value
+
+def get_line_key(key=None, separator='\t', numeric=False):
+    '''It returns a function that takes a line and returns its key.
+
+    key can be a function, a column index or a tuple with several column
+    indexes, the columns are compared as text unless numeric is True, then
+    the numeric columns are compared as numbers, like the positions. If no
+    key is given the whole line is the key. The lines without the key
+    columns raise a ValueError.
+    '''
+    if key is None:
+        return lambda line: line
+    if '__call__' in dir(key):
+        return key
+    single_column = isinstance(key, int)
+    columns = (key,) if single_column else tuple(key)
+    def line_key(line):
+        'It returns the columns of the line'
+        items = line.rstrip('\n').split(separator)
+        try:
+            values = [items[column] for column in columns]
+        except IndexError:
+            raise ValueError('The line has no key columns: ' + repr(line))
+        if numeric:
+            values = [_sort_value(value) for value in values]
+        return values[0] if single_column else tuple(values)
+    return line_key
+
+def _get_fname(file_):
+    'It returns the fname of an fname or an fhand'
+    return file_ if isinstance(file_, basestring) else file_.name
+
+def _read_header(fhand, header):
+    '''It reads the header lines found at the start of the fhand.
+
+    It returns the header lines and the first line after them.
+    '''
+    lines = []
+    line = fhand.readline()
+    while header is not None and line and line.startswith(header):
+        lines.append(line)
+        line = fhand.readline()
+    return lines, line
+
+def merge_sorted_lines(fhands, out_fhand, key, first_lines=None):
+    '''It writes the lines of the sorted fhands into the out_fhand, sorted.
+
+    It is a k-way merge, only one line of every fhand is kept in memory. The
+    lines with the same key are written in the order of the fhands.
+    first_lines can have the first line of every fhand if they have been
+    already read.
+    '''
+    if first_lines is None:
+        first_lines = [fhand.readline() for fhand in fhands]
+    heap = []
+    for index, line in enumerate(first_lines):
+        if line:
+            heap.append((key(line), index, line))
+    heapq.heapify(heap)
+    while heap:
+        index, line = heap[0][1:]
+        if not line.endswith('\n'):
+            line += '\n'
+        out_fhand.write(line)
+        line = fhands[index].readline()
+        if line:
+            heapq.heapreplace(heap, (key(line), index, line))
+        else:
+            heapq.heappop(heap)
+
+def create_merge_joiner(key=None, header=None, numeric=False):
+    '''It returns a joiner that merges the sorted outputs of the subjobs.
+
+    Every output should be sorted by the given key (see get_line_key), the
+    joined output will be sorted too. The outputs are read in one pass with
+    one line per output in memory. If a header prefix is given, like '@' for
+    the sam files, the lines that start with it at the beginning of the
+    outputs are the header. The header of the first output with one is
+    written, the rest are skipped.
+    '''
+    key = get_line_key(key, numeric=numeric)
+    def joiner(out_file, in_files):
+        'It merges the in_files into the out_file'
+        fhands = [open(_get_fname(in_file), 'rb') for in_file in in_files]
+        out_fhand = open(_get_fname(out_file), 'wb')
+        first_lines = []
+        header_written = False
+        for fhand in fhands:
+            header_lines, line = _read_header(fhand, header)
+            if header_lines and not header_written:
+                out_fhand.write(''.join(header_lines))
+                header_written = True
+            first_lines.append(line)
+        merge_sorted_lines(fhands, out_fhand, key, first_lines)
+        out_fhand.close()
+        for fhand in fhands:
+            fhand.close()
+    return joiner
+
+def _write_run(lines, key, fname):
+    'It sorts the lines by the key and it writes them into the fname'
+    lines.sort(key=key)
+    fhand = open(fname, 'wb')
+    fhand.writelines(lines)
+    fhand.close()
+    return fname
+
+def sort_part(part, key, header=None, buffer_size=SORT_BUFFER_SIZE):
+    '''It writes the lines of the part sorted by the key into a new file.
+
+    The new file is created next to the part, with a .sorted suffix, and its
+    fname is returned. The header lines are kept at the beginning. The lines
+    are sorted in runs of buffer_size bytes written next to the part and the
+    runs are merged (see merge_sorted_lines), so only one run is kept in
+    memory.
+    '''
+    sorted_fname = part + '.sorted'
+    runs = []
+    fhand = open(part, 'rb')
+    try:
+        header_lines, line = _read_header(fhand, header)
+        lines = fhand if not line else itertools.chain([line], fhand)
+        run_lines, run_size = [], 0
+        for line in lines:
+            if not line.endswith('\n'):
+                line += '\n'
+            run_lines.append(line)
+            run_size += len(line)
+            if run_size >= buffer_size:
+                runs.append(_write_run(run_lines, key,
+                                       '%s.run%d' % (part, len(runs))))
+                run_lines, run_size = [], 0
+        fhand.close()
+        if runs and run_lines:
+            runs.append(_write_run(run_lines, key,
+                                   '%s.run%d' % (part, len(runs))))
+            run_lines = []
+        else:
+            run_lines.sort(key=key)
+        out_fhand = open(sorted_fname, 'wb')
+        out_fhand.write(''.join(header_lines))
+        out_fhand.writelines(run_lines)
+        run_fhands = [open(run, 'rb') for run in runs]
+        merge_sorted_lines(run_fhands, out_fhand, key)
+        for run_fhand in run_fhands:
+            run_fhand.close()
+        out_fhand.close()
+    except Exception:
+        #no half sorted files are left behind
+        fhand.close()
+        if os.path.exists(sorted_fname):
+            os.remove(sorted_fname)
+        raise
+    finally:
+        for run in runs:
+            if os.path.exists(run):
+                os.remove(run)
+    return sorted_fname
+
+def _sort_part_process(connection, part, key, header, buffer_size):
+    'It sorts the part in a child process and it sends back the error, if any'
+    #the error is raised again by the parent process
+    #pylint: disable-msg=W0703
+    try:
+        sort_part(part, key, header, buffer_size)
+        error = None
+    except Exception, error:
+        pass
+    try:
+        connection.send(error)
+    except Exception:
+        #the error could not be pickled
+        connection.send(RuntimeError(str(error)))
+    connection.close()
+
+class SortingJoin(object):
+    '''It sorts the outputs of the subjobs as they finish and it merges them.
+
+    Every part is sorted by the key next to the part (see sort_part) while the
+    rest of the subjobs are still running. The parts are sorted by up to
+    workers child processes at the same time, one per cpu by default, so the
+    sorts do not compete for the interpreter. Once all the parts are added
+    the sorted parts are merged into the out_file in one pass (see
+    create_merge_joiner) and removed. The lines with the same key keep the
+    order of the parts.
+    '''
+    #pylint: disable-msg=R0913
+    def __init__(self, out_file, key=None, header=None, numeric=False,
+                 workers=None, buffer_size=SORT_BUFFER_SIZE):
+        'It inits the join, out_file can be an fname or an fhand'
+        self._out_file = out_file
+        self._key = get_line_key(key, numeric=numeric)
+        self._header = header
+        self._buffer_size = buffer_size
+        if workers is None:
+            workers = multiprocessing.cpu_count() if multiprocessing else 1
+        self._workers = workers
+        self._sorted_parts = {}
+        self._pending_parts = []
+        self._sorts = []
+        self._error = None
+
+    def _finish_sort(self, sort):
+        'It waits for the sort process and it keeps its error'
+        index, part, process, connection = sort
+        try:
+            error = connection.recv()
+        except EOFError:
+            error = RuntimeError('The part could not be sorted: ' + part)
+        connection.close()
+        process.join()
+        if error is not None and self._error is None:
+            self._error = error
+        self._sorted_parts[index] = part + '.sorted'
+
+    def _start_sorts(self, block=False):
+        '''It starts the sorts of the pending parts that fit with the running
+        ones.
+
+        If block is True it waits for the running sorts to make room.
+        '''
+        if multiprocessing is None:
+            for index, part in self._pending_parts:
+                self._sorted_parts[index] = sort_part(part, self._key,
+                                                      self._header,
+                                                      self._buffer_size)
+            self._pending_parts = []
+            return
+        while self._pending_parts:
+            for sort in self._sorts[:]:
+                if not sort[2].is_alive():
+                    self._sorts.remove(sort)
+                    self._finish_sort(sort)
+            if len(self._sorts) >= self._workers:
+                if not block:
+                    return
+                self._finish_sort(self._sorts.pop(0))
+            index, part = self._pending_parts.pop(0)
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_sort_part_process,
+                                              args=(sender, part, self._key,
+                                                    self._header,
+                                                    self._buffer_size))
+            process.daemon = True
+            process.start()
+            sender.close()
+            self._sorts.append((index, part, process, receiver))
+
+    def add_part(self, index, part):
+        'It adds the part of the subjob with the given index'
+        self._pending_parts.append((index, part))
+        self._start_sorts()
+
+    def close(self):
+        'It waits for the sorts, it merges the sorted parts and it removes them'
+        self._start_sorts(block=True)
+        while self._sorts:
+            self._finish_sort(self._sorts.pop(0))
+        sorted_parts = [self._sorted_parts[index]
+                                        for index in sorted(self._sorted_parts)]
+        try:
+            if self._error is not None:
+                raise self._error
+            joiner = create_merge_joiner(key=self._key, header=self._header)
+            joiner(self._out_file, sorted_parts)
+        finally:
+            for sorted_part in sorted_parts:
+                if os.path.exists(sorted_part):
+                    os.remove(sorted_part)
+
+def create_sort_joiner(key=None, header=None, numeric=False):
+    '''It returns a joiner that sorts the outputs of the subjobs by the key and
+    merges them (see SortingJoin)'''
+    def joiner(out_file, in_files):
+        'It sorts and merges the in_files into the out_file'
+        join = SortingJoin(out_file, key=key, header=header, numeric=numeric)
+        for index, in_file in enumerate(in_files):
+            join.add_part(index, _get_fname(in_file))
+        join.close()
+    return joiner
+
+#the reducers that can be used to join the tables
+REDUCERS = {'sum': lambda value1, value2: value1 + value2,
+            'min': min,
+            'max': max,
+            'histogram': lambda value1, value2: value1 + value2}
+
+def _get_columns(columns):
+    'It returns a tuple with the column indexes'
+    if columns is None:
+        return None
+    if isinstance(columns, int):
+        return (columns,)
+    return tuple(columns)
+
+class ReducingJoin(object):
+    '''It aggregates the tables written by the subjobs as they finish.
+
+    The lines of every table are grouped by the key columns (the first one by
+    default) and the numeric value columns of the lines with the same key are
+    reduced with the given reducer: sum, min, max or histogram. By default all
+    the columns that are not in the key are values, for the histograms the
+    last column is the count of the bin and the rest of the columns are
+    ignored. Only one line per key is kept in memory and written, sorted by
+    the key, the numeric keys are sorted as numbers. If a header prefix is
+    given the header of the first table with one is written.
+    '''
+    def __init__(self, out_file, reducer, key=None, columns=None, header=None,
+                 separator='\t'):
+        'It inits the join, out_file can be an fname or an fhand'
+        if reducer not in REDUCERS:
+            raise ValueError('Unknown reducer: ' + str(reducer))
+        if '__call__' in dir(key):
+            raise ValueError('The reducers need the key columns, not a function')
+        self._out_file = out_file
+        self._reduce = REDUCERS[reducer]
+        self._key = _get_columns(key) if key is not None else (0,)
+        self._columns = _get_columns(columns)
+        if self._columns is None and reducer == 'histogram':
+            self._columns = (-1,)
+        self._header = header
+        self._header_lines = None
+        self._separator = separator
+        self._table = {}
+
+    def _value_columns(self, items):
+        'It returns the indexes of the columns to reduce in this line'
+        if self._columns is not None:
+            return self._columns
+        key = [column % len(items) for column in self._key]
+        return [column for column in range(len(items)) if column not in key]
+
+    def add_part(self, index, part):
+        'It adds the table of the subjob with the given index'
+        fhand = open(part, 'rb')
+        header_lines, line = _read_header(fhand, self._header)
+        if header_lines and self._header_lines is None:
+            self._header_lines = header_lines
+        table = self._table
+        reduce_ = self._reduce
+        while line:
+            if not line.strip():
+                line = fhand.readline()
+                continue
+            items = line.rstrip('\n').split(self._separator)
+            try:
+                key = tuple([items[column] for column in self._key])
+                row = table.get(key)
+                if row is None:
+                    for column in self._value_columns(items):
+                        items[column] = _to_number(items[column])
+                    table[key] = items
+                else:
+                    for column in self._value_columns(items):
+                        row[column] = reduce_(row[column],
+                                              _to_number(items[column]))
+            except (IndexError, ValueError):
+                fhand.close()
+                msg = 'Wrong line for the %s table: %s' % (part, line)
+                raise ValueError(msg)
+            line = fhand.readline()
+        fhand.close()
+
+    def close(self):
+        'It writes the reduced table'
+        out_fhand = open(_get_fname(self._out_file), 'wb')
+        if self._header_lines:
+            out_fhand.write(''.join(self._header_lines))
+        sort_key = lambda key: tuple([_sort_value(value) for value in key])
+        for key in sorted(self._table, key=sort_key):
+            row = self._table[key]
+            out_fhand.write(self._separator.join([_format_number(item)
+                                                  for item in row]))
+            out_fhand.write('\n')
+        out_fhand.close()
+
+def create_reduce_joiner(reducer, key=None, columns=None, header=None):
+    '''It returns a joiner that aggregates the tables of the subjobs with the
+    given reducer (see ReducingJoin)'''
+    def joiner(out_file, in_files):
+        'It reduces the in_files into the out_file'
+        join = ReducingJoin(out_file, reducer, key=key, columns=columns,
+                            header=header)
+        for index, in_file in enumerate(in_files):
+            join.add_part(index, _get_fname(in_file))
+        join.close()
+    return joiner
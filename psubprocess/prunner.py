@@ -25,6 +25,40 @@ the subjobs will run in a condor cluster.
 splits is the number of subjobs that we want to generate. If it's not given the
 runner will provide a suitable number.
 
+chunk_size is optional. If it's given the input is cut into many chunks of
+chunk_size items (or bytes for the streams balanced by bytes) and splits is
+the number of subjobs that will run at the same time. Every time that a subjob
+finishes a new one is launched with the next chunk, so the uneven chunks do
+not leave the processors idle. The outputs are joined in the input order.
+
+The subjobs are checked without blocking with poll or the returncode. The
+subjobs are reaped as they finish, in any order, so a failed subjob is noticed
+while the rest are still running. Their outputs are joined in a thread, so
+poll does not wait for the joins. With sigchld the local subjobs are only
+checked after a SIGCHLD, so polling thousands of running subjobs is cheap. The
+SIGCHLD handler is set only from the main thread and if the signal had no
+other handler, and the previous one is restored once the runs have finished.
+
+max_parallel is optional. If it's given no more than max_parallel subjobs run
+at the same time, the rest of the splits wait and they are launched as the
+running ones finish. The returncode is None until all the splits have run.
+
+stdin can be PIPE or an iterator. In that case the input is read while the
+subjobs run, it is cut into chunks of whole items by the stdin splitter and
+every chunk is run by a new subjob, no more than splits at the same time.
+
+stdout and stderr can be PIPE. The output of the first subjob can be read as
+soon as it finishes, then the output of the second one and so on, so the
+output can be consumed while the last subjobs are still running.
+
+The output files joined by the default cat joiner are written while the
+subjobs finish. The output of every subjob is appended once the previous ones
+have been appended, or as soon as it finishes with the unordered_cat joiner.
+With the sort joiner the output of every subjob is sorted as soon as it
+finishes and the sorted outputs are merged once all have finished. With the
+reducer joiners the tables written by every subjob are aggregated by key as
+soon as it finishes.
+
 cmd_def is a dict that defines how the cmd defines the input and output files.
 We need to tell Popen which are the input and output files in order to split
 them and join them. The syntax for cmd_def is explained in the stream.py module
@@ -45,21 +79,282 @@ them and join them. The syntax for cmd_def is explained in the stream.py module
 # You should have received a copy of the GNU Affero General Public License
 # along with psubprocess. If not, see <http://www.gnu.org/licenses/>.
 
-from subprocess import Popen as StdPopen
-import os, copy
+from subprocess import Popen as StdPopen, PIPE
+import sys, os, copy, time, errno, signal, threading, stat, Queue
+from tempfile import NamedTemporaryFile
 
 from psubprocess.streams import get_streams_from_cmd, STDOUT, STDERR, STDIN
 from psubprocess.condor_runner import call
 from psubprocess import condor_runner
 from psubprocess.splitters import (get_splitter,
-                                   create_non_splitter_splitter)
-from psubprocess.utils import NamedTemporaryDir, copy_file_mode
+                                   create_non_splitter_splitter,
+                                   create_stream_chunker)
+from psubprocess.utils import (NamedTemporaryDir, copy_file_mode,
+                               copy_file_section, map_in_threads)
 from psubprocess.cmd_def_from_cmd import get_cmd_def_from_cmd
 from psubprocess.bam import bam_joiner
+from psubprocess.joiners import (create_merge_joiner, create_sort_joiner,
+                                 create_reduce_joiner, SortingJoin,
+                                 ReducingJoin, REDUCERS)
 
 RUNNER_MODULES = {}
 RUNNER_MODULES['condor_runner'] = condor_runner
 
+#seconds between the checks of the running subjobs while there are chunks to
+#launch
+POLL_INTERVAL = 0.05
+#seconds between the checks of all the running subjobs even if no SIGCHLD has
+#been received
+FULL_POLL_INTERVAL = 1.0
+
+#the runners that need to be launched from the job dir change the cwd of the
+#process
+_CHDIR_LOCK = threading.Lock()
+
+#the number of SIGCHLD received by the process since the handler was set, the
+#runs that need the handler and the handler that it replaced
+_SIGCHLD = {'count': 0, 'runs': 0, 'previous': None}
+#the subprocess.Popen, the exited jobs list of its run and the job index of
+#the local subjobs reaped with the SIGCHLD, by pid
+_SIGCHLD_JOBS = {}
+#the children are reaped and the new subjobs registered holding it
+_SIGCHLD_LOCK = threading.RLock()
+
+def _count_sigchld(signum, frame):
+    'It counts the SIGCHLD received'
+    #pylint: disable-msg=W0613
+    _SIGCHLD['count'] += 1
+
+def _is_main_thread():
+    'It returns True if it is called from the main thread'
+    #pylint: disable-msg=W0212
+    return isinstance(threading.currentThread(), threading._MainThread)
+
+def _set_sigchld_handler():
+    '''It sets a handler that counts the SIGCHLD signals for a new run.
+
+    It returns False if it can not be set, the handler is only set from the
+    main thread and when no one else handles the signal. The interrupted
+    system calls are restarted. The handler is kept until all the runs that
+    have set it have finished (see _unset_sigchld_handler).
+    '''
+    if 'SIGCHLD' not in dir(signal):
+        return False
+    _SIGCHLD_LOCK.acquire()
+    try:
+        if _SIGCHLD['previous'] is None:
+            if not _is_main_thread():
+                return False
+            previous = signal.getsignal(signal.SIGCHLD)
+            if previous != signal.SIG_DFL:
+                return False
+            signal.signal(signal.SIGCHLD, _count_sigchld)
+            signal.siginterrupt(signal.SIGCHLD, False)
+            _SIGCHLD['previous'] = previous
+        _SIGCHLD['runs'] += 1
+        return True
+    finally:
+        _SIGCHLD_LOCK.release()
+
+def _unset_sigchld_handler():
+    '''It restores the previous SIGCHLD handler when no run needs it.
+
+    The handler can only be restored from the main thread, otherwise it is
+    kept until a run that has set it finishes in the main thread.
+    '''
+    _SIGCHLD_LOCK.acquire()
+    try:
+        _SIGCHLD['runs'] -= 1
+        if _SIGCHLD['runs'] or not _is_main_thread():
+            return
+        signal.signal(signal.SIGCHLD, _SIGCHLD['previous'])
+        _SIGCHLD['previous'] = None
+    finally:
+        _SIGCHLD_LOCK.release()
+
+def _reap_children():
+    '''It reaps the registered subjobs that have exited.
+
+    Only the pids of the registered subjobs are waited for with
+    os.waitpid(pid, WNOHANG), the other children of the process are left to
+    their owners. The index of every exited subjob is appended to the exited
+    jobs of its run. It should be called holding the _SIGCHLD_LOCK.
+    '''
+    for pid, (popen, exited_jobs, job_index) in _SIGCHLD_JOBS.items():
+        #subprocess waits for the pid and it keeps its returncode
+        if popen.poll() is None:
+            continue
+        del _SIGCHLD_JOBS[pid]
+        exited_jobs.append(job_index)
+
+class _WorkDirs(object):
+    '''A list of work dirs that creates the new dirs when they are indexed.
+
+    The splitters with a chunk_size can create more splits than the initial
+    work dirs.
+    '''
+    def __init__(self, parent_dir, ndirs):
+        'It creates the first ndirs work dirs inside the parent_dir'
+        self._parent_dir = parent_dir
+        self._dirs = []
+        for index in range(ndirs):
+            self._create_dir()
+
+    def _create_dir(self):
+        'It adds a new work dir'
+        dir_ = NamedTemporaryDir(dir=self._parent_dir)
+        copy_file_mode('.', dir_.name)
+        self._dirs.append(dir_)
+
+    def __getitem__(self, index):
+        'It returns the work dir, it is created if required'
+        if isinstance(index, slice):
+            return self._dirs[index]
+        while index >= len(self._dirs):
+            self._create_dir()
+        return self._dirs[index]
+
+    def __len__(self):
+        'It returns the number of work dirs already created'
+        return len(self._dirs)
+
+    def __iter__(self):
+        'It iterates over the work dirs already created'
+        return iter(list(self._dirs))
+
+def _synchronized(method):
+    'It runs the method of the Popen holding its lock'
+    def locked(self, *args, **kwargs):
+        'It holds the lock while the method runs'
+        self._lock.acquire()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._lock.release()
+    locked.__name__ = method.__name__
+    locked.__doc__ = method.__doc__
+    return locked
+
+def _is_stream(stdin):
+    'It returns True if the stdin is PIPE or an iterator instead of a file'
+    if stdin is PIPE:
+        return True
+    return (stdin is not None and 'name' not in dir(stdin) and
+            '__iter__' in dir(stdin))
+
+class _StdinPipe(object):
+    '''The stdin of a Popen created with stdin=PIPE.
+
+    The data written is cut into chunks by the chunker and the complete
+    chunks are given to the add_chunks function. Once all the data is written
+    it should be closed.
+    '''
+    def __init__(self, chunker, add_chunks):
+        'It inits the pipe'
+        self._chunker = chunker
+        self._add_chunks = add_chunks
+        self.closed = False
+
+    def write(self, data):
+        'It writes some data, it can wait for a free subjob'
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        self._add_chunks(self._chunker.feed(data))
+
+    def writelines(self, lines):
+        'It writes the given lines'
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        'The data is already in the chunker'
+        pass
+
+    def close(self):
+        'It ends the input, the last chunk is given'
+        if self.closed:
+            return
+        self.closed = True
+        self._add_chunks(self._chunker.close())
+
+class _OutputPipe(object):
+    '''A file-like object that reads the outputs of the subjobs in order.
+
+    parts is an iterator that yields the output fname of every subjob once
+    the subjob has finished. The on_close function is called once all the
+    parts have been read or the pipe is closed.
+    '''
+    def __init__(self, parts, on_close=None):
+        'It inits the pipe'
+        self._parts = parts
+        self._on_close = on_close
+        self._fhand = None
+        self.closed = False
+
+    def _next_part(self):
+        'It opens the next part, it returns False if there are no more'
+        if self._fhand is not None:
+            self._fhand.close()
+            self._fhand = None
+        try:
+            fname = self._parts.next()
+        except StopIteration:
+            self.close()
+            return False
+        self._fhand = open(fname, 'rb')
+        return True
+
+    def read(self, size=-1):
+        'It reads up to size bytes, all the output by default'
+        chunks = []
+        remaining = size
+        while remaining and not self.closed:
+            if self._fhand is None and not self._next_part():
+                break
+            if size < 0:
+                data = self._fhand.read()
+            else:
+                data = self._fhand.read(remaining)
+                remaining -= len(data)
+            chunks.append(data)
+            #is this part finished?
+            if (not data or size < 0) and not self._next_part():
+                break
+        return ''.join(chunks)
+
+    def readline(self):
+        'It reads the next line, the parts are joined like with cat'
+        chunks = []
+        while not self.closed:
+            if self._fhand is None and not self._next_part():
+                break
+            line = self._fhand.readline()
+            chunks.append(line)
+            if line.endswith('\n'):
+                break
+            #the part has ended
+            if not self._next_part():
+                break
+        return ''.join(chunks)
+
+    def __iter__(self):
+        'It yields the lines'
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+    def close(self):
+        'It closes the pipe, the parts not read are lost'
+        if self.closed:
+            return
+        self.closed = True
+        if self._fhand is not None:
+            self._fhand.close()
+            self._fhand = None
+        if self._on_close is not None:
+            self._on_close()
 
 class Popen(object):
     '''It paralellizes the given processes dividing them into subprocesses.
@@ -68,16 +363,23 @@ class Popen(object):
     although the functionality of this class is much mor limited.
     When an instance of this class is created a series of subjobs is launched.
     When all subjobs are finished returncode will have an int, if they're still
-    running returncode will be None.
+    running returncode will be None, unless one of them has already failed.
+    poll checks them without blocking, the subjobs are reaped as they finish,
+    not in the split order.
     We can wait for all subjobs to finnish using the wait method or we can
     kill or terminate them using kill and terminate.
     '''
     def __init__(self, cmd, cmd_def=None, runner=None, runner_conf=None,
-                 stdout=None, stderr=None, stdin=None, splits=None):
+                 stdout=None, stderr=None, stdin=None, splits=None,
+                 split_workers=None, chunk_size=None, max_parallel=None,
+                 sigchld=False):
         '''It inits the a Popen instance, it creates and runs the subjobs.
 
-        Like the subprocess.Popen it accepts stdin, stdout, stderr, but in this
-        case all of them should be files, PIPE will not work.
+        Like the subprocess.Popen it accepts stdin, stdout, stderr. All of
+        them can be files or PIPE and stdin can also be an iterator. With PIPE
+        the data should be written into the stdin attribute and it should be
+        closed at the end, and the stdout and stderr attributes should be read
+        before calling wait. communicate does both things.
 
         In the cmd_def list we have to tell this Popen how to locate the
         input and output files in the cmd and how to split and join them. Look
@@ -88,15 +390,55 @@ class Popen(object):
         cmd_def -- the cmd definition list (default [])
         runner -- which runner to use  (default subprocess.Popen)
         runner_conf -- extra parameters for the runner (default {})
-        stdout -- a fhand to store the stdout (default None)
-        stderr -- a fhand to store the stderr (default None)
-        stdin -- a fhand with the stdin (default None)
-        splits -- number of subjobs to generate
+        stdout -- a fhand or PIPE to store the stdout (default None)
+        stderr -- a fhand or PIPE to store the stderr (default None)
+        stdin -- a fhand, PIPE or an iterator with the stdin (default None)
+        splits -- number of subjobs to generate (or to run at the same time
+                  with a stdin stream or a chunk_size)
+        split_workers -- number of split files to write at the same time
+                         (default 1)
+        chunk_size -- items (or bytes) in every chunk, if given the input is
+                      cut into chunks and splits is the number of subjobs
+                      running at the same time (default None, but the stdin
+                      streams use the splitters.STREAM_CHUNK_SIZES)
+        max_parallel -- maximum number of subjobs running at the same time,
+                        the next one is launched when one finishes (default
+                        None, all the splits at once, or splits with a stdin
+                        stream or a chunk_size)
+        sigchld -- reap the local subjobs when a SIGCHLD is received instead
+                   of polling every running one (default False). The handler
+                   is set from the main thread while the run is alive and
+                   only its subjobs are waited for after every SIGCHLD
         '''
         #we want the same interface as subprocess.popen
         #pylint: disable-msg=R0913
         self._retcode = None
         self._outputs_collected = False
+        self._killed = False
+        #the subjobs can be launched and reaped from several threads
+        self._lock = threading.RLock()
+        self.stdin = None
+        self._stdin_iter = None
+        self.stdout = None
+        self.stderr = None
+        self._pipes = {}
+        #the output streams joined while the subjobs finish
+        self._joins = {}
+        self._finished_jobs = set()
+        #the parts are joined in a thread, so polling does not block
+        self._join_queue = Queue.Queue()
+        self._join_thread = None
+        self._joins_finished = False
+        self._join_errors = []
+        #the subjobs reaped, in the order in which they finished
+        self._running_jobs = set()
+        self._reaped_jobs = []
+        self._job_retcodes = {}
+        self._failed_retcode = None
+        self._polled_jobs = 0
+        self._exited_jobs = []
+        self._sigchld_count = None
+        self._last_full_poll = 0
         #some defaults
         #if the runner is not given, we use subprocess.Popen
         if runner is None:
@@ -124,20 +466,292 @@ class Popen(object):
 
         #the main job
         self._job = {'cmd': cmd, 'work_dir': self._work_dir}
+        #the threads that feed the named pipes of the sequential input streams
+        #only the local subjobs can read from our named pipes
+        self._fifo_feeders = [] if runner is StdPopen else None
+        #the local subjobs can be reaped after a SIGCHLD
+        self._sigchld = (sigchld and runner is StdPopen and
+                         _set_sigchld_handler())
+        self._runner = runner
+        self._runner_conf = runner_conf
+        #the piped outputs are written in the subjob files like the other
+        #outputs, but they are not joined
+        if stdout is PIPE:
+            stdout = NamedTemporaryFile(dir=self._work_dir.name)
+            self._pipes[STDOUT] = None
+        if stderr is PIPE:
+            stderr = NamedTemporaryFile(dir=self._work_dir.name)
+            self._pipes[STDERR] = None
+        if _is_stream(stdin):
+            #the subjobs are created while the stdin is read
+            self._jobs = self._create_stream_jobs(cmd, cmd_def, stdout=stdout,
+                                                  stderr=stderr, stdin=stdin,
+                                                  chunk_size=chunk_size)
+            self._max_running = max_parallel or splits
+            if stdin is PIPE:
+                self.stdin = _StdinPipe(self._stdin_chunker,
+                                        self._add_stdin_chunks)
+            else:
+                self._stdin_iter = iter(stdin)
+            self._create_output_pipes()
+            self._create_incremental_joins()
+            self._schedule_jobs()
+            return
         #we create the new subjobs
         self._jobs = self._split_jobs(cmd, cmd_def, splits, self._work_dir,
-                                      stdout=stdout, stderr=stderr, stdin=stdin)
+                                      stdout=stdout, stderr=stderr, stdin=stdin,
+                                      fifo_feeders=self._fifo_feeders,
+                                      split_workers=split_workers,
+                                      chunk_size=chunk_size)
+
+        #with chunks only splits subjobs run at the same time
+        if max_parallel:
+            self._max_running = max_parallel
+        else:
+            self._max_running = splits if chunk_size else None
+        self._create_output_pipes()
+        self._create_incremental_joins()
+        #launch the subjobs
+        self._launch_pending_jobs()
+
+    def _create_output_pipes(self):
+        'It creates the stdout and stderr PIPEs'
+        for location in self._pipes:
+            for stream_index, stream in enumerate(self._job['streams']):
+                if ('cmd_location' in stream and
+                    stream['cmd_location'] == location):
+                    break
+            pipe = _OutputPipe(self._finished_parts(stream_index),
+                               on_close=self._remove_work_dirs)
+            self._pipes[location] = pipe
+        self.stdout = self._pipes.get(STDOUT, None)
+        self.stderr = self._pipes.get(STDERR, None)
+
+    def _create_incremental_joins(self):
+        'It prepares the joins of the outputs that can be joined incrementally'
+        for stream_index, stream in enumerate(self._job['streams']):
+            if stream['io'] != 'out':
+                continue
+            if ('cmd_location' in stream and
+                stream['cmd_location'] in self._pipes):
+                continue
+            order = _get_incremental_join_order(stream)
+            if order is None:
+                continue
+            out_file = stream['fname'] if 'fname' in stream else stream['fhand']
+            if order == 'sort':
+                join = SortingJoin(out_file, key=stream.get('key'),
+                                   header=stream.get('header'),
+                                   numeric=stream.get('numeric', False))
+            elif order == 'reduce':
+                join = ReducingJoin(out_file, stream['joiner'],
+                                    key=stream.get('key'),
+                                    columns=stream.get('columns'),
+                                    header=stream.get('header'))
+            else:
+                join = _IncrementalJoin(out_file, ordered=order == 'ordered')
+            self._joins[stream_index] = join
+
+    def _get_part(self, job_index, stream_index):
+        'It returns the fname of the output of the job for the stream'
+        stream = self._jobs['streams'][job_index][stream_index]
+        if 'fname' in stream:
+            return stream['fname']
+        return stream['fhand'].name
+
+    def _reap_exited_jobs(self):
+        '''It returns the indexes of the subjobs reaped after a SIGCHLD.
+
+        The children are only reaped after a SIGCHLD has been received, or
+        every FULL_POLL_INTERVAL seconds.
+        '''
+        now = time.time()
+        _SIGCHLD_LOCK.acquire()
+        try:
+            if (self._sigchld_count != _SIGCHLD['count'] or
+                now - self._last_full_poll >= FULL_POLL_INTERVAL):
+                #the SIGCHLD received while we reap will be seen in the next
+                #call
+                self._sigchld_count = _SIGCHLD['count']
+                self._last_full_poll = now
+                _reap_children()
+            exited_jobs = self._exited_jobs[:]
+            del self._exited_jobs[:]
+        finally:
+            _SIGCHLD_LOCK.release()
+        return exited_jobs
+
+    @_synchronized
+    def _reap_jobs(self):
+        '''It records the subjobs that have finished since the last call.
+
+        The subjobs are recorded in the order in which they finish. The runs
+        created with sigchld only look for the exited children after a
+        SIGCHLD, so checking many running subjobs costs nothing until one of
+        them exits, the rest poll every running subjob.
+        '''
+        popens = self._jobs.get('popens', [])
+        self._running_jobs.update(range(self._polled_jobs, len(popens)))
+        self._polled_jobs = len(popens)
+        if self._sigchld:
+            exited_jobs = self._reap_exited_jobs()
+        else:
+            exited_jobs = [job_index for job_index in sorted(self._running_jobs)
+                                        if popens[job_index].poll() is not None]
+        for job_index in exited_jobs:
+            retcode = popens[job_index].returncode
+            self._running_jobs.discard(job_index)
+            self._reaped_jobs.append(job_index)
+            self._job_retcodes[job_index] = retcode
+            if retcode != 0 and self._failed_retcode is None:
+                self._failed_retcode = retcode
+
+    @_synchronized
+    def _launch_pending_jobs(self):
+        'It launches the pending jobs that fit with the running ones'
+        self._reap_jobs()
+        if not self._sigchld:
+            self._launch_jobs(self._jobs, runner=self._runner,
+                              runner_conf=self._runner_conf,
+                              max_running=self._max_running,
+                              running=len(self._running_jobs))
+            return
+        #the subjobs are registered before they can be reaped
+        _SIGCHLD_LOCK.acquire()
+        try:
+            first_job = len(self._jobs.get('popens', []))
+            self._launch_jobs(self._jobs, runner=self._runner,
+                              runner_conf=self._runner_conf,
+                              max_running=self._max_running,
+                              running=len(self._running_jobs))
+            popens = self._jobs['popens']
+            for job_index in range(first_job, len(popens)):
+                _SIGCHLD_JOBS[popens[job_index].pid] = (popens[job_index],
+                                                        self._exited_jobs,
+                                                        job_index)
+        finally:
+            _SIGCHLD_LOCK.release()
+
+    @_synchronized
+    def _join_finished_jobs(self):
+        '''It hands the subjobs that have finished to the join thread.
+
+        It returns the number of subjobs that are still running.
+        '''
+        self._reap_jobs()
+        for job_index in self._reaped_jobs:
+            if job_index in self._finished_jobs:
+                continue
+            self._finished_jobs.add(job_index)
+            self._start_join_thread()
+            self._join_queue.put(job_index)
+        return len(self._running_jobs)
+
+    @_synchronized
+    def _finish_joins(self):
+        'It tells the join thread that all the subjobs have finished'
+        if self._joins_finished:
+            return
+        self._joins_finished = True
+        self._start_join_thread()
+        self._join_queue.put(None)
+
+    def _start_join_thread(self):
+        'It starts the join thread if it is not running'
+        if self._join_thread is not None:
+            return
+        self._join_thread = threading.Thread(target=self._join_outputs)
+        self._join_thread.setDaemon(True)
+        self._join_thread.start()
+
+    def _join_outputs(self):
+        '''It joins the outputs of the subjobs as they are handed to it.
+
+        The incremental joins get the parts of every finished subjob. Once all
+        the subjobs have finished all the output streams are collected and
+        the work dirs removed. It runs in the join thread, any error is raised
+        by poll or wait.
+        '''
+        try:
+            while True:
+                job_index = self._join_queue.get()
+                if job_index is None:
+                    break
+                #the output streams are independent
+                add_part = lambda (stream_index, join): join.add_part(
+                          job_index, self._get_part(job_index, stream_index))
+                map_in_threads(add_part, self._joins.items(), len(self._joins))
+            self._join_output_streams()
+        #we want to raise any error in the polling thread
+        #pylint: disable-msg=W0703
+        except Exception:
+            self._join_errors.append(sys.exc_info())
+            return
+        self._outputs_collected = True
+        #now we can delete the tempdirs
+        self._remove_work_dirs()
+
+    def _raise_join_error(self):
+        'It raises the error of the join thread, if any'
+        if self._join_errors:
+            error = self._join_errors[0]
+            raise error[0], error[1], error[2]
 
-        #launch every subjobs
-        self._launch_jobs(self._jobs, runner=runner, runner_conf=runner_conf)
+    @_synchronized
+    def _get_finished_part(self, job_index, stream_index):
+        '''It returns the output fname of the subjob if it has finished.
+
+        It returns None while the subjob is running or waiting to be launched
+        and False if there is no such subjob.
+        '''
+        self._schedule_jobs()
+        self._reap_jobs()
+        if job_index < len(self._jobs['popens']):
+            if job_index in self._job_retcodes:
+                streams = self._jobs['streams'][job_index]
+                return streams[stream_index]['fhand'].name
+        elif not self._pending_jobs():
+            return False
+        return None
+
+    def _finished_parts(self, stream_index):
+        'It yields the output fnames of the subjobs in order as they finish'
+        job_index = 0
+        while True:
+            fname = self._get_finished_part(job_index, stream_index)
+            if fname is False:
+                #there are no more subjobs
+                return
+            if fname is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+            yield fname
+            job_index += 1
 
     @staticmethod
-    def _launch_jobs(jobs, runner, runner_conf):
-        'It launches all jobs and it adds its popen instance to them'
-        jobs['popens'] = []
-        cwd = os.getcwd()
-        for job_index, (cmd, streams, work_dir) in enumerate(zip(jobs['cmds'],
-                                          jobs['streams'], jobs['work_dirs'])):
+    def _launch_jobs(jobs, runner, runner_conf, max_running=None,
+                     running=None):
+        '''It launches the pending jobs and it adds its popen instance to them
+
+        If max_running is given only the jobs that fit with the running ones
+        are launched, the rest are left for a later call. The running jobs
+        are counted if the number is not given.
+        '''
+        if 'popens' not in jobs:
+            jobs['popens'] = []
+        first_job = len(jobs['popens'])
+        last_job = len(jobs['cmds'])
+        if max_running is not None and running is None:
+            running = len([popen for popen in jobs['popens']
+                                                    if popen.poll() is None])
+        if max_running is not None:
+            last_job = min(last_job, first_job + max_running - running)
+        if last_job <= first_job:
+            return
+        for job_index in range(first_job, last_job):
+            cmd = jobs['cmds'][job_index]
+            streams = jobs['streams'][job_index]
+            work_dir = jobs['work_dirs'][job_index]
             #the std stream can be present or not
             stdin, stdout, stderr = None, None, None
             if jobs['stdins']:
@@ -146,8 +760,6 @@ class Popen(object):
                 stdout = jobs['stdouts'][job_index]
             if jobs['stderrs']:
                 stderr = jobs['stderrs'][job_index]
-            #for every job we go to its dir to launch it
-            os.chdir(work_dir.name)
             #we have to be sure that stdin is open for read
             if stdin:
                 stdin = open(stdin.name)
@@ -158,17 +770,35 @@ class Popen(object):
                 stderr = open(stderr.name, 'w')
             #we launch the job
             if runner == StdPopen:
-                popen = runner(cmd, stdout=stdout, stderr=stderr, stdin=stdin)
+                #the subjobs should not inherit the write ends of the other
+                #subjobs named pipes, they would never get an EOF
+                #every job is run in its dir
+                popen = runner(cmd, stdout=stdout, stderr=stderr, stdin=stdin,
+                               close_fds=True, cwd=work_dir.name)
+                #the subjob has its own copies, we don't want to keep a named
+                #pipe open once the subjob is gone
+                for fhand in (stdin, stdout, stderr):
+                    if fhand:
+                        fhand.close()
             else:
-                popen = runner(cmd, cmd_def=streams, stdout=stdout,
-                               stderr=stderr, stdin=stdin,
-                               runner_conf=runner_conf)
+                #the other runners are launched from the job dir, the cwd is
+                #shared by all the threads
+                _CHDIR_LOCK.acquire()
+                cwd = os.getcwd()
+                try:
+                    os.chdir(work_dir.name)
+                    popen = runner(cmd, cmd_def=streams, stdout=stdout,
+                                   stderr=stderr, stdin=stdin,
+                                   runner_conf=runner_conf)
+                finally:
+                    os.chdir(cwd)
+                    _CHDIR_LOCK.release()
             #we record it's popen instane
             jobs['popens'].append(popen)
-        os.chdir(cwd)
 
     def _split_jobs(self, cmd, cmd_def, splits, work_dir, stdout=None,
-                    stderr=None, stdin=None,):
+                    stderr=None, stdin=None, fifo_feeders=None,
+                    split_workers=None, chunk_size=None):
         ''''I creates one job for every split.
 
         Every job has a cmd, work_dir and streams, this info is in the jobs dict
@@ -183,7 +813,10 @@ class Popen(object):
         self._job['streams'] = main_job_streams
 
         streams, work_dirs = self._split_streams(main_job_streams, splits,
-                                                 work_dir.name)
+                                                 work_dir.name,
+                                                 fifo_feeders=fifo_feeders,
+                                                 split_workers=split_workers,
+                                                 chunk_size=chunk_size)
 
         #now we have to create a new cmd with the right in and out streams for
         #every split
@@ -193,6 +826,89 @@ class Popen(object):
                 'stdins':stdins, 'stdouts':stdouts, 'stderrs':stderrs}
         return jobs
 
+    def _create_stream_jobs(self, cmd, cmd_def, stdout=None, stderr=None,
+                            stdin=None, chunk_size=None):
+        '''It prepares the jobs for a stdin stream, the jobs are added later.
+
+        The input streams with files other than stdin can not be split because
+        the number of chunks is not known, so they should be no_split.
+        '''
+        #pylint: disable-msg=R0913
+        main_job_streams = get_streams_from_cmd(cmd, cmd_def, stdout=stdout,
+                                                stderr=stderr, stdin=stdin)
+        self._job['streams'] = main_job_streams
+        for index, stream in enumerate(main_job_streams):
+            if stream['io'] != 'in':
+                continue
+            if 'cmd_location' in stream and stream['cmd_location'] == STDIN:
+                self._stdin_index = index
+            elif (('fhand' in stream and stream['fhand'] is not None) or
+                  ('fname' in stream and stream['fname'] is not None)):
+                if ('special' not in stream or
+                    'no_split' not in stream['special']):
+                    msg = 'With a stdin stream the other input streams should'
+                    msg += ' be no_split: ' + str(stream)
+                    raise ValueError(msg)
+        stdin_stream = main_job_streams[self._stdin_index]
+        if 'splitter' not in stdin_stream:
+            msg = 'An splitter should be provided for every input stream'
+            msg += 'missing for: ' + str(stdin_stream)
+            raise ValueError(msg)
+        balance = (stdin_stream['balance'] if 'balance' in stdin_stream
+                                                                else 'items')
+        self._stdin_chunker = create_stream_chunker(stdin_stream['splitter'],
+                                                    chunk_size=chunk_size,
+                                                    balance=balance)
+        return {'cmds': [], 'work_dirs': [], 'streams': [], 'stdins': [],
+                'stdouts': [], 'stderrs': [], 'popens': []}
+
+    @_synchronized
+    def _add_chunk_job(self, chunk):
+        'It creates a new job for the given stdin chunk'
+        streams = [stream.copy() for stream in self._job['streams']]
+        #the stdin is not split, it is the chunk
+        streams[self._stdin_index]['fhand'] = None
+        streamss, work_dirs = self._split_streams(streams, 1,
+                                                  self._work_dir.name)
+        chunk_fhand = NamedTemporaryFile(dir=work_dirs[0].name, delete=False)
+        chunk_fhand.write(chunk)
+        chunk_fhand.close()
+        streamss[0][self._stdin_index]['fhand'] = chunk_fhand
+        cmds, stdins, stdouts, stderrs = self._create_cmds(self._job['cmd'],
+                                                           streamss)
+        for key, values in (('cmds', cmds), ('work_dirs', work_dirs),
+                            ('streams', streamss), ('stdins', stdins),
+                            ('stdouts', stdouts), ('stderrs', stderrs)):
+            self._jobs[key].extend(values)
+
+    def _add_stdin_chunks(self, chunks):
+        '''It creates the jobs for the chunks written in the stdin PIPE.
+
+        It waits until they are launched, so the chunks in flight are not
+        more than the subjobs.
+        '''
+        if self._killed:
+            return
+        for chunk in chunks:
+            self._add_chunk_job(chunk)
+        while len(self._jobs['popens']) < len(self._jobs['cmds']):
+            self._launch_pending_jobs()
+            if len(self._jobs['popens']) < len(self._jobs['cmds']):
+                time.sleep(POLL_INTERVAL)
+
+    @_synchronized
+    def _read_stdin_chunks(self):
+        'It reads the stdin iterator until there is a chunk to launch'
+        while (self._stdin_iter is not None and
+               len(self._jobs['popens']) == len(self._jobs['cmds'])):
+            try:
+                chunks = self._stdin_chunker.feed(self._stdin_iter.next())
+            except StopIteration:
+                self._stdin_iter = None
+                chunks = self._stdin_chunker.close()
+            for chunk in chunks:
+                self._add_chunk_job(chunk)
+
     @staticmethod
     def _create_cmds(cmd, streams):
         '''Given a base cmd and a steams list it creates one modified cmds for
@@ -231,9 +947,17 @@ class Popen(object):
         return cmds, stdins, stdouts, stderrs
 
     @staticmethod
-    def _split_streams(streams, splits, work_dir):
+    def _split_streams(streams, splits, work_dir, fifo_feeders=None,
+                       split_workers=None, chunk_size=None):
         '''Given a list of streams it splits every stream in the given number of
-        splits'''
+        splits
+
+        If a fifo_feeders list is given the streams declared as sequential will
+        be split into named pipes and their feeders appended to the list.
+        split_workers is the number of split files written at the same time.
+        If a chunk_size is given the streams are cut into chunks of that size
+        and the number of splits will be the number of chunks.
+        '''
         #which are the input and output streams?
         input_stream_indexes = []
         output_stream_indexes = []
@@ -243,12 +967,8 @@ class Popen(object):
             elif stream['io'] == 'out':
                 output_stream_indexes.append(index)
 
-        #we create one work dir for every split
-        work_dirs = []
-        for index in range(splits):
-            dir_ = NamedTemporaryDir(dir=work_dir)
-            work_dirs.append(dir_)
-            copy_file_mode('.', dir_.name)
+        #we create one work dir for every split, the chunks can ask for more
+        work_dirs = _WorkDirs(work_dir, splits)
 
         #we have to do first the input files because the number of splits could
         #be changed by them
@@ -280,6 +1000,8 @@ class Popen(object):
 
         first = True
         split_files = {}
+        #the streams in the same split_group share their split boundaries
+        split_plans = {}
         for index in input_stream_indexes:
             stream = streams[index]
             #splitter
@@ -296,7 +1018,31 @@ class Popen(object):
             #split the given file, otherwise should be a registered type of
             #splitter or a regular expression
             if '__call__' not in dir(splitter):
-                splitter = get_splitter(splitter)
+                balance = stream['balance'] if 'balance' in stream else 'items'
+                if 'special' in stream and 'sequential' in stream['special']:
+                    stream_feeders = fifo_feeders
+                else:
+                    stream_feeders = None
+                index_cache = ('special' in stream and
+                               'index_cache' in stream['special'])
+                compress_splits = ('special' in stream and
+                                   'compress_splits' in stream['special'])
+                if 'split_group' in stream:
+                    group = stream['split_group']
+                    if group not in split_plans:
+                        split_plans[group] = {}
+                    split_plan = split_plans[group]
+                else:
+                    split_plan = None
+                splitter = get_splitter(splitter, balance=balance,
+                                        fifo_feeders=stream_feeders,
+                                        index_cache=index_cache,
+                                        write_workers=split_workers or 1,
+                                        split_plan=split_plan,
+                                        compress_splits=compress_splits,
+                                        chunk_size=chunk_size,
+                                        partition=stream.get('partition'),
+                                        header=stream.get('header'))
             #we split the input files in the splits, every file will be in one
             #of the given work_dirs
             #the stream can have fname or fhands
@@ -324,6 +1070,7 @@ class Popen(object):
                     raise RuntimeError(msg)
             first = False
             split_files[index] = files   #a list of files for every in stream
+        work_dirs = work_dirs[0:splits]
 
         #we split the ouptut stream files into several splits
         output_splitter = create_non_splitter_splitter(copy_files=False)
@@ -366,114 +1113,354 @@ class Popen(object):
             module = RUNNER_MODULES[module]
             return module.get_default_splits()
 
+    def _pending_jobs(self):
+        '''It returns the number of jobs not launched yet.
+
+        A stdin stream not read to the end counts as one more job.
+        '''
+        if self._killed:
+            return 0
+        pending = len(self._jobs['cmds']) - len(self._jobs['popens'])
+        if (self._stdin_iter is not None or
+            (self.stdin is not None and not self.stdin.closed)):
+            pending += 1
+        return pending
+
+    @_synchronized
+    def _schedule_jobs(self):
+        'It launches the pending chunks if some subjobs have finished'
+        if not self._pending_jobs():
+            return
+        while True:
+            nlaunched = len(self._jobs['popens'])
+            if self._stdin_iter is not None:
+                self._read_stdin_chunks()
+            self._launch_pending_jobs()
+            #we read more stdin while there are free subjobs
+            if (self._stdin_iter is None or
+                len(self._jobs['popens']) == nlaunched):
+                break
+
     def wait(self):
         'It waits for all the works to finnish'
+        #nothing else can be written in the stdin PIPE
+        if self.stdin is not None:
+            self.stdin.close()
+        #the pending chunks are launched and the outputs are joined while the
+        #subjobs finish
+        while True:
+            self._schedule_jobs()
+            running = self._join_finished_jobs()
+            if not running and not self._pending_jobs():
+                break
+            time.sleep(POLL_INTERVAL)
         #we wait till all jobs finish
         for job in self._jobs['popens']:
             job.wait()
+        self._stop_fifo_feeders()
         #now that all jobs have finished we join the results
         self._collect_output_streams()
         #we join now the retcodes
         self._collect_retcodes()
         return self._retcode
 
-    def _collect_output_streams(self):
-        '''It joins all the output streams into the output files and it removes
-        the work dirs'''
-        if self._outputs_collected:
+    def communicate(self, input=None):
+        '''It writes the input into the stdin PIPE, it reads the stdout and
+        stderr PIPEs and it waits for the subjobs to finish.
+
+        It returns a tuple with the stdout and stderr, None for the streams
+        that are not PIPEs.
+        '''
+        #we want the same interface as subprocess.popen
+        #pylint: disable-msg=W0622
+        if self.stdin is not None:
+            if input:
+                self.stdin.write(input)
+            self.stdin.close()
+        stdout, stderr = None, None
+        if self.stdout is not None:
+            stdout = self.stdout.read()
+        if self.stderr is not None:
+            stderr = self.stderr.read()
+        self.wait()
+        return stdout, stderr
+
+    def _stop_fifo_feeders(self):
+        '''It waits for the named pipe feeders to finish.
+
+        The feeders whose subjob has not read the pipe are unblocked.
+        '''
+        if not self._fifo_feeders:
             return
-        #for each file in the main job cmd
+        for feeder in self._fifo_feeders:
+            feeder.cancel()
+            feeder.join()
+
+    def _collect_output_streams(self):
+        '''It waits for the join thread to join all the output streams into
+        the output files and to remove the work dirs'''
+        self._finish_joins()
+        self._join_thread.join()
+        self._raise_join_error()
+
+    def _join_output_streams(self):
+        'It joins all the output streams into the output files'
+        #every output stream is joined in its own thread
+        joins = []
         for stream_index, stream in enumerate(self._job['streams']):
             if stream['io'] == 'in':
                 #now we're dealing only with output files
                 continue
-            #every subjob has a part to join for this output stream
-            part_out_fnames = []
-            for streams in self._jobs['streams']:
-                this_stream = streams[stream_index]
-                if 'fname' in this_stream:
-                    part_out_fnames.append(this_stream['fname'])
-                else:
-                    part_out_fnames.append(this_stream['fhand'])
-           
-            joiner = _get_joiner(stream)
+            if ('cmd_location' in stream and
+                stream['cmd_location'] in self._pipes):
+                #they are read from the PIPE
+                continue
+            joins.append((stream_index, stream))
+        map_in_threads(self._join_output_stream, joins, len(joins))
 
-            if 'fname' in stream:
-                out_file = stream['fname']
+    def _join_output_stream(self, (stream_index, stream)):
+        'It joins the outputs of all the launched subjobs for the given stream'
+        #the pending chunks of a killed run have no output
+        launched = len(self._jobs['popens'])
+        if stream_index in self._joins:
+            #the parts not joined yet are added
+            join = self._joins[stream_index]
+            for job_index in range(launched):
+                if job_index not in self._finished_jobs:
+                    join.add_part(job_index, self._get_part(job_index,
+                                                            stream_index))
+            join.close()
+            return
+        #every launched subjob has a part to join for this output stream
+        part_out_fnames = []
+        for streams in self._jobs['streams'][:launched]:
+            this_stream = streams[stream_index]
+            if 'fname' in this_stream:
+                part_out_fnames.append(this_stream['fname'])
             else:
-                out_file = stream['fhand']
-            joiner(out_file, part_out_fnames)
+                part_out_fnames.append(this_stream['fhand'])
 
-        #now we can delete the tempdirs
+        joiner = _get_joiner(stream)
+
+        if 'fname' in stream:
+            out_file = stream['fname']
+        else:
+            out_file = stream['fhand']
+        joiner(out_file, part_out_fnames)
+
+    @_synchronized
+    def _remove_work_dirs(self):
+        '''It removes the work dirs once the outputs are collected and the
+        PIPEs have been read'''
+        if not self._outputs_collected:
+            return
+        for pipe in self._pipes.values():
+            if pipe is not None and not pipe.closed:
+                return
         for work_dir in self._jobs['work_dirs']:
             work_dir.close()
 
-        self._outputs_collected = True
-
+    @_synchronized
     def _collect_retcodes(self):
-        'It gathers the retcodes from all processes'
-        retcode = None
-        for popen in self._jobs['popens']:
-            job_retcode = popen.returncode
-            if job_retcode is None:
-                #if some job is yet to be finished the main job is not finished
-                retcode = None
-                break
-            elif job_retcode != 0:
-                #if one job has finnished badly the main job is badly finished
-                retcode = job_retcode
-                break
-            #it should be 0 at this point
-            retcode = job_retcode
+        '''It gathers the retcodes from all processes.
 
-        #if the retcode is not None the jobs have finished and we have to
-        #collect the outputs
-        if retcode is not None:
-            self._collect_output_streams()
+        The retcode is the one of the first subjob that has failed, even if
+        the rest are still running, or 0 when all have finished and their
+        outputs have been collected. The join thread collects the outputs
+        once all have finished.
+        '''
+        self._raise_join_error()
+        finished = not self._pending_jobs() and not self._running_jobs
+        if finished:
+            self._finish_joins()
+        if finished and self._sigchld:
+            #the handler is not needed any more
+            self._sigchld = False
+            _unset_sigchld_handler()
+        if self._failed_retcode is not None:
+            retcode = self._failed_retcode
+        elif finished and self._outputs_collected:
+            retcode = 0
+        else:
+            retcode = None
         self._retcode = retcode
         return retcode
 
+    @_synchronized
+    def poll(self):
+        '''It checks if the subjobs have finished and it returns the returncode.
+
+        It does not block. The pending subjobs are launched and the finished
+        ones handed to the join thread. The returncode is None while the
+        subjobs are running or their outputs are being joined, unless one of
+        them has failed.
+        '''
+        if not self._outputs_collected:
+            self._schedule_jobs()
+            self._join_finished_jobs()
+        self._collect_retcodes()
+        return self._retcode
+
     def _get_returncode(self):
         'It returns the return code'
-        if self._retcode is None:
-            self._collect_retcodes()
-        return self._retcode
+        return self.poll()
     returncode = property(_get_returncode)
 
+    @_synchronized
     def kill(self):
         'It kills all jobs'
+        #the pending chunks will not be launched
+        self._killed = True
         if 'popens' not in self._jobs:
             return
-        for popen in self._jobs['popens']:
+        for job_index, popen in enumerate(self._jobs['popens']):
+            #the reaped subjobs can not be signaled
+            if job_index in self._job_retcodes or popen.returncode is not None:
+                continue
             #untill 2.6 subprocess.popen do not support kill
             if 'kill' in dir(popen):
                 popen.kill()
             else:
                 pid = popen.pid
                 call(['kill', '-9', str(pid)])
+        self._stop_fifo_feeders()
 
+    @_synchronized
     def terminate(self):
         'It kills all jobs'
+        self._killed = True
         if 'popens' not in self._jobs:
             return
-        for popen in self._jobs['popens']:
+        for job_index, popen in enumerate(self._jobs['popens']):
+            #the reaped subjobs can not be signaled
+            if job_index in self._job_retcodes or popen.returncode is not None:
+                continue
             #untill 2.6 subprocess.popen do not support terminate
             if 'terminate' in dir(popen):
                 popen.terminate()
             else:
                 pid = popen.pid
                 call(['kill', '-6', str(pid)])
+        self._stop_fifo_feeders()
+
+
+def _get_incremental_join_order(stream):
+    '''It returns ordered or unordered if the stream can be joined while the
+    subjobs finish, sort if its parts are sorted while the subjobs finish or
+    reduce if they are aggregated, otherwise it returns None'''
+    if 'joiner' not in stream or stream['joiner'] == 'cat':
+        return 'ordered'
+    elif stream['joiner'] == 'unordered_cat':
+        return 'unordered'
+    elif stream['joiner'] == 'sort':
+        return 'sort'
+    elif stream['joiner'] in REDUCERS:
+        return 'reduce'
+    return None
+
+def _append_part(out_fhand, part):
+    'It appends the part file to the out_fhand, the kernel copies the bytes'
+    in_fhand = open(part, 'rb')
+    size = os.fstat(in_fhand.fileno()).st_size
+    copy_file_section(in_fhand, out_fhand, 0, size)
+    in_fhand.close()
 
+def _rename_part(part, out_fname):
+    '''It moves the part to the out_fname, it returns False if it can not.
+
+    The part gets the mode of the out file that it replaces. Only a missing
+    out file or a regular one with no other links is replaced, the symlinks,
+    the named pipes and the hardlinked files have to be written in place.
+    '''
+    try:
+        try:
+            out_stat = os.lstat(out_fname)
+        except OSError, error:
+            if error.errno != errno.ENOENT:
+                raise
+            out_stat = None
+        if out_stat is not None:
+            if not stat.S_ISREG(out_stat.st_mode) or out_stat.st_nlink != 1:
+                return False
+            copy_file_mode(out_fname, part)
+        os.rename(part, out_fname)
+    except OSError, error:
+        #the work dir might be in a different filesystem
+        if error.errno in (errno.EXDEV, errno.EPERM, errno.EACCES):
+            return False
+        raise
+    return True
+
+class _IncrementalJoin(object):
+    '''It joins the parts of an output stream while the subjobs finish.
+
+    If ordered every part is appended once all the previous ones have been
+    appended, otherwise it is appended as soon as it is added.
+    If the out_file is the fname of a missing or plain file the first part is
+    renamed to become the output (see _rename_part), an fhand is always
+    written, the caller could be reading it.
+    '''
+    def __init__(self, out_file, ordered=True):
+        'It inits the join, out_file can be an fname or an fhand'
+        self._can_rename = isinstance(out_file, str)
+        if not self._can_rename:
+            out_file = out_file.name
+        self._out_fname = out_file
+        self._out_fhand = None
+        self._ordered = ordered
+        self._next_part = 0
+        self._finished_parts = {}
+
+    def _append(self, part):
+        'It appends the part to the output'
+        if self._out_fhand is None:
+            if self._can_rename and _rename_part(part, self._out_fname):
+                #not in append mode, the kernel can not copy into O_APPEND
+                #files
+                self._out_fhand = open(self._out_fname, 'r+b')
+                self._out_fhand.seek(0, os.SEEK_END)
+                return
+            self._out_fhand = open(self._out_fname, 'wb')
+        _append_part(self._out_fhand, part)
+
+    def add_part(self, index, part):
+        'It adds the part of the subjob with the given index'
+        if not self._ordered:
+            self._append(part)
+            return
+        self._finished_parts[index] = part
+        while self._next_part in self._finished_parts:
+            self._append(self._finished_parts.pop(self._next_part))
+            self._next_part += 1
+
+    def close(self):
+        'It closes the output, it is created even if there were no parts'
+        if self._out_fhand is None:
+            self._out_fhand = open(self._out_fname, 'wb')
+        self._out_fhand.close()
 
 def _get_joiner(stream):
     'It gets the joiner'
-    joiners = {'bam':bam_joiner}
+    joiners = {'bam':bam_joiner, 'cat':default_cat_joiner,
+               'unordered_cat':default_cat_joiner}
     if 'joiner' in stream:
         joiner = stream['joiner']
     else:
         joiner = default_cat_joiner
 
-    if '__call__' not in dir(joiner):
+    if joiner == 'merge':
+        joiner = create_merge_joiner(key=stream.get('key'),
+                                     header=stream.get('header'),
+                                     numeric=stream.get('numeric', False))
+    elif joiner == 'sort':
+        joiner = create_sort_joiner(key=stream.get('key'),
+                                    header=stream.get('header'),
+                                    numeric=stream.get('numeric', False))
+    elif joiner in REDUCERS:
+        joiner = create_reduce_joiner(joiner, key=stream.get('key'),
+                                      columns=stream.get('columns'),
+                                      header=stream.get('header'))
+    elif '__call__' not in dir(joiner):
         joiner = joiners[joiner]
 
     return joiner
@@ -481,7 +1468,8 @@ def _get_joiner(stream):
 def default_cat_joiner(out_file_, in_files_):
     '''It joins the given in files into the given out file.
 
-    It works with fnames or fhands.
+    It works with fnames or fhands. The files are appended as they are by the
+    kernel, when possible.
     '''
     #are we working with fhands or fnames?
     file_is_str = None
@@ -492,16 +1480,11 @@ def default_cat_joiner(out_file_, in_files_):
 
     #the output fhand
     if file_is_str:
-        out_fhand = open(out_file_, 'w')
+        out_fhand = open(out_file_, 'wb')
     else:
-        out_fhand = open(out_file_.name, 'w')
+        out_fhand = open(out_file_.name, 'wb')
     for in_file_ in in_files_:
-        #the input fhand
-        if file_is_str:
-            in_fhand = open(in_file_, 'r')
-        else:
-            in_fhand = open(in_file_.name, 'r')
-        for line in in_fhand:
-            out_fhand.write(line)
-        in_fhand.close()
+        if not file_is_str:
+            in_file_ = in_file_.name
+        _append_part(out_fhand, in_file_)
     out_fhand.close()
@@ -19,12 +19,21 @@ Created on 03/12/2009
 # You should have received a copy of the GNU Affero General Public License
 # along with psubprocess. If not, see <http://www.gnu.org/licenses/>.
 
-import re, os, shutil
+import re, os, shutil, threading, errno, mmap, math, zlib, stat
+from array import array
+from bisect import bisect_left
 from tempfile import NamedTemporaryFile
-from psubprocess.utils import copy_file_mode
-from psubprocess.bam import (bam2sam, sam2bam, get_bam_header,
-                             bam_unigene_counter, unigenes_in_bam)
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from psubprocess.utils import (copy_file_mode, copy_file_section,
+                               map_in_threads)
+from psubprocess.bam import (read_bam_header, bam_reference_offsets,
+                             find_bam_index, get_bam_reference_spans,
+                             write_bam_section)
+from psubprocess.bgzf import (get_compression, open_compressed, BgzfWriter,
+                              BgzfReader, get_bgzf_blocks)
 
 def _calculate_divisions(num_items, splits):
     '''It calculates how many items should be in every split to divide
@@ -47,95 +56,464 @@ def _calculate_divisions(num_items, splits):
     res = ((num_fragments1, num_items1), (num_fragments2, num_items2))
     return res
 
-def _items_in_file(fhand, expression):
-    '''Given an fhand and an expression it yields the items cutting where the
-    line matches the expression'''
-    sofar = fhand.readline()
-    for line in fhand:
-        if expression.search(line):
-            yield sofar
-            sofar = line
-        else:
-            sofar += line
+def _split_item_ranges(nitems, splits):
+    '''It returns a list with the (first_item, last_item + 1) for every split.
+
+    The items are distributed as _calculate_divisions says, if there are less
+    items than splits less ranges will be returned.
+    '''
+    if splits > nitems:
+        splits = nitems
+    ranges = []
+    if not splits:
+        return ranges
+    start = 0
+    for nsplits, split_nitems in _calculate_divisions(nitems, splits):
+        #pylint: disable-msg=W0612
+        for split_index in range(nsplits):
+            ranges.append((start, start + split_nitems))
+            start += split_nitems
+    return ranges
+
+#the extension of the item offset index files written next to the inputs
+INDEX_CACHE_EXTENSION = '.psidx'
+INDEX_CACHE_VERSION = '1'
+
+def _index_cache_key(fname, kind, expression):
+    '''It returns the key that identifies a valid index for this file.
+
+    It depends on the file path, size and modification time and on how the
+    items are defined.
+    '''
+    fstat = os.stat(fname)
+    if expression is not None and 'pattern' in dir(expression):
+        expression = (expression.pattern, expression.flags)
+    key = (os.path.abspath(fname), fstat.st_size, fstat.st_mtime, kind,
+           expression, array('L').itemsize)
+    return 'psidx\t%s\t%s\n' % (INDEX_CACHE_VERSION, repr(key))
+
+def _read_index_cache(fname, kind, expression, size=None):
+    '''It returns the item offsets from the index file of the given file.
+
+    If there is no index file or if it is stale or corrupt it returns None.
+    The number of offsets and the first one should be the ones written after
+    the key and the last offset should be the given size, by default the file
+    size. For the files with an unknown size, like the gzip ones, size can be
+    False.
+    '''
+    index_fname = fname + INDEX_CACHE_EXTENSION
+    try:
+        index_fhand = open(index_fname, 'rb')
+    except IOError:
+        return None
+    try:
+        if index_fhand.readline() != _index_cache_key(fname, kind, expression):
+            return None
+        noffsets, first_offset = map(int, index_fhand.readline().split('\t'))
+        offsets = array('L')
+        offsets.fromstring(index_fhand.read())
+    except (IOError, OSError, ValueError):
+        return None
+    finally:
+        index_fhand.close()
+    if size is None:
+        size = os.path.getsize(fname)
+    #the items can begin after some blank lines, but they end at the file size
+    if (len(offsets) != noffsets or not offsets or
+        offsets[0] != first_offset or
+        (size is not False and offsets[-1] != size)):
+        return None
+    return offsets
+
+def _write_index_cache(fname, kind, expression, offsets, key):
+    '''It writes the item offsets into the index file of the given file.
+
+    The key should be taken before indexing the file, if the file has changed
+    since then the index is not written. If the index can not be written,
+    e.g. because the dir is not writable, nothing is done.
+    '''
+    if key != _index_cache_key(fname, kind, expression):
+        return
+    index_fname = fname + INDEX_CACHE_EXTENSION
+    try:
+        #we write a temporary file and we rename it to be atomic
+        index_fhand = NamedTemporaryFile(dir=os.path.dirname(index_fname),
+                                         prefix='.psidx', delete=False)
+    except (IOError, OSError):
+        return
+    try:
+        index_fhand.write(key)
+        index_fhand.write('%d\t%d\n' % (len(offsets), offsets[0]))
+        index_fhand.write(offsets.tostring())
+        index_fhand.close()
+        os.rename(index_fhand.name, index_fname)
+    except (IOError, OSError):
+        if os.path.exists(index_fhand.name):
+            os.remove(index_fhand.name)
+
+def _split_weighted_ranges(cumulative, splits):
+    '''Given the cumulative weights of the items it returns a list with the
+    (first_item, last_item + 1) for every split.
+
+    cumulative[n] should be the weight of all the items before the item n, so
+    it has one element more than items. The splits are cut in the item
+    boundaries closest to an equal share of the total weight, but every split
+    will have at least one item. If there are less items than splits less
+    ranges will be returned.
+    '''
+    nitems = len(cumulative) - 1
+    if splits > nitems:
+        splits = nitems
+    ranges = []
+    if not splits:
+        return ranges
+    base = cumulative[0]
+    total = cumulative[-1] - base
+    start = 0
+    for split_index in range(1, splits):
+        target = base + total * split_index / float(splits)
+        end = bisect_left(cumulative, target, start + 1, nitems)
+        #which boundary is closer to the target, this one or the previous one?
+        if (end - 1 > start and
+            target - cumulative[end - 1] <= cumulative[end] - target):
+            end -= 1
+        #we have to leave at least one item for every remaining split
+        end = min(end, nitems - (splits - split_index))
+        ranges.append((start, end))
+        start = end
+    ranges.append((start, nitems))
+    return ranges
+
+def _get_item_weigher(balance):
+    '''It returns the function that weighs an item for the given balance.
+
+    balance can be 'items', 'bytes' or a function that takes an item and
+    returns its weight. For 'items' None is returned because the items do not
+    have to be weighed.
+    '''
+    if '__call__' in dir(balance):
+        return balance
+    elif balance == 'items':
+        return None
+    elif balance == 'bytes':
+        return len
     else:
-        #the last item
-        yield sofar
+        raise ValueError('Unknown split balance: ' + str(balance))
+
+def _re_item_offsets(fhand, expression):
+    '''It returns an array with the byte offsets in which every item starts.
 
-def _re_item_counter(fhand, expression):
-    'It counts how many times the expression is found in the file'
-    nitems = 0
+    An item starts in the first line and everytime a line matches the
+    expression. The file size is appended at the end, so the item n spans from
+    offsets[n] to offsets[n + 1].
+    '''
+    offsets = array('L')
+    offset = 0
     for line in fhand:
-        if expression.search(line):
-            nitems += 1
-    return nitems
-
-def _items_in_fastq(fhand, expression=None):
-    'It returns the fastq items'
-    for item in FastqGeneralIterator(fhand):
-        yield '@%s\n%s\n+\n%s\n' % (item)
-
-def _fastq_items_counter(fhand, expression=None):
-    nitems = 0
-    for item in FastqGeneralIterator(fhand):
-        nitems += 1
-    return nitems
-
-def _blank_line_items_counter(fhand, expression=None):
-    'It returns the number of items separated by blank line'
-    nitems = 0
+        if not offset or expression.search(line):
+            offsets.append(offset)
+        offset += len(line)
+    offsets.append(offset)
+    return offsets
+
+#the characters that make a regular expression something more than a literal
+_RE_SPECIAL_CHARS = '.^$*+?{}[]\\|()'
+
+def _parse_literal(expression):
+    '''If the expression is a literal str it returns the literal and if it is
+    anchored to the line start, otherwise it returns None.
+
+    '>' is a literal found anywhere in the line and '^>' a literal found at the
+    beginning of the line.
+    '''
+    if not isinstance(expression, str):
+        return None
+    anchored = expression.startswith('^')
+    literal = expression[1:] if anchored else expression
+    for char in literal:
+        if char in _RE_SPECIAL_CHARS:
+            return None
+    #an empty literal matches every line
+    if not literal:
+        anchored = True
+    return literal, anchored
+
+def _literal_starts_in_block(data, block_start, block_end, literal,
+                             anchored, line_start):
+    '''It returns the starts of the lines with the literal in the block.
+
+    line_start is where the line that includes the block_start begins. The
+    positions are returned in a numpy array.
+    '''
+    #pylint: disable-msg=R0913
+    size = len(data)
+    literal = numpy.frombuffer(literal, dtype=numpy.uint8)
+    block_newlines = numpy.flatnonzero(data[block_start:block_end] == 10)
+    block_newlines += block_start
+    if anchored:
+        #the lines that start in this block
+        starts = block_newlines + 1
+        starts = starts[starts < size]
+        if line_start == block_start:
+            starts = numpy.concatenate(([block_start], starts))
+        for index, byte in enumerate(literal):
+            starts = starts[starts + index < size]
+            starts = starts[data[starts + index] == byte]
+        return starts
+    #where is the literal found in this block?
+    nbytes = min(block_end, size - len(literal) + 1) - block_start
+    if nbytes <= 0:
+        return numpy.array([], dtype=numpy.int64)
+    found = numpy.ones(nbytes, dtype=bool)
+    for index, byte in enumerate(literal):
+        start = block_start + index
+        found &= data[start:start + nbytes] == byte
+    positions = numpy.flatnonzero(found) + block_start
+    #which are the lines for those positions?
+    #the lines begin at the line_start or after a newline
+    line_starts = numpy.concatenate(([line_start], block_newlines + 1))
+    line_indexes = numpy.searchsorted(line_starts, positions, side='right')
+    return numpy.unique(line_starts[line_indexes - 1])
+
+def _literal_item_offsets(fhand, expression, block_size=67108864):
+    '''It returns an array with the byte offsets in which every item starts.
+
+    It has the same result than _re_item_offsets, but the expression should be
+    a literal (see _parse_literal) and the file is memory mapped and scanned in
+    blocks with numpy.
+    '''
+    literal, anchored = _parse_literal(expression)
+    file_no = fhand.fileno()
+    size = os.fstat(file_no).st_size
+    offsets = array('L')
+    if not size:
+        offsets.append(0)
+        return offsets
+    offsets.append(0)
+    mapped = mmap.mmap(file_no, 0, access=mmap.ACCESS_READ)
+    try:
+        data = numpy.frombuffer(mapped, dtype=numpy.uint8)
+        line_start = 0
+        for block_start in range(0, size, block_size):
+            block_end = min(block_start + block_size, size)
+            starts = _literal_starts_in_block(data, block_start, block_end,
+                                              literal, anchored, line_start)
+            #the first line is always an item start, and a line that spans
+            #several blocks could be found in the previous one
+            starts = starts[starts > offsets[-1]]
+            offsets.fromstring(starts.astype(offsets.typecode).tostring())
+            newlines = numpy.flatnonzero(data[block_start:block_end] == 10)
+            if len(newlines):
+                line_start = block_start + int(newlines[-1]) + 1
+        del data
+    finally:
+        mapped.close()
+    offsets.append(size)
+    return offsets
+
+def _fastq_item_offsets(fhand, expression=None):
+    '''It returns an array with the byte offsets of the fastq records.
+
+    The records should have four lines: @title, sequence, +[title] and
+    qualities. They are checked, but not parsed, so the bytes of every record
+    are kept as they are. It raises a ValueError for a malformed file.
+    The file size is appended at the end of the array.
+    '''
+    offsets = array('L')
+    offset = 0
+    lines = iter(fhand)
+    for title in lines:
+        if not title.strip():
+            #only blank lines are allowed after the last record
+            offset += len(title)
+            for line in lines:
+                if line.strip():
+                    msg = 'Blank line in the fastq file at byte %d' % offset
+                    raise ValueError(msg)
+                offset += len(line)
+            break
+        seq, plus, qual = next(lines, ''), next(lines, ''), next(lines, '')
+        if not title.startswith('@'):
+            msg = 'Fastq record not starting with @ at byte %d' % offset
+            raise ValueError(msg)
+        if not plus.startswith('+'):
+            msg = 'Fastq record without a + line at byte %d' % offset
+            raise ValueError(msg)
+        plus_title = plus[1:].rstrip()
+        if plus_title and plus_title != title[1:].rstrip():
+            msg = 'Fastq record with different @ and + titles at byte %d'
+            raise ValueError(msg % offset)
+        if len(seq.rstrip('\r\n')) != len(qual.rstrip('\r\n')):
+            msg = 'Fastq record with different sequence and quality lengths'
+            msg += ' at byte %d' % offset
+            raise ValueError(msg)
+        offsets.append(offset)
+        offset += len(title) + len(seq) + len(plus) + len(qual)
+    offsets.append(offset)
+    return offsets
+
+def _blank_line_item_offsets(fhand, expression=None):
+    '''It returns an array with the byte offsets of the items separated by
+    blank lines.
+
+    Every item starts in the first non blank line after a blank line and it
+    includes the blank lines that follow it. The file size is appended at the
+    end.
+    '''
+    offsets = array('L')
+    offset = 0
     item_read = False
     for line in fhand:
-        line = line.rstrip()
-        if line:
-            item_read = True
-        elif item_read and not line:
+        if line.strip():
+            if not item_read:
+                offsets.append(offset)
+                item_read = True
+        else:
             item_read = False
-            nitems += 1
-    return nitems
+        offset += len(line)
+    offsets.append(offset)
+    return offsets
 
-def _items_in_blank_line(fhand, expression=None):
-    'It returns the items separated by blank lines'
-    buffer_ = ''
-    for line in fhand:
-        line = line.rstrip()
-        if line:
-            buffer_ += line + '\n'
-        elif buffer_ and not line:
-            yield buffer_ + '\n'
-            buffer_ = ''
-    if buffer_:
-        yield buffer_ + '\n'
-
-def _create_file_splitter(kind, expression=None):
+def _items_in_offsets(fhand, offsets):
+    'It yields the items found in the given offsets'
+    for index in range(len(offsets) - 1):
+        fhand.seek(offsets[index])
+        yield fhand.read(offsets[index + 1] - offsets[index])
+
+def _weigh_items(items, item_weigher):
+    'It returns an array with the cumulative weights of the given items'
+    cumulative = array('d', [0])
+    total = 0
+    for item in items:
+        total += item_weigher(item)
+        cumulative.append(total)
+    return cumulative
+
+class _FifoFeeder(object):
+    '''It writes a section of a file into a named pipe in a thread.
+
+    The thread will be blocked until a subjob opens the pipe for reading, so
+    the section is written while the subjob consumes it. It has a name
+    attribute with the path of the pipe, like the fhands returned by the
+    splitters.
+    '''
+    def __init__(self, fifo_path, fname, start, end):
+        'It creates the feeder, it does not start it'
+        self.name = fifo_path
+        self._fname = fname
+        self._section = start, end
+        self._thread = threading.Thread(target=self._feed)
+        self._thread.setDaemon(True)
+
+    def _feed(self):
+        'It writes the section into the pipe'
+        in_fhand = open(self._fname, 'rb')
+        try:
+            #unbuffered, nothing should be left to write if the pipe breaks
+            out_fhand = open(self.name, 'wb', 0)
+            start, end = self._section
+            copy_file_section(in_fhand, out_fhand, start, end)
+            out_fhand.close()
+        except (IOError, OSError), error:
+            #the subjob has closed the pipe before reading everything
+            if error.errno != errno.EPIPE:
+                raise
+        finally:
+            in_fhand.close()
+
+    def start(self):
+        'It starts to feed the pipe'
+        self._thread.start()
+
+    def is_alive(self):
+        'It returns True if the pipe is still being fed'
+        return self._thread.isAlive()
+
+    def cancel(self):
+        '''It unblocks the feeder if nobody has read the pipe.
+
+        The subjob might have died without opening the pipe, in that case
+        the feeder would be waiting forever.
+        '''
+        if not self.is_alive():
+            return
+        try:
+            fifo_fd = os.open(self.name, os.O_RDONLY | os.O_NONBLOCK)
+            os.close(fifo_fd)
+        except OSError:
+            pass
+
+    def join(self, timeout=None):
+        'It waits until the pipe is fed'
+        self._thread.join(timeout)
+
+def _create_fifo_feeder(work_dir, suffix, fname, start, end):
+    'It creates a named pipe in the work dir and it starts its feeder'
+    ofh = NamedTemporaryFile(dir=work_dir.name, delete=False, suffix=suffix)
+    fifo_path = ofh.name
+    ofh.close()
+    os.remove(fifo_path)
+    os.mkfifo(fifo_path)
+    #the feeder has to open the pipe for writing, even for read only inputs
+    os.chmod(fifo_path, os.stat(fname).st_mode | stat.S_IRUSR | stat.S_IWUSR)
+    feeder = _FifoFeeder(fifo_path, fname, start, end)
+    feeder.start()
+    return feeder
+
+def _create_file_splitter(kind, expression=None, balance='items',
+                          fifo_feeders=None, index_cache=False,
+                          write_workers=1, split_plan=None,
+                          compress_splits=False, chunk_size=None):
     '''Given an expression it creates a file splitter.
 
     The expression can be a regex or an str.
     The item in the file will be defined everytime a line matches the
     expression.
+    The file will be read only once to get the byte offsets of its items and
+    the splits will be copied from those offsets.
+    balance defines what should be equal in all splits. With 'items' (the
+    default) every split will have the same number of items, with 'bytes' the
+    splits will be cut in the item boundaries closest to equal sizes. It can
+    also be a function that takes an item and returns its weight.
+    If a list is given as fifo_feeders the splits will be named pipes fed in
+    threads from the input file while the subjobs read them, the feeders will
+    be appended to the list. The compressed inputs and splits are always
+    written to files.
+    If index_cache is True the item offsets will be stored in an index file
+    next to the input (input.fa.psidx) and later splits of the same unmodified
+    file will use them instead of scanning it.
+    write_workers is the number of split files that can be written at the
+    same time.
+    split_plan is a dict to share the split boundaries between several
+    splitters. The first splitter that uses it stores its boundaries and the
+    rest will put the same items in every split, so the split n of all the
+    files will have the same record indexes. All the files should have the
+    same number of items, otherwise a ValueError is raised.
+    If a chunk_size is given the number of splits will not be the number of
+    work_dirs, the file will be cut in chunks of chunk_size items, or of
+    chunk_size bytes or weight if the balance is not 'items'. The work_dirs
+    should be able to create the extra dirs when they are indexed.
+    The gzip and BGZF compressed inputs are split without decompressing them
+    to disk. The BGZF blocks are decompressed by write_workers threads and
+    every split is read from its own block, the gzip files are decompressed
+    while they are read, one split after the other. A gzip file can not be
+    read from an offset, so it is decompressed twice, once to find its items
+    and once to write the splits, and once more to weigh the items with a
+    balance function. The index_cache saves the first pass.
+    If compress_splits is True the splits will be written as BGZF files, with
+    a .gz suffix, for the commands that can read them. It does not apply to
+    the fifos.
     '''
-    item_counters = {'re': _re_item_counter,
-                     'fastq': _fastq_items_counter,
-                     'blank_line': _blank_line_items_counter,
-                     'bam':bam_unigene_counter}
-    item_splitters = {'re':_items_in_file,
-                      'fastq':_items_in_fastq,
-                      'blank_line': _items_in_blank_line,
-                      'bam':unigenes_in_bam}
-    preproces_funcs  = {'bam':bam2sam}
-    postproces_funcs = {'bam':sam2bam}
-
-    header_funcs = {'bam':get_bam_header}
-    footer_funcs = {}
-
-    item_counter  = item_counters[kind]
-    item_splitter = item_splitters[kind]
-
-    preprocesor  = preproces_funcs[kind] if kind in preproces_funcs else None
-    postprocesor = postproces_funcs[kind] if kind in postproces_funcs else None
-    header_extractor = header_funcs[kind] if kind in header_funcs else None
-    footer_extractor = footer_funcs[kind] if kind in footer_funcs else None
-
-    if expression is not None and isinstance(expression, str):
+    item_indexers = {'re': _re_item_offsets,
+                     'literal': _literal_item_offsets,
+                     'fastq': _fastq_item_offsets,
+                     'blank_line': _blank_line_item_offsets}
+    item_weigher = _get_item_weigher(balance)
+    item_indexer = item_indexers[kind]
+
+    #the literals are scanned as they are
+    if (kind != 'literal' and expression is not None and
+        isinstance(expression, str)):
         expression = re.compile(expression)
 
     def splitter(file_, work_dirs):
@@ -155,99 +533,135 @@ def _create_file_splitter(kind, expression=None):
         else:
             fname = file_.name
             file_is_str = False
-
-        # do we have header?
-        if header_extractor is not None:
-            header_fhand = NamedTemporaryFile()
-            fhand = open(fname)
-            header_extractor(fhand, header_fhand)
+        compression = get_compression(fname)
+        #the block table is read once for all the readers of the input
+        if compression == 'bgzf':
+            fhand = open(fname, 'rb')
+            blocks = get_bgzf_blocks(fhand)
             fhand.close()
         else:
-            header_fhand = None
+            blocks = None
 
-        # do we have footer?
-        if footer_extractor is not None:
-            footer_fhand = NamedTemporaryFile()
-            fhand = open(fname)
-            footer_extractor(fhand, header_fhand)
-            fhand.close()
-        else:
-            footer_fhand = None
-
-        # File preprocess
-        if preprocesor is not None:
-            suffix = os.path.splitext(fname)[-1]
-            preprocessed_fhand = NamedTemporaryFile(suffix=suffix)
-            fhand = open(fname)
-            preprocesor(fhand, preprocessed_fhand)
-            fhand.close()
-            fname = preprocessed_fhand.name
+        def open_input(workers=1):
+            'It returns an fhand with the uncompressed content of the input'
+            if compression is None:
+                return open(fname, 'rb')
+            return open_compressed(fname, compression, workers=workers,
+                                   blocks=blocks)
+        #the literal scan needs the bytes as they are in the file
+        indexer = item_indexer
+        index_expression = expression
+        if compression is not None and kind == 'literal':
+            indexer = _re_item_offsets
+            index_expression = re.compile(expression)
 
-
-        #how many splits do we want?
-        nsplits = len(work_dirs)
         #how many items are in the file? We assume that all files have the same
         #number of items
-
-        fhand = open(fname, 'r')
-        nitems = item_counter(fhand, expression)
+        fhand = open_input(workers=write_workers)
+        offsets = None
+        if index_cache:
+            if compression == 'bgzf':
+                size = fhand.size
+            elif compression == 'gzip':
+                size = False
+            else:
+                size = None
+            offsets = _read_index_cache(fname, kind, expression, size)
+        if offsets is None:
+            cache_key = _index_cache_key(fname, kind, expression)
+            #one pass to get where every item starts
+            offsets = indexer(fhand, index_expression)
+            if index_cache:
+                _write_index_cache(fname, kind, expression, offsets,
+                                   cache_key)
+        nitems = len(offsets) - 1
+        #the offsets are already the cumulative bytes
+        if item_weigher is len:
+            cumulative = offsets
+        elif item_weigher is not None:
+            fhand.seek(0)
+            cumulative = _weigh_items(_items_in_offsets(fhand, offsets),
+                                      item_weigher)
 
         #how many splits a we going to create? and how many items will be in
         #every split
         #if there are more items than splits we create as many splits as items
-        if nsplits > nitems:
-            nsplits = nitems
-        (nsplits1, nitems1), (nsplits2, nitems2) = _calculate_divisions(nitems,
-                                                                       nsplits)
-        #we have to create nsplits1 files with nitems1 in it and nsplits2 files
-        #with nitems2 items in it
-        new_files  = []
-        fhand = open(fname, 'r')
-        items = item_splitter(fhand, expression)
-        splits_made = 0
-        for nsplits, nitems in ((nsplits1, nitems1), (nsplits2, nitems2)):
-            #we have to create nsplits files with nitems in it
-            #we don't need the split_index for anything
-            #pylint: disable-msg=W0612
-            for split_index in range(nsplits):
-                suffix = os.path.splitext(fname)[-1]
-                work_dir = work_dirs[splits_made]
-                ofh = NamedTemporaryFile(dir=work_dir.name, delete=False,
-                                         suffix=suffix)
-                copy_file_mode(fhand.name, ofh.name)
-
-                # header
-                if header_fhand is not None:
-                    header_fhand.seek(0)
-                    ofh.write(header_fhand.read())
-
-                for item_index in range(nitems):
-                    ofh.write(items.next())
-                ofh.flush()
-
-                # footer
-                if footer_fhand is not None:
-                    footer_fhand.seek(0)
-                    ofh.write(footer_fhand.read())
-
-                #postprocess
-                if postprocesor is not None:
-                    newofh = NamedTemporaryFile(dir=work_dir.name, delete=False,
-                                                suffix=suffix)
-                    postprocesor(ofh, newofh)
-                    ofh_path = ofh.name
-                    ofh.close()
-                    os.remove(ofh_path)
-                    ofh = newofh
-
-                #we have to close the files otherwise we can run out of files
-                #in the os filesystem
-                if file_is_str:
-                    new_files.append(ofh.name)
-                else:
-                    new_files.append(ofh)
-                ofh.close()
-                splits_made += 1
+        #how many splits do we want?
+        if chunk_size:
+            total = nitems if item_weigher is None else cumulative[-1]
+            nsplits = max(1, int(math.ceil(total / float(chunk_size))))
+        else:
+            nsplits = len(work_dirs)
+        if split_plan:
+            #the boundaries have been set by other file
+            if split_plan['nitems'] != nitems:
+                msg = 'The files split together have different number of items'
+                msg += ': %d and %d' % (split_plan['nitems'], nitems)
+                raise ValueError(msg)
+            split_ranges = split_plan['ranges']
+        elif item_weigher is None:
+            split_ranges = _split_item_ranges(nitems, nsplits)
+        else:
+            split_ranges = _split_weighted_ranges(cumulative, nsplits)
+        if split_plan is not None and not split_plan:
+            split_plan['nitems'] = nitems
+            split_plan['ranges'] = split_ranges
+        if compression is not None:
+            #the splits are not compressed like the input, seqs.fq.gz -> .fq
+            suffix = os.path.splitext(os.path.splitext(fname)[0])[-1]
+        else:
+            suffix = os.path.splitext(fname)[-1]
+        if compress_splits:
+            suffix += '.gz'
+        if compression == 'gzip':
+            #the gzip file is read forward only once, by all the splits
+            fhand.seek(0)
+
+        def write_split(split):
+            'It writes the split file and it returns its fname or fhand'
+            split_index, (start, end) = split
+            work_dir = work_dirs[split_index]
+            ofh = NamedTemporaryFile(dir=work_dir.name, delete=False,
+                                     suffix=suffix)
+            copy_file_mode(fname, ofh.name)
+            if compress_splits:
+                ofh = BgzfWriter(ofh)
+
+            #every split has its own fhand to be written independently
+            if compression == 'gzip':
+                in_fhand = fhand
+            else:
+                in_fhand = open_input()
+            copy_file_section(in_fhand, ofh, offsets[start], offsets[end],
+                              kernel_copy=compression is None)
+            if in_fhand is not fhand:
+                in_fhand.close()
+
+            #we have to close the files otherwise we can run out of files
+            #in the os filesystem
+            ofh.close()
+            if file_is_str:
+                return ofh.name
+            else:
+                return ofh
+
+        splits = list(enumerate(split_ranges))
+        if (fifo_feeders is not None and compression is None and
+            not compress_splits):
+            new_files = []
+            for split_index, (start, end) in splits:
+                fifo = _create_fifo_feeder(work_dirs[split_index], suffix,
+                                           fname, offsets[start],
+                                           offsets[end])
+                fifo_feeders.append(fifo)
+                new_files.append(fifo.name if file_is_str else fifo)
+        elif compression != 'gzip':
+            #the splits are independent sections of the file
+            new_files = map_in_threads(write_split, splits, write_workers)
+        else:
+            #the gzip file is read forward, one split after the other
+            new_files = [write_split(split) for split in splits]
+        fhand.close()
 
         return new_files
     return splitter
@@ -256,20 +670,294 @@ fastq_splitter = _create_file_splitter(kind='fastq')
 
 blank_line_splitter = _create_file_splitter(kind='blank_line')
 
-bam_splitter = _create_file_splitter(kind='bam')
+def _create_bam_splitter(balance='items', fifo_feeders=None,
+                         index_cache=False, write_workers=1, split_plan=None,
+                         compress_splits=False, chunk_size=None):
+    '''It creates a bam splitter.
+
+    The items are the references, the alignments of every reference should be
+    together in the bam. The bams sorted by coordinate with an up to date bai
+    index are split using the index and the references are balanced by their
+    number of reads. The rest are read once to find where every reference
+    starts. The balance functions take the binary alignments of a reference.
+    Every split is copied from the compressed blocks of the bam by
+    write_workers threads, only the blocks cut by the split are compressed
+    again. The bams are not fed through fifos, nor compressed again, nor
+    cached in a psidx index.
+    '''
+    item_weigher = _get_item_weigher(balance)
+    use_index = '__call__' not in dir(balance) and split_plan is None
+
+    def indexed_references(fname, index_fname, blocks):
+        '''It returns the cumulative weights and the starts of the references
+        using the bai index.
+
+        It returns None if the bam is not sorted, the index is broken or it
+        has no reads per reference, like the indexes without pseudo-bins.
+        '''
+        try:
+            spans = get_bam_reference_spans(fname, index_fname,
+                                            blocks=blocks)[2]
+        except ValueError:
+            return None
+        if not spans:
+            return None
+        cumulative = array('d', [0])
+        for start, end, nreads in spans:
+            weight = end - start if balance == 'bytes' else nreads
+            cumulative.append(cumulative[-1] + weight)
+        starts = [span[0] for span in spans]
+        return cumulative, starts
+
+    def splitter(file_, work_dirs):
+        '''It splits the given bam into several bams.
+
+        It returns a list with the fpaths or fhands for the splitted files.
+        '''
+        file_is_str = isinstance(file_, str)
+        fname = file_ if file_is_str else file_.name
+        #the block table is read once for all the readers of the bam
+        fhand = open(fname, 'rb')
+        blocks = get_bgzf_blocks(fhand)
+        fhand.close()
+        alignments_start = read_bam_header(fname, blocks=blocks)[2]
+        alignments_end = blocks[1][-1]
 
-def create_file_splitter_with_re(expression):
+        index_fname = find_bam_index(fname) if use_index else None
+        indexed = None
+        if index_fname is not None:
+            indexed = indexed_references(fname, index_fname, blocks)
+        if indexed is not None:
+            cumulative, starts = indexed
+            nitems = len(starts)
+            weighted = True
+        else:
+            #one pass through the alignments to find the references
+            offsets = bam_reference_offsets(fname, blocks=blocks)
+            starts = list(offsets[:-1])
+            nitems = len(starts)
+            weighted = item_weigher is not None
+            if item_weigher is len:
+                cumulative = offsets
+            elif weighted:
+                reader = BgzfReader(fname, workers=write_workers,
+                                    blocks=blocks)
+                cumulative = _weigh_items(_items_in_offsets(reader, offsets),
+                                          item_weigher)
+                reader.close()
+
+        if chunk_size:
+            total = cumulative[-1] - cumulative[0] if weighted else nitems
+            nsplits = max(1, int(math.ceil(total / float(chunk_size))))
+        else:
+            nsplits = len(work_dirs)
+        if split_plan:
+            #the boundaries have been set by other file
+            if split_plan['nitems'] != nitems:
+                msg = 'The files split together have different number of items'
+                msg += ': %d and %d' % (split_plan['nitems'], nitems)
+                raise ValueError(msg)
+            split_ranges = split_plan['ranges']
+        elif weighted:
+            split_ranges = _split_weighted_ranges(cumulative, nsplits)
+        else:
+            split_ranges = _split_item_ranges(nitems, nsplits)
+        if split_plan is not None and not split_plan:
+            split_plan['nitems'] = nitems
+            split_plan['ranges'] = split_ranges
+
+        #the splits go from the first alignment of its first reference to the
+        #first alignment of the next split, the unplaced alignments at the end
+        #go to the last split
+        starts.append(alignments_end)
+        sections = []
+        for split_index, (first_ref, last_ref) in enumerate(split_ranges):
+            start = starts[first_ref] if split_index else alignments_start
+            sections.append((start, starts[last_ref]))
+        if not sections and alignments_start < alignments_end:
+            #only unplaced alignments
+            sections.append((alignments_start, alignments_end))
+
+        def write_split(split):
+            'It writes the split bam and it returns its fname or fhand'
+            split_index, (start, end) = split
+            ofh = NamedTemporaryFile(dir=work_dirs[split_index].name,
+                                     delete=False, suffix='.bam')
+            ofh.close()
+            write_bam_section(fname, ofh.name, alignments_start, start, end,
+                              blocks=blocks)
+            copy_file_mode(fname, ofh.name)
+            return ofh.name if file_is_str else ofh
+        return map_in_threads(write_split, list(enumerate(sections)),
+                              write_workers)
+    return splitter
+
+bam_splitter = _create_bam_splitter()
+
+def create_file_splitter_with_re(expression, balance='items',
+                                 fifo_feeders=None, index_cache=False,
+                                 write_workers=1, split_plan=None,
+                                 compress_splits=False, chunk_size=None):
     '''Given an expression it creates a file splitter.
 
     The expression can be a regex or an str.
     The item in the file will be defined everytime a line matches the
     expression.
+    If the expression is a literal, like '>' or '^@', and numpy is available
+    the item boundaries will be looked for with numpy instead of running the
+    regex in every line.
+    '''
+    if numpy is not None and _parse_literal(expression) is not None:
+        kind = 'literal'
+    else:
+        kind = 're'
+    return _create_file_splitter(kind=kind, expression=expression,
+                                 balance=balance, fifo_feeders=fifo_feeders,
+                                 index_cache=index_cache,
+                                 write_workers=write_workers,
+                                 split_plan=split_plan,
+                                 compress_splits=compress_splits,
+                                 chunk_size=chunk_size)
+
+def _get_partition_key(partition):
+    '''It returns a function that takes an item and returns its partition key.
+
+    partition can be a column index of the first line of the item, the
+    columns are tab separated, a regular expression, the first group or the
+    whole match is the key, or a function that takes the item.
     '''
-    return _create_file_splitter(kind='re', expression=expression)
+    if '__call__' in dir(partition):
+        return partition
+    if isinstance(partition, int):
+        def column_key(item):
+            'It returns the column of the first line of the item'
+            columns = item.split('\n', 1)[0].rstrip('\r').split('\t')
+            return columns[partition] if partition < len(columns) else ''
+        return column_key
+    if isinstance(partition, str):
+        partition = re.compile(partition)
+    def re_key(item):
+        'It returns the match of the expression in the item'
+        match = partition.search(item)
+        if match is None:
+            return ''
+        return match.group(1) if partition.groups else match.group()
+    return re_key
 
-def get_splitter(expression):
+def create_partition_splitter(expression, partition, header=None,
+                              compress_splits=False, buffer_size=1048576):
+    '''It creates a splitter that distributes the items by the hash of a key.
+
+    The items are defined by the expression like in the stream chunkers and
+    the key by the partition (see _get_partition_key). The items with the same
+    key go to the same split, the split is chosen by the crc32 of the key, so
+    the input does not have to be sorted and it is read once. There is one
+    split for every work_dir, some splits can be empty, and the files
+    partitioned by the same key into the same number of splits have the same
+    keys in the split n. If a header prefix is given, like '@' for the sam
+    files, the lines that start with it at the beginning of the input are
+    written in every split.
+    '''
+    #the chunker fails soon with the expressions not supported
+    create_stream_chunker(expression, chunk_size=1)
+    partition_key = _get_partition_key(partition)
+
+    def splitter(file_, work_dirs):
+        '''It splits the given file into one split per work_dir.
+
+        It returns a list with the fpaths or fhands for the splitted files.
+        '''
+        file_is_str = isinstance(file_, str)
+        fname = file_ if file_is_str else file_.name
+        compression = get_compression(fname)
+        if compression is None:
+            fhand = open(fname, 'rb')
+            suffix = os.path.splitext(fname)[-1]
+        else:
+            fhand = open_compressed(fname, compression)
+            suffix = os.path.splitext(os.path.splitext(fname)[0])[-1]
+        if compress_splits:
+            suffix += '.gz'
+        nsplits = len(work_dirs)
+        out_fhands = []
+        for split_index in range(nsplits):
+            ofh = NamedTemporaryFile(dir=work_dirs[split_index].name,
+                                     delete=False, suffix=suffix)
+            copy_file_mode(fname, ofh.name)
+            if compress_splits:
+                ofh = BgzfWriter(ofh)
+            out_fhands.append(ofh)
+
+        #the header goes to every split
+        line = fhand.readline()
+        while header is not None and line and line.startswith(header):
+            for ofh in out_fhands:
+                ofh.write(line)
+            line = fhand.readline()
+
+        #one item per chunk
+        chunker = create_stream_chunker(expression, chunk_size=1)
+        def write_items(items):
+            'It writes every item into the split of its key'
+            for item in items:
+                key = partition_key(item)
+                if not isinstance(key, str):
+                    key = str(key)
+                split_index = (zlib.crc32(key) & 0xffffffff) % nsplits
+                out_fhands[split_index].write(item)
+        write_items(chunker.feed(line))
+        while True:
+            data = fhand.read(buffer_size)
+            if not data:
+                break
+            write_items(chunker.feed(data))
+        write_items(chunker.close())
+        fhand.close()
+
+        new_files = []
+        for ofh in out_fhands:
+            ofh.close()
+            new_files.append(ofh.name if file_is_str else ofh)
+        return new_files
+    return splitter
+
+def get_splitter(expression, balance='items', fifo_feeders=None,
+                 index_cache=False, write_workers=1, split_plan=None,
+                 compress_splits=False, chunk_size=None, partition=None,
+                 header=None):
     '''If the expression is a known splitter kind it returns it, otherwise it
-    creates a regular expression based splitter'''
+    creates a regular expression based splitter
+
+    If a balance different than 'items', a fifo_feeders list, an index_cache,
+    several write_workers, a split_plan, compress_splits or a chunk_size are
+    given a new splitter will be created.
+    If a partition is given the items are distributed by the hash of their key
+    (see create_partition_splitter), the balance, the fifo_feeders, the
+    index_cache, the write_workers, the split_plan and the chunk_size do not
+    apply to it.
+    '''
+    if partition is not None:
+        return create_partition_splitter(expression, partition, header=header,
+                                         compress_splits=compress_splits)
+    default_options = (balance == 'items' and fifo_feeders is None and
+                       not index_cache and write_workers == 1 and
+                       split_plan is None and not compress_splits and
+                       chunk_size is None)
+    if expression == 'bam' and not default_options:
+        return _create_bam_splitter(balance=balance, fifo_feeders=fifo_feeders,
+                                    index_cache=index_cache,
+                                    write_workers=write_workers,
+                                    split_plan=split_plan,
+                                    compress_splits=compress_splits,
+                                    chunk_size=chunk_size)
+    if expression in ('fastq', 'blank_line') and not default_options:
+        return _create_file_splitter(kind=expression, balance=balance,
+                                     fifo_feeders=fifo_feeders,
+                                     index_cache=index_cache,
+                                     write_workers=write_workers,
+                                     split_plan=split_plan,
+                                     compress_splits=compress_splits,
+                                     chunk_size=chunk_size)
     if expression == 'fastq':
         return fastq_splitter
     elif expression == 'blank_line':
@@ -277,7 +965,13 @@ def get_splitter(expression):
     elif expression == 'bam':
         return bam_splitter
     else:
-        return create_file_splitter_with_re(expression)
+        return create_file_splitter_with_re(expression, balance=balance,
+                                            fifo_feeders=fifo_feeders,
+                                            index_cache=index_cache,
+                                            write_workers=write_workers,
+                                            split_plan=split_plan,
+                                            compress_splits=compress_splits,
+                                            chunk_size=chunk_size)
 
 def create_non_splitter_splitter(copy_files=False):
     '''It creates an splitter function that will not split the given file.
@@ -333,3 +1027,111 @@ def create_non_splitter_splitter(copy_files=False):
                 new_fpaths.append(ofh)
         return new_fpaths
     return splitter
+
+#the default chunk sizes for the streamed inputs, in items or bytes
+STREAM_CHUNK_SIZES = {'items': 10000, 'bytes': 16777216}
+
+class _StreamChunker(object):
+    '''It cuts a stream that arrives in pieces into chunks of whole items.
+
+    The pieces are given to feed, that returns the chunks completed by them.
+    The last chunk is returned by close. Only the chunk being filled is kept
+    in memory.
+    '''
+    def __init__(self, starts_item, chunk_size, item_weigher=None):
+        '''It inits the chunker.
+
+        starts_item is a function that takes a line, its index and the
+        previous line and tells if the line is the first one of an item.
+        '''
+        self._starts_item = starts_item
+        self._chunk_size = chunk_size
+        self._item_weigher = item_weigher
+        self._partial_line = ''
+        self._line_index = 0
+        self._previous_line = None
+        self._item = []
+        self._chunk = []
+        self._chunk_weight = 0
+
+    def _end_chunk(self, chunks):
+        'It adds the current chunk to the chunks'
+        chunks.append(''.join(self._chunk))
+        self._chunk = []
+        self._chunk_weight = 0
+
+    def _end_item(self, chunks):
+        'It adds the current item to the chunk, the chunk can be completed'
+        item = ''.join(self._item)
+        self._item = []
+        self._chunk.append(item)
+        if self._item_weigher is None:
+            self._chunk_weight += 1
+        else:
+            self._chunk_weight += self._item_weigher(item)
+        if self._chunk_weight >= self._chunk_size:
+            self._end_chunk(chunks)
+
+    def _add_line(self, line, chunks):
+        'It adds a line to the current item or it starts a new one'
+        if self._item and self._starts_item(line, self._line_index,
+                                            self._previous_line):
+            self._end_item(chunks)
+        self._item.append(line)
+        self._line_index += 1
+        self._previous_line = line
+
+    def feed(self, data):
+        'It adds the data to the stream and it returns the complete chunks'
+        chunks = []
+        lines = (self._partial_line + data).split('\n')
+        self._partial_line = lines.pop()
+        for line in lines:
+            self._add_line(line + '\n', chunks)
+        return chunks
+
+    def close(self):
+        'It ends the stream and it returns the last chunks'
+        chunks = []
+        if self._partial_line:
+            self._add_line(self._partial_line, chunks)
+            self._partial_line = ''
+        if self._item:
+            self._end_item(chunks)
+        if self._chunk:
+            self._end_chunk(chunks)
+        return chunks
+
+def _fastq_starts_item(line, line_index, previous_line):
+    'Every fastq record has four lines'
+    return not line_index % 4 and line.strip()
+
+def _blank_line_starts_item(line, line_index, previous_line):
+    'The items start after a blank line'
+    return line.strip() and not previous_line.strip()
+
+def create_stream_chunker(expression, chunk_size=None, balance='items'):
+    '''It returns a chunker that cuts a stream in chunks of whole items.
+
+    The items are defined by the expression like in the file splitters, but
+    bam and functions are not supported. The chunks will have chunk_size items
+    or bytes or weight depending on the balance, the STREAM_CHUNK_SIZES are
+    used by default.
+    '''
+    item_weigher = _get_item_weigher(balance)
+    if chunk_size is None:
+        chunk_size = STREAM_CHUNK_SIZES['bytes' if balance == 'bytes' else
+                                        'items']
+    if expression == 'fastq':
+        starts_item = _fastq_starts_item
+    elif expression == 'blank_line':
+        starts_item = _blank_line_starts_item
+    elif expression == 'bam' or '__call__' in dir(expression):
+        raise ValueError('This splitter can not split a stream: ' +
+                         str(expression))
+    else:
+        if isinstance(expression, str):
+            expression = re.compile(expression)
+        starts_item = lambda line, line_index, previous_line: (not line_index
+                                                    or expression.search(line))
+    return _StreamChunker(starts_item, chunk_size, item_weigher=item_weigher)
@@ -41,9 +41,62 @@ definint it:
        - a re      every line with a match will be considered a token start
        - a function    the function should take the stream an return an
                        iterator with the tokens
+The gzip and BGZF inputs are split without decompressing them to disk, the
+splits are written uncompressed unless the stream is compress_splits.
+The bams sorted by coordinate with an up to date bai index are split by
+reference using the index, copying their compressed blocks.
+
+balance: It defines how the items should be distributed between the splits.
+       - items     every split will have the same number of items (default)
+       - bytes     every split will have a similar size in bytes
+       - a function    it should take an item and return its weight
+
+partition: If given the items are distributed between the splits by the hash
+of their key, so all the items with the same key are in the same split without
+sorting the input. It can be the index of a tab separated column of the first
+line of the item, a regular expression that finds the key, its first group if
+it has groups, or a function that takes an item. The input is read once and
+every split gets the header, if a header prefix is given. With a chunk_size
+the number of splits is the number of subjobs.
+
+split_group: The input streams with the same split_group are split together,
+the split n of every one of them will have the same items (e.g. the paired
+reads of two fastq files). The items are distributed by the first stream split.
 
 joiner: A function that should take the out streams for all jobs and return
 the joined stream. If not given the output stream will be just concatenated.
+It can also be the name of a registered joiner.
+       - cat       the default, the outputs are concatenated in the input
+                   order while the subjobs finish
+       - unordered_cat     the output of every subjob is appended as soon as
+                   it finishes, for the outputs in which the order does not
+                   matter
+       - bam       the bam files are merged, the alignments of the bams with
+                   different references are renumbered
+       - merge     the outputs, sorted by the key, are merged keeping the
+                   order, so the joined output is sorted too
+       - sort      the output of every subjob is sorted by the key as soon
+                   as it finishes, while the rest are running, and the sorted
+                   outputs are merged
+       - sum, min, max     the tables written by the subjobs are aggregated,
+                   the values of the lines with the same key are reduced and
+                   one line per key is written, sorted by the key
+       - histogram     the counts of the bins, in the last column, are added
+
+key: The key of the lines for the joiners that merge by key. It can be a
+function that takes a line and returns its key, a column index or a tuple of
+column indexes of the tab separated lines, compared as text.
+The reducers need the column indexes, by default the first column.
+
+numeric: If True the numeric key columns of the merge and sort joiners are
+compared as numbers, e.g. the positions of the sorted sam files.
+
+columns: The column index or indexes with the numbers aggregated by the
+reducer joiners. By default all the columns not in the key.
+
+header: The prefix of the header lines found at the start of the files, e.g.
+'@' for the sam files. The joiners that merge by key write only one header and
+the partitioned inputs have the header in every split.
 
 fhand or fpath: the stream file. This information is not part of the cmd_def.
 It will be added to the streams looking at the cmd
@@ -52,6 +105,14 @@ special: It defines some special treatments for the streams.
    - no_split      It shouldn't be split
    - no_transfer   It shouldn't be transfer to all nodes
    - no_support    An error should be raised if used.
+   - sequential    The cmd reads it from the beginning to the end, so with
+                   the local runner every split can be a named pipe fed while
+                   the subjob is running.
+   - index_cache   The item offsets found while splitting it are stored in a
+                   file.psidx index file next to it and reused while the file
+                   is not modified.
+   - compress_splits   The splits are written BGZF compressed, with a .gz
+                   suffix, for the cmds that read gzip files.
 
 cmd_location: Where in the cmd is the file that corresponds to this stream
 is located. This information shouldn't be in the cmd_def it will be added to the
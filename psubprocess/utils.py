@@ -20,11 +20,22 @@ import psubprocess
 # You should have received a copy of the GNU Affero General Public License
 # along with psubprocess. If not, see <http://www.gnu.org/licenses/>.
 
-import tempfile, os, shutil, signal, subprocess, logging
+import tempfile, os, shutil, signal, subprocess, logging, errno, struct, stat
+import sys, threading, Queue
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 DATA_DIR = os.path.join(os.path.split(psubprocess.__path__[0])[0], 'psubprocess',
                          'data')
 
+#the ioctl to share a range of blocks between two files (aka reflink)
+FICLONE_RANGE = 0x4020940d
+#the errors that tell us that the kernel can not copy between these files
+_KERNEL_COPY_ERRORS = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF,
+                       errno.EOPNOTSUPP, errno.ETXTBSY, errno.EPERM)
+
 class NamedTemporaryDir(object):
     '''This class creates temporary directories '''
     #pylint: disable-msg=W0622
@@ -50,6 +61,152 @@ def copy_file_mode(fpath1, fpath2):
     mode = os.stat(fpath1)[0]
     os.chmod(fpath2, mode)
 
+def _clone_file_section(in_fd, out_fd, start, length, dest_offset):
+    '''It tries to reflink the section into the end of the out file.
+
+    The filesystem has to support FICLONE_RANGE and the offsets have to be
+    aligned to the filesystem block size, otherwise it returns False.
+    '''
+    if fcntl is None:
+        return False
+    block_size = os.fstat(out_fd).st_blksize
+    in_size = os.fstat(in_fd).st_size
+    #only the last block of the input file can be a partial one
+    if (start % block_size or dest_offset % block_size or
+        (length % block_size and start + length != in_size)):
+        return False
+    arg = struct.pack('qQQQ', in_fd, start, length, dest_offset)
+    try:
+        fcntl.ioctl(out_fd, FICLONE_RANGE, arg)
+    except (IOError, OSError):
+        return False
+    return True
+
+#the libc functions already looked up, finding libc forks ldconfig
+_LIBC_FUNCTIONS = {}
+
+def _get_libc_function(name):
+    '''It returns the given libc function or None if it is not available.
+
+    The functions are looked up once and cached.
+    '''
+    if name in _LIBC_FUNCTIONS:
+        return _LIBC_FUNCTIONS[name]
+    try:
+        import ctypes, ctypes.util
+        if 'libc' not in _LIBC_FUNCTIONS:
+            _LIBC_FUNCTIONS['libc'] = ctypes.CDLL(ctypes.util.find_library('c'),
+                                                  use_errno=True)
+        func = getattr(_LIBC_FUNCTIONS['libc'], name)
+        func.restype = ctypes.c_ssize_t
+    except (ImportError, OSError, AttributeError, TypeError):
+        func = None
+    _LIBC_FUNCTIONS[name] = func
+    return func
+
+def _libc_copy(func_name, in_fd, out_fd, offset, count):
+    '''It calls copy_file_range or sendfile from libc.
+
+    The old pythons do not have them in the os module.
+    '''
+    import ctypes
+    func = _get_libc_function(func_name)
+    if func is None:
+        raise OSError(errno.ENOSYS, func_name + ' not available')
+    offset = ctypes.c_longlong(offset)
+    if func_name == 'copy_file_range':
+        done = func(in_fd, ctypes.byref(offset), out_fd, None,
+                    ctypes.c_size_t(count), 0)
+    else:
+        done = func(out_fd, in_fd, ctypes.byref(offset),
+                    ctypes.c_size_t(count))
+    if done < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return done
+
+def _kernel_copy(func_name, in_fd, out_fd, offset, count):
+    '''It copies count bytes from the offset of in_fd to the current position
+    of out_fd with copy_file_range or sendfile.'''
+    #pylint: disable-msg=E1101
+    if func_name == 'copy_file_range' and 'copy_file_range' in dir(os):
+        return os.copy_file_range(in_fd, out_fd, count, offset)
+    elif func_name == 'sendfile' and 'sendfile' in dir(os):
+        return os.sendfile(out_fd, in_fd, offset, count)
+    return _libc_copy(func_name, in_fd, out_fd, offset, count)
+
+def _kernel_copy_file_section(in_fd, out_fd, start, length):
+    '''It copies the section with copy_file_range or sendfile.
+
+    The bytes are written in the current position of out_fd. It returns the
+    number of bytes copied, it can be less than length if the kernel can not
+    copy between these files.
+    '''
+    copied = 0
+    for func_name in ('copy_file_range', 'sendfile'):
+        try:
+            while copied < length:
+                done = _kernel_copy(func_name, in_fd, out_fd, start + copied,
+                                    length - copied)
+                if not done:
+                    #the input file is shorter than expected
+                    return copied
+                copied += done
+        except OSError, error:
+            if error.errno not in _KERNEL_COPY_ERRORS:
+                raise
+        if copied == length:
+            break
+    return copied
+
+def copy_file_section(in_fhand, out_fhand, start, end, buffer_size=1048576,
+                      kernel_copy=True):
+    '''It appends the bytes from start to end of in_fhand to out_fhand.
+
+    The copy is done by the kernel when possible, reflinking the blocks with
+    FICLONE_RANGE or with copy_file_range or sendfile, otherwise the bytes are
+    read and written by python.
+    kernel_copy should be False when the in_fhand has a fileno, but its data
+    are not the bytes of the file, e.g. a GzipFile.
+    '''
+    length = end - start
+    if length <= 0:
+        return
+    copied = 0
+    in_fd, out_fd = None, None
+    if kernel_copy:
+        try:
+            in_fd = in_fhand.fileno()
+            out_fd = out_fhand.fileno()
+        except (AttributeError, IOError, ValueError):
+            in_fd, out_fd = None, None
+    if in_fd is not None:
+        #the python buffers should be in the file before the kernel writes
+        out_fhand.flush()
+        #the output can be a pipe, that can not be reflinked nor seeked
+        if stat.S_ISFIFO(os.fstat(out_fd).st_mode):
+            dest_offset = None
+        else:
+            dest_offset = out_fhand.tell()
+            os.lseek(out_fd, dest_offset, os.SEEK_SET)
+        if (dest_offset is not None and
+            _clone_file_section(in_fd, out_fd, start, length, dest_offset)):
+            copied = length
+        else:
+            copied = _kernel_copy_file_section(in_fd, out_fd, start, length)
+        #the python file object should be aware of the new end of file
+        if dest_offset is not None:
+            out_fhand.seek(dest_offset + copied)
+    #the rest is done the slow way
+    in_fhand.seek(start + copied)
+    remaining = length - copied
+    while remaining > 0:
+        chunk = in_fhand.read(min(buffer_size, remaining))
+        if not chunk:
+            break
+        out_fhand.write(chunk)
+        remaining -= len(chunk)
+
 def call(cmd, environment=None, stdin=None, raise_on_error=False,
          stdout=None, stderr=None, log=False):
     'It calls a command and it returns stdout, stderr and retcode'
@@ -123,6 +280,47 @@ def call(cmd, environment=None, stdin=None, raise_on_error=False,
 
     return stdout_str, stderr_str, retcode
 
+def map_in_threads(func, items, max_workers=1):
+    '''It calls func for every item using up to max_workers threads.
+
+    It returns a list with the results in the same order than the items. If
+    any call fails no more items are processed and the first exception is
+    raised once the running calls have finished.
+    '''
+    items = list(items)
+    if not max_workers or max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def worker():
+        'It processes items until the queue is empty or something fails'
+        while not errors:
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            #we want to raise any error in the main thread
+            #pylint: disable-msg=W0703
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = []
+    for index in range(min(max_workers, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
 def get_fhand(file_, writable=False):
     'Given an fhand or and fpath it returns an fhand'
     if isinstance(file_, basestring):
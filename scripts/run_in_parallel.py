@@ -28,6 +28,8 @@ several nodes using condor.
 from optparse import OptionParser
 import os.path, sys, signal
 
+from subprocess import PIPE
+
 from psubprocess import CondorPopen, Popen
 
 POPEN = None
@@ -37,16 +39,19 @@ def parse_options():
     parser = OptionParser('usage: %prog -c "command"')
     parser.add_option('-n', '--nsplits', dest='splits',
                       help='number of subjobs to create')
+    parser.add_option('-p', '--max_parallel', dest='max_parallel',
+                      help='maximum number of subjobs running at the same time')
     parser.add_option('-r', '--runner', dest='runner', default='subprocess',
                       help='who should run the subjobs (subprocess or condor)')
     parser.add_option('-c', '--command', dest='command',
                       help='The command to run')
     parser.add_option('-o', '--stdout', dest='stdout',
-                      help='A file to store the stdout')
+                      help='A file to store the stdout, by default it is '
+                           'written in our stdout in the input order')
     parser.add_option('-e', '--stderr', dest='stderr',
                       help='A file to store the stderr')
     parser.add_option('-i', '--stdin', dest='stdin',
-                      help='A file to store the stdin')
+                      help='A file with the stdin, - to read it from our stdin')
     parser.add_option('-d', '--cmd_def', dest='cmd_def',
                       help='The command line definition')
     parser.add_option('-q', '--runner_req', dest='runner_req',
@@ -62,11 +67,20 @@ def get_options():
         raise parser.error('The command should be set')
     else:
         options['cmd'] = cmd_options.command.split()
+    if cmd_options.splits is not None:
+        options['splits'] = int(cmd_options.splits)
+    if cmd_options.max_parallel is not None:
+        options['max_parallel'] = int(cmd_options.max_parallel)
     if cmd_options.stdout is not None:
         options['stdout'] = open(cmd_options.stdout, 'w')
+    else:
+        options['stdout'] = PIPE
     if cmd_options.stderr is not None:
         options['stderr'] = open(cmd_options.stderr, 'w')
-    if cmd_options.stdin is not None:
+    if cmd_options.stdin == '-':
+        #it is read while the subjobs run
+        options['stdin'] = iter(sys.stdin.readline, '')
+    elif cmd_options.stdin is not None:
         options['stdin'] = open(cmd_options.stdin)
     if cmd_options.runner == 'subprocess':
         options['runner'] = None
@@ -112,6 +126,11 @@ def main():
     options = get_options()
     global POPEN
     POPEN = Popen(**options)
+    if POPEN.stdout is not None:
+        #the output of every subjob is written as soon as it is finished
+        for line in POPEN.stdout:
+            sys.stdout.write(line)
+        sys.stdout.flush()
     sys.exit(POPEN.wait())
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+'''
+Created on 17/10/2026
+
+@author: jose
+'''
+
+# Copyright 2009 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of psubprocess.
+# psubprocess is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# psubprocess is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with psubprocess. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest, os
+from tempfile import NamedTemporaryFile
+from subprocess import PIPE
+
+from psubprocess.aio import create_parallel, asyncio
+from psubprocess.streams import STDIN
+from test_utils import create_test_binary
+
+class AioTest(unittest.TestCase):
+    'It tests the asyncio interface'
+
+    @staticmethod
+    @unittest.skipIf(asyncio is None, 'asyncio or trollius is required')
+    def test_wait():
+        'The run is waited from the event loop'
+        bin = create_test_binary()
+        content = ''.join(['>hola%d\nhola\n' % index for index in range(10)])
+        in_file = NamedTemporaryFile()
+        in_file.write(content)
+        in_file.flush()
+        out_file = NamedTemporaryFile()
+        cmd = [bin, '-i', in_file.name, '-t', out_file.name]
+        cmd_def = [{'options': ('-i', '--input'), 'io': 'in', 'splitter':'>'},
+                   {'options': ('-t', '--output'), 'io': 'out'}]
+        loop = asyncio.new_event_loop()
+        popen = loop.run_until_complete(create_parallel(cmd, loop=loop,
+                                                        cmd_def=cmd_def,
+                                                        splits=3,
+                                                        max_parallel=2))
+        assert popen.returncode is None
+        assert loop.run_until_complete(popen.wait()) == 0
+        assert popen.returncode == 0
+        assert open(out_file.name).read() == content
+
+        #a failed subjob
+        popen = loop.run_until_complete(create_parallel([bin, '-r', '3'],
+                                                        loop=loop, splits=2))
+        assert loop.run_until_complete(popen.wait()) == 3
+
+        #with PIPEs
+        popen = loop.run_until_complete(create_parallel([bin, '-s'],
+                                                 loop=loop, stdin=PIPE,
+                                                 stdout=PIPE,
+                                                 cmd_def=[{'options': STDIN,
+                                                     'io': 'in',
+                                                     'splitter': ''}]))
+        stdout = loop.run_until_complete(popen.communicate('a\nb\n'))[0]
+        assert stdout == 'a\nb\n'
+        assert popen.returncode == 0
+
+        #the PIPEs are written and read in the executor
+        popen = loop.run_until_complete(create_parallel([bin, '-s'],
+                                                 loop=loop, stdin=PIPE,
+                                                 stdout=PIPE,
+                                                 cmd_def=[{'options': STDIN,
+                                                     'io': 'in',
+                                                     'splitter': ''}]))
+        loop.run_until_complete(popen.stdin.write('c\nd\n'))
+        wait = popen.wait()
+        assert loop.run_until_complete(popen.stdout.readline()) == 'c\n'
+        assert loop.run_until_complete(popen.stdout.read()) == 'd\n'
+        assert loop.run_until_complete(wait) == 0
+        assert popen.stdin.closed
+        loop.close()
+        os.remove(bin)
+
+if __name__ == "__main__":
+    unittest.main()
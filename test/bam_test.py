@@ -0,0 +1,217 @@
+'''
+Created on 17/10/2026
+
+@author: jose
+'''
+
+# Copyright 2009 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of psubprocess.
+# psubprocess is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# psubprocess is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with psubprocess. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest, struct, gzip, os
+from tempfile import NamedTemporaryFile
+
+from psubprocess.bam import (bam_joiner, read_bam_header, iter_bam_records,
+                             bam_reference_offsets)
+from psubprocess.bgzf import BgzfWriter, BgzfReader, BGZF_EOF
+from psubprocess.splitters import get_splitter
+from psubprocess.utils import NamedTemporaryDir, DATA_DIR
+
+def _create_bam(text, references, alignments, flush_header=True):
+    '''It creates a bam file with the given header and alignments.
+
+    The alignments are not real alignments, but the joiner does not care.
+    '''
+    header = 'BAM\x01' + struct.pack('<i', len(text)) + text
+    header += struct.pack('<i', len(references))
+    for name, length in references:
+        header += struct.pack('<i', len(name) + 1) + name + '\x00'
+        header += struct.pack('<i', length)
+    fhand = NamedTemporaryFile(suffix='.bam')
+    writer = BgzfWriter(open(fhand.name, 'wb'))
+    writer.write(header)
+    if flush_header:
+        writer.flush()
+    writer.write(alignments)
+    writer.close()
+    return fhand, header
+
+def _create_bai(bam_fname, spans, pseudo_bins=True):
+    '''It creates a bai index with only the span and the read count of every
+    reference.
+
+    spans should have a (start, end, nreads) uncompressed span for every
+    reference, or None. Without pseudo_bins the references have no bins, like
+    in the indexes created by some old tools.
+    '''
+    reader = BgzfReader(bam_fname)
+    index = 'BAI\x01' + struct.pack('<i', len(spans))
+    for span in spans:
+        if span is None or not pseudo_bins:
+            index += struct.pack('<ii', 0, 0)
+            continue
+        start, end, nreads = span
+        index += struct.pack('<iIi', 1, 37450, 2)
+        index += struct.pack('<4Q', reader.get_virtual_offset(start),
+                             reader.get_virtual_offset(end), nreads, 0)
+        index += struct.pack('<i', 0)
+    reader.close()
+    index_fhand = open(bam_fname + '.bai', 'wb')
+    index_fhand.write(index)
+    index_fhand.close()
+
+class BamTest(unittest.TestCase):
+    'It tests the bam utilities'
+
+    @staticmethod
+    def test_bam_joiner():
+        'The blocks of the bams are concatenated'
+        references = [('ref1', 1000), ('ref2', 200)]
+        text = '@HD\tVN:1.0\n@SQ\tSN:ref1\tLN:1000\n@SQ\tSN:ref2\tLN:200\n'
+        bam1, header = _create_bam(text + '@PG\tID:a\tCL:a split1\n',
+                                   references, 'alignments1')
+        #the header and the alignments can share a block
+        bam2 = _create_bam(text + '@PG\tID:a\tCL:a split2\n', references,
+                           'alignments2', flush_header=False)[0]
+        assert read_bam_header(bam1.name)[1] == references
+        assert read_bam_header(bam1.name)[2] == len(header)
+
+        out_fhand = NamedTemporaryFile(suffix='.bam')
+        bam_joiner(out_fhand, [bam1, bam2])
+        joined = open(out_fhand.name, 'rb').read()
+        assert gzip.open(out_fhand.name).read() == (header + 'alignments1' +
+                                                    'alignments2')
+        assert joined.endswith(BGZF_EOF)
+        assert BGZF_EOF not in joined[:-len(BGZF_EOF)]
+
+    @staticmethod
+    def test_bam_index_splitter():
+        'The sorted and indexed bams are split by reference'
+        references = [('ref1', 1000), ('ref2', 200), ('ref3', 10),
+                      ('ref4', 300)]
+        text = '@HD\tVN:1.0\tSO:coordinate\n'
+        reads = {}
+        for ref_index, nreads in ((0, 30), (1, 10), (3, 20)):
+            record = 'read_%d_%%03d' % ref_index
+            reads[ref_index] = ''.join([struct.pack('<ii', 4 + 10, ref_index)
+                                        + record % read_index
+                                        for read_index in range(nreads)])
+        alignments = reads[0] + reads[1] + reads[3]
+        bam, header = _create_bam(text, references, alignments,
+                                  flush_header=False)
+        #more than one block for the alignments
+        writer = BgzfWriter(open(bam.name, 'wb'))
+        for index in range(0, len(header + alignments), 100):
+            writer.write((header + alignments)[index: index + 100])
+            writer.flush()
+        writer.close()
+        start1 = len(header)
+        start2 = start1 + len(reads[0])
+        start4 = start2 + len(reads[1])
+        _create_bai(bam.name, [(start1, start2, 30), (start2, start4, 10),
+                               None, (start4, start4 + len(reads[3]), 20)])
+        try:
+            work_dirs = [NamedTemporaryDir() for index in range(3)]
+            splitter = get_splitter('bam', write_workers=2)
+            splits = splitter(bam.name, work_dirs)
+            assert len(splits) == 3
+            contents = [gzip.open(split).read() for split in splits]
+            assert contents == [header + reads[0], header + reads[1],
+                                header + reads[3]]
+            for split in splits:
+                assert open(split, 'rb').read().endswith(BGZF_EOF)
+
+            #one split by every 30 reads
+            splitter = get_splitter('bam', chunk_size=30)
+            splits = splitter(bam.name, work_dirs)
+            assert [gzip.open(split).read() for split in splits] == [
+                            header + reads[0], header + reads[1] + reads[3]]
+
+            #without pseudo-bins the references are found reading the bam
+            _create_bai(bam.name, [(start1, start2, 30), (start2, start4, 10),
+                                   None, (start4, start4 + len(reads[3]), 20)],
+                        pseudo_bins=False)
+            splits = get_splitter('bam')(bam.name, work_dirs)
+            assert [gzip.open(split).read() for split in splits] == [
+                    header + reads[0], header + reads[1], header + reads[3]]
+        finally:
+            os.remove(bam.name + '.bai')
+            for work_dir in work_dirs:
+                work_dir.close()
+
+    @staticmethod
+    def test_bam_records():
+        'The alignments of a bam are read'
+        bam_fname = os.path.join(DATA_DIR, 'seq.bam')
+        alignments_start = read_bam_header(bam_fname)[2]
+        reader = BgzfReader(bam_fname)
+        reader.seek(alignments_start)
+        records = list(iter_bam_records(reader))
+        reader.close()
+        offsets = bam_reference_offsets(bam_fname)
+        assert len(offsets) == 3
+        assert offsets[0] == alignments_start
+        assert offsets[-1] == alignments_start + len(''.join(records))
+
+        #without index the bam is split by the references found in it
+        work_dirs = [NamedTemporaryDir() for index in range(3)]
+        splits = get_splitter('bam')(bam_fname, work_dirs)
+        assert len(splits) == 2
+        header = gzip.open(bam_fname).read()[:alignments_start]
+        contents = [gzip.open(split).read() for split in splits]
+        assert [content[:alignments_start] for content in contents] == \
+                                                                [header] * 2
+        assert ''.join([content[alignments_start:] for content in contents]) \
+                                                        == ''.join(records)
+        for work_dir in work_dirs:
+            work_dir.close()
+
+        #a record cut in the middle
+        bam, header = _create_bam('@HD\tVN:1.0\n', [('ref1', 100)],
+                                  struct.pack('<i', 36) + 'x' * 20)
+        reader = BgzfReader(bam.name)
+        reader.seek(len(header))
+        try:
+            list(iter_bam_records(reader))
+            raise AssertionError('ValueError expected')
+        except ValueError:
+            pass
+        reader.close()
+
+    @staticmethod
+    def test_merging_bam_joiner():
+        'The bams with different references are joined renumbering them'
+        record = lambda ref_id, next_ref_id, name: (struct.pack('<i', 32 +
+                len(name)) + struct.pack('<iiiiiii', ref_id, 0, 0, 0, 0,
+                next_ref_id, 0) + struct.pack('<i', 0) + name)
+        bam1 = _create_bam('@HD\tVN:1.0\n@RG\tID:a\n', [('ref1', 100)],
+                           record(0, 0, 'read1') + record(-1, -1, 'read2'))[0]
+        bam2 = _create_bam('@HD\tVN:1.0\n@RG\tID:b\n',
+                           [('ref2', 200), ('ref1', 100)],
+                           record(0, 1, 'read3') + record(1, -1, 'read4'))[0]
+        out_fhand = NamedTemporaryFile(suffix='.bam')
+        bam_joiner(out_fhand.name, [bam1, bam2])
+        text, references, alignments_start = read_bam_header(out_fhand.name)
+        assert references == [('ref1', 100), ('ref2', 200)]
+        assert text == '@HD\tVN:1.0\n@RG\tID:a\n@SQ\tSN:ref2\tLN:200\n' + \
+                       '@RG\tID:b\n'
+        reader = BgzfReader(out_fhand.name)
+        reader.seek(alignments_start)
+        assert list(iter_bam_records(reader)) == [record(0, 0, 'read1'),
+                            record(-1, -1, 'read2'), record(1, 0, 'read3'),
+                            record(0, -1, 'read4')]
+        reader.close()
+
+if __name__ == "__main__":
+    unittest.main()
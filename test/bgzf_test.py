@@ -0,0 +1,80 @@
+'''
+Created on 17/10/2026
+
+@author: jose
+'''
+
+# Copyright 2009 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of psubprocess.
+# psubprocess is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# psubprocess is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with psubprocess. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest, gzip
+from tempfile import NamedTemporaryFile
+
+from psubprocess.bgzf import (BgzfReader, BgzfWriter, get_compression,
+                              get_bgzf_blocks, split_virtual_offset,
+                              MAX_BLOCK_DATA)
+
+class BgzfTest(unittest.TestCase):
+    'It tests the BGZF reader and writer'
+
+    @staticmethod
+    def test_write_read():
+        'It writes a BGZF file and it reads it back'
+        content = ''.join(['>seq%d\n%s\n' % (index, 'ACGT' * (index % 50))
+                                                    for index in range(20000)])
+        bgzf_fhand = NamedTemporaryFile(suffix='.gz')
+        writer = BgzfWriter(open(bgzf_fhand.name, 'wb'), workers=2)
+        for start in range(0, len(content), 10000):
+            writer.write(content[start:start + 10000])
+        writer.close()
+
+        #it is a gzip file with several blocks
+        assert get_compression(bgzf_fhand.name) == 'bgzf'
+        assert gzip.open(bgzf_fhand.name).read() == content
+        coffsets, uoffsets = get_bgzf_blocks(open(bgzf_fhand.name, 'rb'))
+        assert len(coffsets) > 3
+        assert uoffsets[1] == MAX_BLOCK_DATA
+        assert uoffsets[-1] == len(content)
+
+        reader = BgzfReader(bgzf_fhand.name, workers=2, blocks_per_batch=2)
+        assert reader.size == len(content)
+        assert reader.read() == content
+        for position in (0, 5, MAX_BLOCK_DATA - 1, MAX_BLOCK_DATA * 3 + 7):
+            reader.seek(position)
+            assert reader.read(100000) == content[position:position + 100000]
+        reader.seek(MAX_BLOCK_DATA + 10)
+        assert list(reader) == content[MAX_BLOCK_DATA + 10:].splitlines(True)
+        assert split_virtual_offset(reader.get_virtual_offset(
+                                         MAX_BLOCK_DATA + 10)) == (coffsets[1],
+                                                                   10)
+        reader.close()
+
+        #the block table can be shared by the readers
+        reader = BgzfReader(bgzf_fhand.name, blocks=(coffsets, uoffsets))
+        reader.seek(MAX_BLOCK_DATA * 2 + 3)
+        assert reader.read(10) == content[MAX_BLOCK_DATA * 2 + 3:
+                                          MAX_BLOCK_DATA * 2 + 13]
+        reader.close()
+
+        #a plain gzip file
+        gzip_fhand = NamedTemporaryFile(suffix='.gz')
+        gzip_file = gzip.GzipFile(gzip_fhand.name, 'wb')
+        gzip_file.write(content)
+        gzip_file.close()
+        assert get_compression(gzip_fhand.name) == 'gzip'
+        assert get_compression(__file__) is None
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+'''
+Created on 17/10/2026
+
+@author: jose
+'''
+
+# Copyright 2009 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of psubprocess.
+# psubprocess is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# psubprocess is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with psubprocess. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest, os
+from tempfile import NamedTemporaryFile
+
+from psubprocess.joiners import (create_merge_joiner, get_line_key,
+                                 SortingJoin, ReducingJoin,
+                                 create_reduce_joiner, sort_part)
+
+def _create_parts(contents):
+    'It creates a file for every content'
+    parts = []
+    for content in contents:
+        part = NamedTemporaryFile()
+        part.write(content)
+        part.flush()
+        parts.append(part)
+    return parts
+
+class JoinersTest(unittest.TestCase):
+    'It tests the joiners that merge by key'
+
+    @staticmethod
+    def test_line_key():
+        'The keys can be columns or functions'
+        line = 'chr1\t100\tA\n'
+        assert get_line_key()(line) == line
+        assert get_line_key(1)(line) == '100'
+        assert get_line_key((0, 2))(line) == ('chr1', 'A')
+        assert get_line_key(lambda line: len(line))(line) == 11
+        assert get_line_key(1, numeric=True)(line) == 100
+        assert get_line_key((0, 1), numeric=True)(line) == ('chr1', 100)
+        for line in ('chr1\n', '\n'):
+            try:
+                get_line_key((0, 1))(line)
+                raise AssertionError('ValueError expected')
+            except ValueError:
+                pass
+
+    @staticmethod
+    def test_merge_joiner():
+        'The sorted outputs are merged'
+        parts = _create_parts(['@HD\t1\na\t1\nc\t1\n', '@HD\t2\nb\t2\nc\t2',
+                               '', 'a\t3\nd\t3\n'])
+        out_fhand = NamedTemporaryFile()
+        joiner = create_merge_joiner(key=0, header='@')
+        joiner(out_fhand, parts)
+        result = open(out_fhand.name).read()
+        assert result == '@HD\t1\na\t1\na\t3\nb\t2\nc\t1\nc\t2\nd\t3\n'
+
+        #numeric keys
+        parts = _create_parts(['chr1\t9\nchr1\t10\n', 'chr1\t2\nchr2\t1\n'])
+        key = lambda line: (line.split()[0], int(line.split()[1]))
+        create_merge_joiner(key=key)(out_fhand.name, parts)
+        result = open(out_fhand.name).read()
+        assert result == 'chr1\t2\nchr1\t9\nchr1\t10\nchr2\t1\n'
+        create_merge_joiner(key=(0, 1), numeric=True)(out_fhand.name, parts)
+        assert open(out_fhand.name).read() == result
+
+        #the multi-digit positions are sorted as numbers
+        parts = _create_parts(['chr1\t100\nchr1\t99\n', 'chr1\t1000\n'])
+        join = SortingJoin(out_fhand, key=1, numeric=True)
+        join.add_part(0, parts[0].name)
+        join.add_part(1, parts[1].name)
+        join.close()
+        result = open(out_fhand.name).read()
+        assert result == 'chr1\t99\nchr1\t100\nchr1\t1000\n'
+
+    @staticmethod
+    def test_sorting_join():
+        'The parts are sorted as they are added and then merged'
+        parts = _create_parts(['#h\nc\t1\na\t1\n', 'b\t2\na\t2',
+                               'd\t3\nc\t3\n'])
+        out_fhand = NamedTemporaryFile()
+        join = SortingJoin(out_fhand, key=0, header='#')
+        join.add_part(2, parts[2].name)
+        join.add_part(0, parts[0].name)
+        join.add_part(1, parts[1].name)
+        join.close()
+        result = open(out_fhand.name).read()
+        assert result == '#h\na\t1\na\t2\nb\t2\nc\t1\nc\t3\nd\t3\n'
+        #the sorted parts are removed once they are merged
+        for part in parts:
+            assert not os.path.exists(part.name + '.sorted')
+
+        #the parts are sorted by one process at a time
+        join = SortingJoin(out_fhand, key=0, header='#', workers=1)
+        for index, part in enumerate(parts):
+            join.add_part(index, part.name)
+        join.close()
+        assert open(out_fhand.name).read() == result
+
+        #the errors found sorting are raised when the join is closed
+        part = _create_parts(['a\t1\nb\n'])[0]
+        join = SortingJoin(out_fhand, key=(0, 1))
+        join.add_part(0, part.name)
+        try:
+            join.close()
+            raise AssertionError('ValueError expected')
+        except ValueError:
+            pass
+        assert not os.path.exists(part.name + '.sorted')
+
+    @staticmethod
+    def test_sort_part_runs():
+        'The big parts are sorted in runs that are merged'
+        lines = ['%d\t%d\n' % (index % 7, index) for index in range(100)]
+        part = _create_parts([''.join(lines)])[0]
+        sorted_fname = sort_part(part.name, get_line_key(0), buffer_size=50)
+        expected = sorted(lines, key=lambda line: line.split('\t')[0])
+        assert open(sorted_fname).read() == ''.join(expected)
+        assert os.listdir(os.path.dirname(part.name)).count(
+                                os.path.basename(part.name) + '.run0') == 0
+        os.remove(sorted_fname)
+
+    @staticmethod
+    def test_reducers():
+        'The tables are aggregated by key'
+        parts = _create_parts(['#gene\tcount\tlength\ng2\t3\t1.5\n'
+                               'g10\t1\t2\n',
+                               '#gene\tcount\tlength\ng10\t4\t0.5\n\n',
+                               'g1\t2\t1\ng2\t1\t7\n'])
+        out_fhand = NamedTemporaryFile()
+        create_reduce_joiner('sum', header='#')(out_fhand, parts)
+        assert open(out_fhand.name).read() == ('#gene\tcount\tlength\n'
+                                'g1\t2\t1\ng10\t5\t2.5\ng2\t4\t8.5\n')
+        create_reduce_joiner('max', columns=1, header='#')(out_fhand, parts)
+        assert open(out_fhand.name).read() == ('#gene\tcount\tlength\n'
+                                'g1\t2\t1\ng10\t4\t2\ng2\t3\t1.5\n')
+
+        #the histogram bins are sorted as numbers
+        parts = _create_parts(['10\tx\t2\n2\tx\t1\n', '2\tx\t3\n'])
+        join = ReducingJoin(out_fhand, 'histogram')
+        join.add_part(1, parts[1].name)
+        join.add_part(0, parts[0].name)
+        join.close()
+        assert open(out_fhand.name).read() == '2\tx\t4\n10\tx\t2\n'
+
+        #the floats keep all their digits
+        parts = _create_parts(['a\t0.1234567890123456\n', 'a\t0.5\n'])
+        create_reduce_joiner('min')(out_fhand, parts)
+        assert open(out_fhand.name).read() == 'a\t0.1234567890123456\n'
+
+        try:
+            create_reduce_joiner('min')(out_fhand, _create_parts(['a\tb\n']))
+            raise AssertionError('ValueError expected')
+        except ValueError:
+            pass
+
+if __name__ == "__main__":
+    unittest.main()
@@ -21,11 +21,13 @@ Created on 16/07/2009
 
 import unittest
 from tempfile import NamedTemporaryFile
-import os
+import os, time, signal, pwd, subprocess, threading
+from subprocess import PIPE
 
-from psubprocess import Popen
-from psubprocess.streams import STDIN
-from psubprocess.utils import DATA_DIR
+from psubprocess import Popen, utils
+from psubprocess.prunner import _IncrementalJoin, default_cat_joiner
+from psubprocess.streams import STDIN, STDOUT
+from psubprocess.utils import DATA_DIR, NamedTemporaryDir
 from test_utils import create_test_binary
 
 class PRunnerTest(unittest.TestCase):
@@ -69,6 +71,16 @@ class PRunnerTest(unittest.TestCase):
         assert open(stderr.name).read() == 'caracola' * splits
         os.remove(bin)
 
+    @staticmethod
+    def test_job_dirs():
+        'Every subjob is run in its work dir'
+        cwd = os.getcwd()
+        popen = Popen(['pwd'], stdout=PIPE, cmd_def=[], splits=3)
+        work_dirs = [work_dir.name for work_dir in popen._jobs['work_dirs']]
+        assert os.getcwd() == cwd
+        assert popen.communicate()[0].splitlines() == [
+                        os.path.realpath(work_dir) for work_dir in work_dirs]
+
     @staticmethod
     def test_stdin():
         'It test that stdin works as input'
@@ -93,6 +105,79 @@ class PRunnerTest(unittest.TestCase):
         assert open(stderr.name).read() == ''
         os.remove(bin)
 
+    @staticmethod
+    def test_stdin_stream():
+        'The stdin can be a PIPE or an iterator'
+        bin = create_test_binary()
+        content = ''.join(['>hola%d\nhola\n' % index for index in range(50)])
+        cmd = [bin, '-s']
+        cmd_def = [{'options':STDIN, 'io': 'in', 'splitter':'>'}]
+
+        #an iterator
+        stdout = NamedTemporaryFile()
+        stderr = NamedTemporaryFile()
+        lines = iter(content.splitlines(True))
+        popen = Popen(cmd, stdout=stdout, stderr=stderr, stdin=lines,
+                      cmd_def=cmd_def, splits=2, chunk_size=7)
+        #only the chunks of the running subjobs and the next one have been
+        #read
+        assert len(popen._jobs['cmds']) == 3
+        assert popen.wait() == 0 #waits till finishes and looks to the retcod
+        assert len(popen._jobs['cmds']) == 8
+        assert open(stdout.name).read() == content
+
+        #a PIPE
+        stdout = NamedTemporaryFile()
+        stderr = NamedTemporaryFile()
+        popen = Popen(cmd, stdout=stdout, stderr=stderr, stdin=PIPE,
+                      cmd_def=cmd_def, splits=3, chunk_size=5)
+        for index in range(0, len(content), 9):
+            popen.stdin.write(content[index:index + 9])
+        popen.stdin.close()
+        assert popen.wait() == 0 #waits till finishes and looks to the retcod
+        assert len(popen._jobs['cmds']) == 10
+        assert open(stdout.name).read() == content
+
+        #an empty stream
+        stdout = NamedTemporaryFile()
+        stderr = NamedTemporaryFile()
+        popen = Popen(cmd, stdout=stdout, stderr=stderr, stdin=iter([]),
+                      cmd_def=cmd_def)
+        assert popen.wait() == 0
+        assert open(stdout.name).read() == ''
+        os.remove(bin)
+
+    @staticmethod
+    def test_stdout_pipe():
+        'The stdout can be read while the subjobs run'
+        bin = create_test_binary()
+        content = ''.join(['>hola%d\nhola\n' % index for index in range(50)])
+        in_file = NamedTemporaryFile()
+        in_file.write(content)
+        in_file.flush()
+        cmd = [bin, '-i', in_file.name]
+        cmd_def = [{'options': ('-i', '--input'), 'io': 'in', 'splitter':'>'}]
+
+        popen = Popen(cmd, stdout=PIPE, stderr=PIPE, cmd_def=cmd_def,
+                      splits=3, chunk_size=10)
+        assert popen.stdout.readline() == '>hola0\n'
+        assert popen.stdout.read(5) == 'hola\n'
+        lines = list(popen.stdout)
+        assert ''.join(lines) == content[12:]
+        assert popen.stderr.read() == ''
+        assert popen.wait() == 0
+
+        #communicate with stdin and stdout PIPEs
+        cmd = [bin, '-s']
+        cmd_def = [{'options':STDIN, 'io': 'in', 'splitter':'>'}]
+        stderr = NamedTemporaryFile()
+        popen = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=stderr,
+                      cmd_def=cmd_def, splits=2, chunk_size=7)
+        assert popen.communicate(content) == (content, None)
+        assert popen.returncode == 0
+        in_file.close()
+        os.remove(bin)
+
     @staticmethod
     def test_infile_outfile():
         'It tests that we can set an input file and an output file'
@@ -221,6 +306,334 @@ class PRunnerTest(unittest.TestCase):
         in_file2.close()
         os.remove(bin)
 
+    @staticmethod
+    def test_sequential_streams():
+        'The sequential input streams are fed through named pipes'
+        bin = create_test_binary()
+        content = '>hola1\nhola2\n>hola3\nhola4\n>hola5\nhola6\n'
+        in_file = NamedTemporaryFile()
+        in_file.write(content)
+        in_file.flush()
+        stdin = NamedTemporaryFile()
+        stdin.write(content)
+        stdin.flush()
+
+        cmd = [bin]
+        cmd.extend(['-i', in_file.name])
+        stdout = NamedTemporaryFile()
+        stderr = NamedTemporaryFile()
+        cmd_def = [{'options': ('-i', '--input'), 'io': 'in', 'splitter':'>',
+                    'special':['sequential']}]
+        popen = Popen(cmd, stdout=stdout, stderr=stderr, cmd_def=cmd_def,
+                      splits=2)
+        assert popen.wait() == 0 #waits till finishes and looks to the retcod
+        assert open(stdout.name).read() == content
+
+        #with stdin
+        cmd = [bin, '-s']
+        cmd_def = [{'options':STDIN, 'io': 'in', 'splitter':'>',
+                    'special':['sequential']}]
+        popen = Popen(cmd, stdout=stdout, stderr=stderr, stdin=stdin,
+                      cmd_def=cmd_def, splits=2)
+        assert popen.wait() == 0 #waits till finishes and looks to the retcod
+        assert open(stdout.name).read() == content
+
+        #a subjob that does not read its pipe does not block us
+        cmd = [bin, '-o', 'hola', '-x', in_file.name]
+        cmd_def = [{'options': ('-x',), 'io': 'in', 'splitter':'>',
+                    'special':['sequential']}]
+        popen = Popen(cmd, stdout=stdout, stderr=stderr, cmd_def=cmd_def,
+                      splits=2)
+        assert popen.wait() == 0 #waits till finishes and looks to the retcod
+        in_file.close()
+        os.remove(bin)
+
+    @staticmethod
+    def test_sequential_read_only_input():
+        'The read only inputs can be fed through named pipes by any user'
+        def run_cat():
+            'It cats a read only file through the named pipes'
+            work_dir = NamedTemporaryDir()
+            in_fname = os.path.join(work_dir.name, 'in.txt')
+            content = '>hola1\nhola2\n>hola3\nhola4\n'
+            open(in_fname, 'w').write(content)
+            os.chmod(in_fname, 0444)
+            stdout = NamedTemporaryFile(dir=work_dir.name)
+            cmd_def = [{'options':STDIN, 'io': 'in', 'splitter':'>',
+                        'special':['sequential']}]
+            popen = Popen(['cat'], stdout=stdout, stdin=open(in_fname),
+                          cmd_def=cmd_def, splits=2)
+            assert popen.wait() == 0
+            assert open(stdout.name).read() == content
+            work_dir.close()
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                signal.alarm(20)
+                os.chdir('/tmp')
+                #root could write the pipe anyway
+                if not os.getuid():
+                    os.setgid(pwd.getpwnam('nobody').pw_gid)
+                    os.setuid(pwd.getpwnam('nobody').pw_uid)
+                run_cat()
+                status = 0
+            finally:
+                os._exit(status)
+        assert os.waitpid(pid, 0)[1] == 0
+
+    @staticmethod
+    def test_split_workers():
+        'The split files can be written by several threads'
+        bin = create_test_binary()
+        content = ''.join(['>hola%d\nhola\n' % index for index in range(50)])
+        in_file = NamedTemporaryFile()
+        in_file.write(content)
+        in_file.flush()
+        out_file = NamedTemporaryFile()
+
+        cmd = [bin, '-i', in_file.name, '-t', out_file.name]
+        stdout = NamedTemporaryFile()
+        stderr = NamedTemporaryFile()
+        cmd_def = [{'options': ('-i', '--input'), 'io': 'in', 'splitter':'>'},
+                   {'options': ('-t', '--output'), 'io': 'out'}]
+        popen = Popen(cmd, stdout=stdout, stderr=stderr, cmd_def=cmd_def,
+                      splits=10, split_workers=4)
+        assert popen.wait() == 0 #waits till finishes and looks to the retcod
+        assert open(out_file.name).read() == content
+        in_file.close()
+        os.remove(bin)
+
+    @staticmethod
+    def test_chunks():
+        'The input can be cut into more chunks than running subjobs'
+        bin = create_test_binary()
+        content = ''.join(['>hola%d\nhola\n' % index for index in range(50)])
+        in_file = NamedTemporaryFile()
+        in_file.write(content)
+        in_file.flush()
+        out_file = NamedTemporaryFile()
+
+        cmd = [bin, '-i', in_file.name, '-t', out_file.name]
+        stdout = NamedTemporaryFile()
+        stderr = NamedTemporaryFile()
+        cmd_def = [{'options': ('-i', '--input'), 'io': 'in', 'splitter':'>'},
+                   {'options': ('-t', '--output'), 'io': 'out'}]
+        popen = Popen(cmd, stdout=stdout, stderr=stderr, cmd_def=cmd_def,
+                      splits=2, chunk_size=4)
+        #13 chunks, but only 2 subjobs at the same time
+        assert len(popen._jobs['cmds']) == 13
+        assert len(popen._jobs['popens']) == 2
+        assert popen.wait() == 0 #waits till finishes and looks to the retcod
+        assert len(popen._jobs['popens']) == 13
+        #the outputs are joined in the input order
+        assert open(out_file.name).read() == content
+        in_file.close()
+        os.remove(bin)
+
+    @staticmethod
+    def test_max_parallel():
+        'Only max_parallel subjobs run at the same time'
+        bin = create_test_binary()
+        content = ''.join(['>hola%d\nhola\n' % index for index in range(10)])
+        in_file = NamedTemporaryFile()
+        in_file.write(content)
+        in_file.flush()
+        out_file = NamedTemporaryFile()
+
+        cmd = [bin, '-i', in_file.name, '-t', out_file.name]
+        cmd_def = [{'options': ('-i', '--input'), 'io': 'in', 'splitter':'>'},
+                   {'options': ('-t', '--output'), 'io': 'out'}]
+        popen = Popen(cmd, cmd_def=cmd_def, splits=5, max_parallel=2)
+        assert len(popen._jobs['cmds']) == 5
+        assert len(popen._jobs['popens']) == 2
+        assert popen.returncode is None
+        assert popen.wait() == 0
+        assert len(popen._jobs['popens']) == 5
+        assert open(out_file.name).read() == content
+        os.remove(bin)
+
+    @staticmethod
+    def test_merge_joiner():
+        'The sorted outputs are merged by key'
+        bin = create_test_binary()
+        content = ''.join(['seq\t%03d\n' % index for index in range(20)])
+        in_file = NamedTemporaryFile()
+        in_file.write(content)
+        in_file.flush()
+        out_file = NamedTemporaryFile()
+
+        cmd = [bin, '-i', in_file.name, '-t', out_file.name]
+        cmd_def = [{'options': ('-i', '--input'), 'io': 'in', 'splitter':''},
+                   {'options': ('-t', '--output'), 'io': 'out',
+                    'joiner': 'merge', 'key': 1}]
+        popen = Popen(cmd, cmd_def=cmd_def, splits=3)
+        assert popen.wait() == 0
+        assert open(out_file.name).read() == content
+        os.remove(bin)
+
+    @staticmethod
+    def test_sort_joiner():
+        'The outputs are sorted while the subjobs finish and merged'
+        bin = create_test_binary()
+        lines = ['seq\t%03d\n' % ((index * 7) % 20) for index in range(20)]
+        in_file = NamedTemporaryFile()
+        in_file.write(''.join(lines))
+        in_file.flush()
+        out_file = NamedTemporaryFile()
+
+        cmd = [bin, '-i', in_file.name, '-t', out_file.name]
+        cmd_def = [{'options': ('-i', '--input'), 'io': 'in', 'splitter':''},
+                   {'options': ('-t', '--output'), 'io': 'out',
+                    'joiner': 'sort', 'key': 1}]
+        popen = Popen(cmd, cmd_def=cmd_def, splits=3)
+        assert popen.wait() == 0
+        assert open(out_file.name).read() == ''.join(sorted(lines))
+        os.remove(bin)
+
+    @staticmethod
+    def test_reducer_joiner():
+        'The tables written by the subjobs are aggregated'
+        bin = create_test_binary()
+        content = ''.join(['k%d\t%d\n' % (index % 3, index)
+                                                        for index in range(12)])
+        in_file = NamedTemporaryFile()
+        in_file.write(content)
+        in_file.flush()
+        out_file = NamedTemporaryFile()
+
+        cmd = [bin, '-i', in_file.name, '-t', out_file.name]
+        cmd_def = [{'options': ('-i', '--input'), 'io': 'in', 'splitter':''},
+                   {'options': ('-t', '--output'), 'io': 'out',
+                    'joiner': 'sum'}]
+        popen = Popen(cmd, cmd_def=cmd_def, splits=4)
+        assert popen.wait() == 0
+        assert open(out_file.name).read() == 'k0\t18\nk1\t22\nk2\t26\n'
+        os.remove(bin)
+
+    @staticmethod
+    def test_incremental_join():
+        'The outputs are joined while the subjobs finish'
+        work_dir = NamedTemporaryDir()
+        def create_parts():
+            'It creates the parts of the join'
+            parts = []
+            for index in range(3):
+                part = NamedTemporaryFile(dir=work_dir.name, delete=False)
+                part.write('part%d\n' % index)
+                part.close()
+                parts.append(part.name)
+            return parts
+        parts = create_parts()
+        out_file = NamedTemporaryFile()
+        join = _IncrementalJoin(out_file)
+        join.add_part(1, parts[1])
+        #the first part has not finished
+        assert open(out_file.name).read() == ''
+        join.add_part(0, parts[0])
+        join.add_part(2, parts[2])
+        join.close()
+        assert open(out_file.name).read() == 'part0\npart1\npart2\n'
+
+        join = _IncrementalJoin(out_file, ordered=False)
+        join.add_part(1, parts[1])
+        join.add_part(0, parts[0])
+        join.close()
+        assert open(out_file.name).read() == 'part1\npart0\n'
+
+        #with an fname the first part becomes the output
+        join = _IncrementalJoin(out_file.name)
+        join.add_part(0, parts[0])
+        #the next parts are still copied by the kernel
+        kernel_copied = []
+        kernel_copy_file_section = utils._kernel_copy_file_section
+        def record_kernel_copy(*args):
+            'It records the bytes copied by the kernel'
+            kernel_copied.append(kernel_copy_file_section(*args))
+            return kernel_copied[-1]
+        utils._kernel_copy_file_section = record_kernel_copy
+        try:
+            join.add_part(1, parts[1])
+        finally:
+            utils._kernel_copy_file_section = kernel_copy_file_section
+        assert kernel_copied == [len('part1\n')]
+        join.close()
+        assert open(out_file.name).read() == 'part0\npart1\n'
+        assert not os.path.exists(parts[0])
+
+        #the symlinks and the hardlinks are written, not replaced
+        link = os.path.join(work_dir.name, 'link')
+        os.symlink(out_file.name, link)
+        hardlink = os.path.join(work_dir.name, 'hardlink')
+        os.link(out_file.name, hardlink)
+        for out_fname in (link, hardlink):
+            parts = create_parts()
+            join = _IncrementalJoin(out_fname)
+            join.add_part(0, parts[0])
+            join.add_part(1, parts[1])
+            join.close()
+            assert os.path.exists(parts[0])
+            assert os.path.islink(link)
+            assert os.path.samefile(out_file.name, hardlink)
+            assert open(out_file.name).read() == 'part0\npart1\n'
+        work_dir.close()
+
+        #an unordered join in a Popen
+        bin = create_test_binary()
+        content = ''.join(['>hola%d\nhola\n' % index for index in range(50)])
+        in_file = NamedTemporaryFile()
+        in_file.write(content)
+        in_file.flush()
+        cmd = [bin, '-i', in_file.name, '-t', out_file.name]
+        cmd_def = [{'options': ('-i', '--input'), 'io': 'in', 'splitter':'>'},
+                   {'options': ('-t', '--output'), 'io': 'out',
+                    'joiner': 'unordered_cat'}]
+        popen = Popen(cmd, cmd_def=cmd_def, splits=4, chunk_size=5)
+        assert popen.wait() == 0
+        out_lines = open(out_file.name).read().splitlines()
+        assert sorted(out_lines) == sorted(content.splitlines())
+        in_file.close()
+        os.remove(bin)
+
+    @staticmethod
+    def test_split_group():
+        'The input files in a split group are split together'
+        bin = create_test_binary()
+        content1 = '>s1\n' + 'A' * 100 + '\n>s2\nA\n>s3\nA\n'
+        content2 = '>s1\nA\n>s2\nA\n>s3\n' + 'A' * 100 + '\n'
+        in_file1 = NamedTemporaryFile()
+        in_file1.write(content1)
+        in_file1.flush()
+        in_file2 = NamedTemporaryFile()
+        in_file2.write(content2)
+        in_file2.flush()
+        out_file1 = NamedTemporaryFile()
+        out_file2 = NamedTemporaryFile()
+
+        cmd = [bin, '-i', in_file1.name, '-t', out_file1.name]
+        cmd.extend(['-x', in_file2.name, '-z', out_file2.name])
+        stdout = NamedTemporaryFile()
+        stderr = NamedTemporaryFile()
+        cmd_def = [{'options': ('-i',), 'io': 'in', 'splitter':'>',
+                    'balance': 'bytes', 'split_group': 'pair'},
+                   {'options': ('-x',), 'io': 'in', 'splitter':'>',
+                    'balance': 'bytes', 'split_group': 'pair'},
+                   {'options': ('-t',), 'io': 'out'},
+                   {'options': ('-z',), 'io': 'out'}]
+        popen = Popen(cmd, stdout=stdout, stderr=stderr, cmd_def=cmd_def,
+                      splits=2)
+        #both inputs were split by the first one
+        first_split = [stream['fname'] for stream in
+                       popen._jobs['streams'][0][:2]]
+        assert open(first_split[0]).read() == '>s1\n' + 'A' * 100 + '\n'
+        assert open(first_split[1]).read() == '>s1\nA\n'
+        assert popen.wait() == 0 #waits till finishes and looks to the retcod
+        assert open(out_file1.name).read() == content1
+        assert open(out_file2.name).read() == content2
+        in_file1.close()
+        in_file2.close()
+        os.remove(bin)
+
     @staticmethod
     def test_kill_subjobs():
         'It tests that we can kill the subjobs'
@@ -236,6 +649,85 @@ class PRunnerTest(unittest.TestCase):
         assert not open(stderr.name).read()
         os.remove(bin)
 
+        #the pending chunks are not launched nor joined
+        in_file = NamedTemporaryFile(suffix='.sh')
+        in_file.write('sleep 30\n' * 4)
+        in_file.flush()
+        cmd = ['sh', in_file.name]
+        cmd_def = [{'options': -1, 'io': 'in', 'splitter': ''}]
+        stdout = NamedTemporaryFile()
+        popen = Popen(cmd, stdout=stdout, cmd_def=cmd_def, splits=2,
+                      chunk_size=1)
+        assert len(popen._jobs['popens']) == 2
+        popen.kill()
+        assert popen.wait() == -9
+        assert len(popen._jobs['popens']) == 2
+        assert not open(stdout.name).read()
+
+    @staticmethod
+    def test_poll():
+        'A failed subjob is noticed while the previous ones are running'
+        in_file = NamedTemporaryFile(suffix='.sh')
+        in_file.write('sleep 30\nexit 3\n')
+        in_file.flush()
+        cmd = ['sh', in_file.name]
+        cmd_def = [{'options': -1, 'io': 'in', 'splitter': ''}]
+        popen = Popen(cmd, cmd_def=cmd_def, splits=2)
+        assert len(popen._jobs['popens']) == 2
+        start = time.time()
+        while popen.poll() is None:
+            assert time.time() - start < 20
+            time.sleep(0.01)
+        assert popen.poll() == 3
+        #the first subjob is still running
+        assert popen._jobs['popens'][0].poll() is None
+        popen.kill()
+        assert popen.wait() == 3
+
+        #the subjobs reaped after a SIGCHLD
+        in_file = NamedTemporaryFile(suffix='.sh')
+        in_file.write('exit 0\nexit 0\nexit 4\nexit 0\n')
+        in_file.flush()
+        cmd = ['sh', in_file.name]
+        handler = signal.getsignal(signal.SIGCHLD)
+        popen = Popen(cmd, cmd_def=cmd_def, splits=2, chunk_size=1,
+                      sigchld=True)
+        assert signal.getsignal(signal.SIGCHLD) != handler
+        assert popen.wait() == 4
+        assert sorted(popen._job_retcodes.values()) == [0, 0, 0, 4]
+        #the handler is restored once the run has finished
+        assert signal.getsignal(signal.SIGCHLD) == handler
+
+        #the other children of the process keep their exit status
+        child = subprocess.Popen(['sh', '-c', 'exit 3'])
+        time.sleep(0.2)
+        popen = Popen(cmd, cmd_def=cmd_def, splits=2, chunk_size=1,
+                      sigchld=True)
+        assert popen.wait() == 4
+        assert child.wait() == 3
+
+        #the outputs are joined while poll returns
+        bin = create_test_binary()
+        out_file = NamedTemporaryFile()
+        joining = threading.Event()
+        def slow_joiner(out_file_, in_files_):
+            'It waits until the test lets it join'
+            joining.wait(20)
+            default_cat_joiner(out_file_, in_files_)
+        cmd_def = [{'options': STDOUT, 'io': 'out', 'joiner': slow_joiner}]
+        popen = Popen([bin, '-o', 'hola'], stdout=out_file, cmd_def=cmd_def,
+                      splits=2)
+        start = time.time()
+        while not popen._joins_finished:
+            assert popen.poll() is None
+            assert time.time() - start < 20
+            time.sleep(0.01)
+        assert popen.poll() is None
+        joining.set()
+        assert popen.wait() == 0
+        assert open(out_file.name).read() == 'hola' * 2
+        os.remove(bin)
+
     @staticmethod
     def test_nosplit():
         'It test that we can set some input files to be not split'
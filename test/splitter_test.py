@@ -19,12 +19,17 @@ Created on 03/12/2009
 # You should have received a copy of the GNU Affero General Public License
 # along with psubprocess. If not, see <http://www.gnu.org/licenses/>.
 
-import unittest, os
+import unittest, os, re, gzip
 from tempfile import NamedTemporaryFile
 from psubprocess.utils import DATA_DIR
 from psubprocess.prunner import NamedTemporaryDir
 from psubprocess.splitters import (create_file_splitter_with_re, fastq_splitter,
-                                   bam_splitter, blank_line_splitter)
+                                   bam_splitter, blank_line_splitter,
+                                   _split_weighted_ranges, _re_item_offsets,
+                                   _literal_item_offsets, _read_index_cache,
+                                   get_splitter, create_stream_chunker,
+                                   create_partition_splitter)
+from psubprocess.bgzf import BgzfWriter
 
 class SplitterTest(unittest.TestCase):
     'It test that we can split the input files'
@@ -49,6 +54,126 @@ class SplitterTest(unittest.TestCase):
         dir2.close()
         dir3.close()
 
+    @staticmethod
+    def test_re_splitter_offsets():
+        'The re splitter copies the items from the offsets found in one pass'
+        content = '>seq1\nACTG\n>seq2\nGT\nCA\n>seq3\nAA\n'
+        file_ = NamedTemporaryFile()
+        file_.write(content)
+        file_.flush()
+
+        splitter = create_file_splitter_with_re(expression='^>')
+        dir1 = NamedTemporaryDir()
+        dir2 = NamedTemporaryDir()
+        new_files = splitter(file_.name, [dir1, dir2])
+        assert len(new_files) == 2
+        assert open(new_files[0]).read() == '>seq1\nACTG\n>seq2\nGT\nCA\n'
+        assert open(new_files[1]).read() == '>seq3\nAA\n'
+        dir1.close()
+        dir2.close()
+
+        #an empty file has no items
+        file_ = NamedTemporaryFile()
+        dir1 = NamedTemporaryDir()
+        assert not splitter(file_.name, [dir1])
+        dir1.close()
+
+    @staticmethod
+    def test_byte_balanced_splitter():
+        'The items can be distributed to get splits with similar sizes'
+        content = '>s1\n' + 'A' * 100 + '\n>s2\nA\n>s3\nA\n>s4\nA\n'
+        file_ = NamedTemporaryFile()
+        file_.write(content)
+        file_.flush()
+
+        splitter = create_file_splitter_with_re(expression='^>',
+                                                balance='bytes')
+        dir1 = NamedTemporaryDir()
+        dir2 = NamedTemporaryDir()
+        new_files = splitter(file_.name, [dir1, dir2])
+        assert open(new_files[0]).read() == '>s1\n' + 'A' * 100 + '\n'
+        assert open(new_files[1]).read() == '>s2\nA\n>s3\nA\n>s4\nA\n'
+
+        #every item weighs what the given function says
+        splitter = create_file_splitter_with_re(expression='^>',
+                                                balance=lambda item: 1)
+        new_files = splitter(file_.name, [dir1, dir2])
+        assert open(new_files[1]).read() == '>s3\nA\n>s4\nA\n'
+        dir1.close()
+        dir2.close()
+
+    @staticmethod
+    def test_weighted_ranges():
+        'Every split gets at least one item'
+        assert _split_weighted_ranges([0, 10, 11, 12], 2) == [(0, 1), (1, 3)]
+        assert _split_weighted_ranges([0, 1, 2, 100], 3) == [(0, 1), (1, 2),
+                                                             (2, 3)]
+        assert _split_weighted_ranges([0, 100, 101], 3) == [(0, 1), (1, 2)]
+        assert _split_weighted_ranges([0], 3) == []
+
+    @staticmethod
+    def test_literal_offsets():
+        'The literals are found with numpy at the same offsets than the re'
+        content = '>s1\nA>\n>s2\n\n>s3>\nAC\nGT>'
+        file_ = NamedTemporaryFile()
+        file_.write(content)
+        file_.flush()
+        for expression in ('>', '^>', 'A', '^A', '', '>s'):
+            expected = _re_item_offsets(open(file_.name),
+                                        re.compile(expression))
+            for block_size in (1, 3, 1000):
+                offsets = _literal_item_offsets(open(file_.name), expression,
+                                                block_size=block_size)
+                assert offsets == expected
+
+    @staticmethod
+    def test_index_cache():
+        'The item offsets can be stored in an index file'
+        content = '>s1\nAC\n>s2\nGT\n'
+        file_ = NamedTemporaryFile()
+        file_.write(content)
+        file_.flush()
+        index_fname = file_.name + '.psidx'
+
+        splitter = create_file_splitter_with_re(expression='^>',
+                                                index_cache=True)
+        dir1 = NamedTemporaryDir()
+        dir2 = NamedTemporaryDir()
+        new_files = splitter(file_.name, [dir1, dir2])
+        assert open(new_files[1]).read() == '>s2\nGT\n'
+        assert os.path.exists(index_fname)
+        #the index is used
+        offsets = _read_index_cache(file_.name, 'literal', '^>')
+        assert list(offsets) == [0, 7, 14]
+
+        #a modified file invalidates the index
+        file_.write('>s3\nAA\n')
+        file_.flush()
+        assert _read_index_cache(file_.name, 'literal', '^>') is None
+        new_files = splitter(file_.name, [dir1, dir2])
+        assert open(new_files[1]).read() == '>s3\nAA\n'
+
+        #a corrupt index is ignored
+        index = open(index_fname).read()
+        open(index_fname, 'w').write(index[:-3])
+        assert _read_index_cache(file_.name, 'literal', '^>') is None
+        new_files = splitter(file_.name, [dir1, dir2])
+        assert open(new_files[1]).read() == '>s3\nAA\n'
+        os.remove(index_fname)
+
+        #the items can begin after some blank lines
+        file_ = NamedTemporaryFile()
+        file_.write('\n\nitem1\n\nitem2\n')
+        file_.flush()
+        splitter = get_splitter('blank_line', index_cache=True)
+        new_files = splitter(file_.name, [dir1, dir2])
+        assert open(new_files[1]).read() == 'item2\n'
+        offsets = _read_index_cache(file_.name, 'blank_line', None)
+        assert list(offsets) == [2, 9, 15]
+        os.remove(file_.name + '.psidx')
+        dir1.close()
+        dir2.close()
+
     @staticmethod
     def test_fastq_splitter():
         'It tests the fastq splitter'
@@ -69,6 +194,203 @@ class SplitterTest(unittest.TestCase):
         dir2.close()
         dir3.close()
 
+    @staticmethod
+    def test_fastq_records_kept():
+        'The fastq records are copied as they are and they are checked'
+        fastq = '@seq1 desc\nACTG\n+seq1 desc\nmoco\n@seq2\nGTCA\n+\nhola\n\n'
+        file_ = NamedTemporaryFile()
+        file_.write(fastq)
+        file_.flush()
+        dir1 = NamedTemporaryDir()
+        dir2 = NamedTemporaryDir()
+        new_files = fastq_splitter(file_.name, [dir1, dir2])
+        expected = '@seq1 desc\nACTG\n+seq1 desc\nmoco\n'
+        assert open(new_files[0]).read() == expected
+        assert open(new_files[1]).read() == '@seq2\nGTCA\n+\nhola\n\n'
+
+        for fastq in ('@seq1\nACTG\n+\nmoc\n', 'seq1\nACTG\n+\nmoco\n',
+                      '@seq1\nACTG\n+seq2\nmoco\n', '@seq1\nACTG\nmoco\n',
+                      '@seq1\nACTG\n+\nmoco\n\n@seq2\nA\n+\nm\n'):
+            file_ = NamedTemporaryFile()
+            file_.write(fastq)
+            file_.flush()
+            try:
+                fastq_splitter(file_.name, [dir1, dir2])
+                raise AssertionError('ValueError expected for: ' + fastq)
+            except ValueError:
+                pass
+        dir1.close()
+        dir2.close()
+
+    @staticmethod
+    def test_split_plan():
+        'Several files can be split with the same boundaries'
+        fastq1 = '@s1/1\n' + 'A' * 50 + '\n+\n' + 'I' * 50 + '\n'
+        fastq1 += '@s2/1\nA\n+\nI\n@s3/1\nA\n+\nI\n'
+        fastq2 = '@s1/2\nA\n+\nI\n@s2/2\nA\n+\nI\n'
+        fastq2 += '@s3/2\n' + 'A' * 50 + '\n+\n' + 'I' * 50 + '\n'
+        files = []
+        for fastq in (fastq1, fastq2):
+            file_ = NamedTemporaryFile()
+            file_.write(fastq)
+            file_.flush()
+            files.append(file_)
+        dirs = [NamedTemporaryDir(), NamedTemporaryDir()]
+
+        plan = {}
+        splitter = get_splitter('fastq', balance='bytes', split_plan=plan)
+        new_files1 = splitter(files[0].name, dirs)
+        new_files2 = splitter(files[1].name, dirs)
+        assert open(new_files1[1]).read().startswith('@s2/1')
+        assert open(new_files2[1]).read().startswith('@s2/2')
+
+        #the files should have the same number of items
+        file_ = NamedTemporaryFile()
+        file_.write('@s1/2\nA\n+\nI\n')
+        file_.flush()
+        try:
+            splitter(file_.name, dirs)
+            raise AssertionError('ValueError expected')
+        except ValueError:
+            pass
+        for dir_ in dirs:
+            dir_.close()
+
+    @staticmethod
+    def test_chunk_size():
+        'The file can be split in chunks of a given size'
+        content = ''.join(['>s%d\n%s\n' % (index, 'A' * index)
+                                                      for index in range(10)])
+        file_ = NamedTemporaryFile()
+        file_.write(content)
+        file_.flush()
+        dirs = []
+        def create_dir():
+            'It creates a new dir'
+            dirs.append(NamedTemporaryDir())
+            return dirs[-1]
+        class WorkDirs(object):
+            'The work dirs are created when asked for'
+            def __getitem__(self, index):
+                while index >= len(dirs):
+                    create_dir()
+                return dirs[index]
+        splitter = get_splitter('>', chunk_size=3)
+        new_files = splitter(file_.name, WorkDirs())
+        assert len(new_files) == 4
+        assert open(new_files[1]).read() == '>s3\nAAA\n>s4\nAAAA\n>s5\nAAAAA\n'
+
+        #the chunks can have a size in bytes
+        splitter = get_splitter('>', chunk_size=20, balance='bytes')
+        new_files = splitter(file_.name, WorkDirs())
+        #95 bytes in 5 chunks
+        assert len(new_files) == 5
+        assert ''.join([open(new_file).read()
+                                          for new_file in new_files]) == content
+        for dir_ in dirs:
+            dir_.close()
+
+    @staticmethod
+    def test_partition_splitter():
+        'The items with the same key are in the same split'
+        lines = ['r%d\tk%d\n' % (index, (index * 7) % 5) for index in range(40)]
+        in_file = NamedTemporaryFile(suffix='.sam')
+        in_file.write('@HD\tVN:1.0\n' + ''.join(lines))
+        in_file.flush()
+        dirs = [NamedTemporaryDir() for index in range(3)]
+        splitter = get_splitter('', partition=1, header='@')
+        splits = splitter(in_file.name, dirs)
+        assert len(splits) == 3
+        keys_in_splits = []
+        items = []
+        for split in splits:
+            content = open(split).read()
+            assert content.startswith('@HD\tVN:1.0\n')
+            split_lines = content.splitlines(True)[1:]
+            items.extend(split_lines)
+            keys_in_splits.append(set([line.split()[1]
+                                                    for line in split_lines]))
+        assert sorted(items) == sorted(lines)
+        all_keys = [key for keys in keys_in_splits for key in keys]
+        assert len(all_keys) == len(set(all_keys)) == 5
+        #the order of the items is kept inside every split
+        for split in splits:
+            split_lines = open(split).readlines()[1:]
+            assert split_lines == [line for line in lines
+                                                    if line in split_lines]
+
+        #the multiline items with a regex key
+        in_file = NamedTemporaryFile(suffix='.fasta')
+        in_file.write('>s1 g=a\nAC\n>s2 g=b\nGT\n>s3 g=a\nTT\n')
+        in_file.flush()
+        splitter = create_partition_splitter('>', r'g=(\w+)')
+        splits = splitter(in_file.name, dirs)
+        contents = [open(split).read() for split in splits]
+        assert '>s1 g=a\nAC\n>s3 g=a\nTT\n' in contents
+        assert '>s2 g=b\nGT\n' in contents
+        for dir_ in dirs:
+            dir_.close()
+
+    @staticmethod
+    def test_stream_chunker():
+        'A stream is cut into chunks of whole items'
+        content = '>s1\nAC\n>s2\nA\n>s3\nC\n>s4\nG'
+        chunker = create_stream_chunker('>', chunk_size=3)
+        chunks = []
+        for index in range(0, len(content), 5):
+            chunks.extend(chunker.feed(content[index:index + 5]))
+        assert chunks == ['>s1\nAC\n>s2\nA\n>s3\nC\n']
+        assert chunker.close() == ['>s4\nG']
+
+        chunker = create_stream_chunker('fastq', chunk_size=1)
+        chunks = chunker.feed('@s1\nA\n+\nI\n@s2\nA\n+\nI\n')
+        assert chunks == ['@s1\nA\n+\nI\n']
+        assert chunker.close() == ['@s2\nA\n+\nI\n']
+
+        chunker = create_stream_chunker('>', chunk_size=10, balance='bytes')
+        assert chunker.feed(content) == ['>s1\nAC\n>s2\nA\n']
+        assert chunker.close() == ['>s3\nC\n>s4\nG']
+
+    @staticmethod
+    def test_compressed_splitter():
+        'The gzip and BGZF files are split without decompressing them'
+        content = ''.join(['@s%d\nACGT\n+\nIIII\n' % index
+                                                    for index in range(40000)])
+        gzip_fhand = NamedTemporaryFile(suffix='.fastq.gz')
+        gzip_file = gzip.GzipFile(gzip_fhand.name, 'wb')
+        gzip_file.write(content)
+        gzip_file.close()
+        bgzf_fhand = NamedTemporaryFile(suffix='.fastq.gz')
+        writer = BgzfWriter(open(bgzf_fhand.name, 'wb'))
+        writer.write(content)
+        writer.close()
+        plain_fhand = NamedTemporaryFile(suffix='.fastq')
+        plain_fhand.write(content)
+        plain_fhand.flush()
+        dirs = [NamedTemporaryDir(), NamedTemporaryDir(), NamedTemporaryDir()]
+        for splitter in (fastq_splitter, create_file_splitter_with_re('^@'),
+                         get_splitter('fastq', balance='bytes',
+                                      write_workers=3)):
+            #the splits should be the ones of the uncompressed file
+            expected = [open(new_file).read()
+                           for new_file in splitter(plain_fhand.name, dirs)]
+            assert len(expected) == 3
+            for fname in (gzip_fhand.name, bgzf_fhand.name):
+                new_files = splitter(fname, dirs)
+                assert new_files[0].endswith('.fastq')
+                assert [open(new_file).read()
+                                        for new_file in new_files] == expected
+
+        #the splits can be compressed
+        splitter = get_splitter('fastq', compress_splits=True)
+        new_files = splitter(bgzf_fhand.name, dirs)
+        assert new_files[0].endswith('.fastq.gz')
+        split_content = ''.join([gzip.open(new_file).read()
+                                                  for new_file in new_files])
+        assert split_content == content
+        for dir_ in dirs:
+            dir_.close()
+
     @staticmethod
     def test_blank_line_splitter():
         'It tests the blank line splitter'
@@ -0,0 +1,76 @@
+'''
+Created on 17/10/2026
+
+@author: jose
+'''
+
+# Copyright 2009 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of psubprocess.
+# psubprocess is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# psubprocess is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with psubprocess. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from tempfile import NamedTemporaryFile
+
+from psubprocess.utils import (copy_file_section, map_in_threads,
+                               _get_libc_function)
+
+class UtilsTest(unittest.TestCase):
+    'It tests the utilities'
+
+    @staticmethod
+    def test_copy_file_section():
+        'It copies a byte range at the end of a file'
+        content = '0123456789' * 1000
+        in_fhand = NamedTemporaryFile()
+        in_fhand.write(content)
+        in_fhand.flush()
+        out_fhand = NamedTemporaryFile()
+        out_fhand.write('head')
+        copy_file_section(open(in_fhand.name, 'rb'), out_fhand, 5, 9005)
+        out_fhand.write('tail')
+        out_fhand.flush()
+        assert open(out_fhand.name).read() == 'head' + content[5:9005] + 'tail'
+
+        #if the file is shorter we get what it is in it
+        out_fhand = NamedTemporaryFile()
+        copy_file_section(open(in_fhand.name, 'rb'), out_fhand, 9995, 11000)
+        out_fhand.flush()
+        assert open(out_fhand.name).read() == '56789'
+
+    @staticmethod
+    def test_libc_functions_cached():
+        'The libc functions are looked up only once'
+        func = _get_libc_function('sendfile')
+        assert _get_libc_function('sendfile') is func
+        assert _get_libc_function('not_a_libc_function') is None
+
+    @staticmethod
+    def test_map_in_threads():
+        'It runs a function in several threads and keeps the order'
+        assert map_in_threads(lambda x: x * 2, range(20), 4) == range(0, 40, 2)
+        assert map_in_threads(lambda x: x * 2, [1, 2]) == [2, 4]
+        def fail(item):
+            'It fails for one item'
+            if item == 3:
+                raise ValueError('3')
+            return item
+        try:
+            map_in_threads(fail, range(10), 3)
+            raise AssertionError('ValueError expected')
+        except ValueError:
+            pass
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()